@@ -6,22 +6,86 @@
 import sys
 import logging
 import re
+import email.message
 import email.parser
 import email.utils
 import couchdb.client
 import socket
 import urllib
+import base64
 import hashlib
-
+import copy
+import threading
+import Queue
+import tempfile
+import time
+import json
+
+import mimestream
+import journal
+import blobstore
+import instrument
+import policy
+import throttle
+
+from collections import defaultdict
 from datetime import date
 from optparse import OptionParser
+import imaplib
 from imaplib import IMAP4, IMAP4_SSL
+from instrument import format_size, format_duration
 from types import ListType, TupleType
 
 missing = object()
 
+# UID MOVE (RFC 6851), not known to older imaplib versions
+imaplib.Commands.setdefault('MOVE', ('SELECTED', ))
+
 excluded_uids = ["339", "18205", "11382", "22493", "24791","4196", "27970","28193", "9472"]
 
+# number of messages to ask for in a single UID FETCH command
+FETCH_BATCH_SIZE = 500
+
+# prefix of the ids of the CouchDB documents holding attachment contents, followed by their SHA-256
+BLOB_PREFIX = 'blob-sha256-'
+
+# seconds to wait for a concurrent upload of the same attachment content to complete before taking it over,
+# polling its blob document every BLOB_POLL_INTERVAL seconds
+BLOB_WAIT_SECONDS = 300
+BLOB_POLL_INTERVAL = 2
+
+# estimated peak memory use of parsing a mail in memory, as a multiple of its size
+MEMORY_FACTOR = 4
+
+# number of processed messages between checkpoints, which write queued archive documents, delete the
+# originals of rewritten messages and commit the journal
+CHECKPOINT_INTERVAL = 100
+
+# limits of the stripped mails sent to the server in a single pipelined batch of APPENDs
+APPEND_BATCH_SIZE = 50
+APPEND_BATCH_BYTES = 16 * 1024 * 1024
+
+# approximate size of the notice replacing a removed attachment, for --plan estimates
+NOTICE_SIZE = 300
+
+# upper end of the CouchDB key range used to list the documents of a mailbox, sorts after all ids
+DOC_ID_RANGE_END = u'\ufff0'
+
+# Gmail drops connections beyond 15 simultaneous IMAP sessions per account, leave some for the users
+GMAIL_MAX_SESSIONS = 10
+
+# errors meaning the IMAP session is gone (IMAP4.readonly is an IMAP4.abort too, but not one of them)
+SESSION_ERRORS = (IMAP4.abort, socket.error)
+
+# attempts to reconnect after the IMAP session dropped, waiting RECONNECT_DELAY seconds before the first one
+# and twice as long before each further one, up to MAX_RECONNECT_DELAY
+MAX_RECONNECTS = 5
+RECONNECT_DELAY = 2
+MAX_RECONNECT_DELAY = 120
+
+# times an operation is tried again on a new session after the session dropped during it
+MAX_RETRIES = 3
+
 
 def get_filename_from_part(part):
     """Get filename from a message part.
@@ -36,12 +100,82 @@ def get_filename_from_part(part):
         if filename is not missing:
             filename = email.utils.collapse_rfc2231_value(filename).strip()
 
+    if isinstance(filename, unicode):
+        # RFC 2231 encoded filename
+        filename = filename.encode('utf-8')
     filename = str(filename).replace('\n','')
     filename = re.sub('[^\x21-\x7E]*', '', filename)
     filename = re.sub('^_+', '', filename)
     return filename
 
 
+def attachment_type(part):
+    """Return the filename and MIME type to archive an attachment part under.
+
+    >>> part = email.message_from_string('Content-Type: image/png\\nContent-Disposition: attachment; '
+    ...                                  'filename="a.png"\\n\\nx')
+    >>> attachment_type(part)
+    ('a.png', 'image/png')
+    >>> attachment_type(email.message_from_string('Content-Type: foo; filename=b.bin\\n\\nx'))
+    ('b.bin', 'application/octet-stream')
+    """
+    filename = get_filename_from_part(part)
+    params = part.get_params()
+    if len(params) > 0 and '/' in params[0][0]:
+        mimetype = params[0][0]
+    else:
+        mimetype = 'application/octet-stream'
+    return filename, mimetype
+
+
+def append_flags(flags):
+    """Turn the flags returned by parse_flags() into the flag list of an APPEND command.
+
+    \\Recent can only be set by the server and is left out.
+    >>> append_flags('\\\\Seen \\\\Recent $Label1')
+    '(\\\\Seen $Label1)'
+    >>> append_flags('\\\\Recent') is None
+    True
+    >>> append_flags(None) is None
+    True
+    """
+    flags = [flag for flag in (flags or '').split() if flag.lower() != '\\recent']
+    if not flags:
+        return None
+    return '(%s)' % ' '.join(flags)
+
+
+def expand_uid_set(uid_set):
+    """Expand an IMAP UID set without '*' into a list of UIDs, the inverse of compress_uid_set().
+
+    >>> expand_uid_set('3:5,9')
+    ['3', '4', '5', '9']
+    """
+    uids = []
+    for item in uid_set.split(','):
+        if ':' in item:
+            first, last = sorted(int(uid) for uid in item.split(':'))
+            uids.extend(str(uid) for uid in range(first, last + 1))
+        else:
+            uids.append(item)
+    return uids
+
+
+def parse_appenduid(text):
+    """Parse the APPENDUID response code of an APPEND response into the UIDVALIDITY and the new UIDs.
+
+    Returns (None, []) if the response has no APPENDUID.
+    >>> parse_appenduid('[APPENDUID 38505 3955:3957] APPEND completed')
+    (38505, ['3955', '3956', '3957'])
+    >>> parse_appenduid('APPEND completed')
+    (None, [])
+    """
+    m = re.search(r'\[APPENDUID (\d+) ([\d:,]+)\]', text or '', re.IGNORECASE)
+    if not m:
+        return None, []
+    return int(m.group(1)), expand_uid_set(m.group(2))
+
+
 def split_response(resp):
     """Itemize an IMAP response into its elements.
 
@@ -107,6 +241,24 @@ def parse_uid(uidstr):
     return m.groups()[0]
 
 
+def parse_size(sizestr):
+    """Retrieve the IMAP RFC822.SIZE from a string.
+
+    Parses the "RFC822.SIZE 1234" section from a string, returning the size as an int.
+
+    >>> parse_size("(UID 321 RFC822.SIZE 44827 FLAGS (Foo Bar))")
+    44827
+    >>> parse_size("(UID 321)") is None
+    True
+    """
+    if (isinstance(sizestr, ListType) or isinstance(sizestr, TupleType)):
+        sizestr = sizestr[0]
+    m = re.match(r".*RFC822\.SIZE\s+(\d+).*", sizestr)
+    if not m:
+        return None
+    return int(m.groups()[0])
+
+
 def parse_internaldate(datestr):
     """Retrieve IMAP internal date from a string.
 
@@ -124,11 +276,266 @@ def parse_internaldate(datestr):
     return m.groups()[0]
 
 
+def parse_gm_msgid(msgidstr):
+    """Retrieve the Gmail message id (X-GM-MSGID, see Gmail's X-GM-EXT-1 extension) from a string.
+
+    The message id is the same in all mailboxes (labels) a Gmail message shows up in.
+
+    >>> parse_gm_msgid("(UID 321 X-GM-MSGID 1278455344230334865 RFC822.SIZE 44827)")
+    '1278455344230334865'
+    >>> parse_gm_msgid("(UID 321)") is None
+    True
+    """
+    m = re.match(r".*X-GM-MSGID\s+(\d+).*", msgidstr, re.IGNORECASE)
+    if not m:
+        return None
+    return m.groups()[0]
+
+
+def compress_uid_set(uids):
+    """Compress a list of UIDs into an IMAP sequence set.
+
+    Consecutive UIDs are joined into ranges, so a whole mailbox usually fits into a short string.
+
+    >>> compress_uid_set(['1', '2', '3', '5', '8', '7'])
+    '1:3,5,7:8'
+    >>> compress_uid_set(range(1, 501) + [733] + range(900, 1201))
+    '1:500,733,900:1200'
+    >>> compress_uid_set([])
+    ''
+    """
+    ranges = []
+    for uid in sorted(set(int(uid) for uid in uids)):
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join([(start == end and str(start)) or '%d:%d' % (start, end) for start, end in ranges])
+
+
+def chunks(seq, size):
+    """Split a sequence into lists of at most size items.
+
+    >>> list(chunks(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    """
+    seq = list(seq)
+    for pos in range(0, len(seq), size):
+        yield seq[pos:pos + size]
+
+
+def _tokenize_response(data):
+    """Split imaplib response data into tokens.
+
+    Literals (the second element of tuples in the response data) are returned as plain strings in place of
+    their {size} marker.
+    """
+    tokens = []
+    for item in data:
+        if item is None:
+            continue
+        literal = None
+        if isinstance(item, TupleType):
+            item, literal = item
+            item = re.sub(r'\{\d+\}$', '', item)
+        pos = 0
+        while pos < len(item):
+            char = item[pos]
+            if char in ' \r\n':
+                pos += 1
+            elif char in '()':
+                tokens.append(char)
+                pos += 1
+            elif char == '"':
+                pos += 1
+                value = []
+                while item[pos] != '"':
+                    if item[pos] == '\\':
+                        pos += 1
+                    value.append(item[pos])
+                    pos += 1
+                tokens.append(('string', ''.join(value)))
+                pos += 1
+            else:
+                start = pos
+                depth = 0
+                while pos < len(item) and (depth or item[pos] not in ' ()'):
+                    if item[pos] == '[':
+                        depth += 1
+                    elif item[pos] == ']':
+                        depth -= 1
+                    pos += 1
+                tokens.append(('atom', item[start:pos]))
+        if literal is not None:
+            tokens.append(('string', literal))
+    return tokens
+
+
+def parse_response(data):
+    """Parse imaplib response data into nested lists.
+
+    Atoms and strings become str, NIL becomes None and parenthesized lists become lists. Unlike
+    split_response() this handles nested lists, escapes and literals.
+
+    >>> parse_response(['1 (FLAGS (\\\\Seen foo) INTERNALDATE "14-Nov-2009 16:05:24 +0000" X NIL)'])
+    ['1', ['FLAGS', ['\\\\Seen', 'foo'], 'INTERNALDATE', '14-Nov-2009 16:05:24 +0000', 'X', None]]
+    >>> parse_response([('2 (UID 18 BODY[HEADER.FIELDS (FROM)] {6}', 'a\\r\\nb\\r\\n'), ')'])
+    ['2', ['UID', '18', 'BODY[HEADER.FIELDS (FROM)]', 'a\\r\\nb\\r\\n']]
+    """
+    result = []
+    stack = [result]
+    for token in _tokenize_response(data):
+        if token == '(':
+            stack.append([])
+            stack[-2].append(stack[-1])
+        elif token == ')':
+            stack.pop()
+        elif token[0] == 'atom' and token[1].upper() == 'NIL':
+            stack[-1].append(None)
+        else:
+            stack[-1].append(token[1])
+    return result
+
+
+def parse_fetch_response(data):
+    """Parse the data of a FETCH response into a list of (message number, {item: value}) tuples.
+
+    Item names are upper-cased. The BODY.PEEK items of the request show up as BODY.
+
+    >>> response = parse_fetch_response(['1 (UID 17 RFC822.SIZE 42)',
+    ...                                  ('2 (uid 18 BODY[1] {5}', 'hello'), ')'])
+    >>> [(num, sorted(items.items())) for num, items in response]
+    [('1', [('RFC822.SIZE', '42'), ('UID', '17')]), ('2', [('BODY[1]', 'hello'), ('UID', '18')])]
+    """
+    ret = []
+    tokens = parse_response(data)
+    for pos in range(0, len(tokens) - 1, 2):
+        items = tokens[pos + 1]
+        if not isinstance(items, ListType):
+            continue
+        ret.append((tokens[pos], dict((items[i].upper(), items[i + 1]) for i in range(0, len(items) - 1, 2))))
+    return ret
+
+
+def _structure_header(value, params):
+    """Build a MIME header value from a BODYSTRUCTURE value and parameter list."""
+    params = params or []
+    for i in range(0, len(params) - 1, 2):
+        value += '; %s="%s"' % (params[i].lower(), email.utils.quote(params[i + 1] or ''))
+    return value
+
+
+def _structure_part(content_type, params, encoding, disposition):
+    """Construct a header-only message part from BODYSTRUCTURE fields."""
+    part = email.message.Message()
+    part['Content-Type'] = _structure_header(content_type, params)
+    if encoding:
+        part['Content-Transfer-Encoding'] = encoding.lower()
+    if isinstance(disposition, ListType) and disposition and disposition[0]:
+        part['Content-Disposition'] = _structure_header(disposition[0].lower(), disposition[1])
+    return part
+
+
+def _join_section(section, num):
+    if section:
+        return '%s.%d' % (section, num)
+    return str(num)
+
+
+def _walk_structure(structure, section, parts, root):
+    """Recursive worker for structure_parts()."""
+    if isinstance(structure[0], ListType):
+        children = []
+        for child in structure:
+            if not isinstance(child, ListType):
+                break
+            children.append(child)
+        extension = structure[len(children) + 1:] + [None, None]
+        content_type = 'multipart/' + structure[len(children)].lower()
+        parts.append((section, _structure_part(content_type, extension[0], None, extension[1]), 0))
+        for num, child in enumerate(children):
+            _walk_structure(child, _join_section(section, num + 1), parts, False)
+        return
+
+    if root:
+        section = _join_section(section, 1)
+    content_type = ('%s/%s' % (structure[0], structure[1])).lower()
+    if content_type == 'message/rfc822':
+        disposition_pos = 11
+    elif content_type.startswith('text/'):
+        disposition_pos = 9
+    else:
+        disposition_pos = 8
+    disposition = len(structure) > disposition_pos and structure[disposition_pos] or None
+    parts.append((section, _structure_part(content_type, structure[2], structure[5], disposition),
+                  int(structure[6] or 0)))
+    if content_type == 'message/rfc822' and isinstance(structure[8], ListType):
+        _walk_structure(structure[8], section, parts, True)
+
+
+def structure_parts(structure):
+    """Flatten a parsed BODYSTRUCTURE into a list of (section, part, size) tuples.
+
+    The parts are email.message.Message objects carrying only the Content-Type, Content-Transfer-Encoding and
+    Content-Disposition headers, in the same order as email.message.Message.walk() would return them. The
+    section is suitable for BODY[<section>], size is the encoded size of the part body.
+
+    >>> bs = parse_response(['(("TEXT" "PLAIN" ("CHARSET" "us-ascii") NIL NIL "7BIT" 12 1 NIL NIL NIL NIL)'
+    ...                      '("APPLICATION" "PDF" NIL NIL NIL "BASE64" 5000 NIL'
+    ...                      ' ("ATTACHMENT" ("FILENAME" "a.pdf")) NIL NIL)'
+    ...                      ' "MIXED" ("BOUNDARY" "xx") NIL NIL NIL)'])[0]
+    >>> [(section, part.get_content_type(), size) for section, part, size in structure_parts(bs)]
+    [('', 'multipart/mixed', 0), ('1', 'text/plain', 12), ('2', 'application/pdf', 5000)]
+    >>> get_filename_from_part(structure_parts(bs)[2][1])
+    'a.pdf'
+    >>> bs = parse_response(['("TEXT" "HTML" NIL NIL NIL "QUOTED-PRINTABLE" 400 9 NIL NIL NIL NIL)'])[0]
+    >>> [(section, part.get_content_type(), size) for section, part, size in structure_parts(bs)]
+    [('1', 'text/html', 400)]
+    """
+    parts = []
+    _walk_structure(structure, '', parts, True)
+    return parts
+
+
+def hash_payload(payload):
+    """Return the SHA-256 hex digest and the length of a payload given as string or file object.
+
+    >>> hash_payload('hello')
+    ('2cf24dba5fb0a30e26e83b2ac5b9e29e1b161e5c1fa7425e73043362938b9824', 5)
+    >>> import StringIO
+    >>> hash_payload(StringIO.StringIO('hello')) == hash_payload('hello')
+    True
+    """
+    if not hasattr(payload, 'read'):
+        return hashlib.sha256(payload).hexdigest(), len(payload)
+
+    digest = hashlib.sha256()
+    length = 0
+    while True:
+        data = payload.read(mimestream.COPY_BUFFER_SIZE)
+        if not data:
+            break
+        digest.update(data)
+        length += len(data)
+    payload.seek(0)
+    return digest.hexdigest(), length
+
+
 class RemoveAttachmentsException(Exception):
     """Exception type generated by the RemoveAttachments class."""
     pass
 
 
+class ReconnectException(RemoveAttachmentsException):
+    """Raised if the work on a mailbox cannot be resumed after the IMAP session dropped."""
+    pass
+
+
+class ArchiveException(RemoveAttachmentsException):
+    """Raised if queued archive documents could not be written, the work on the mailbox is abandoned."""
+    pass
+
+
 class RemoveAttachments(object):
     """Remove attachments program class.
 
@@ -139,7 +546,9 @@ class RemoveAttachments(object):
 
     def __init__(self, server, port, ssl, username, password, only_mailbox=None, cdb_server=None,
                  cdb_db=None, remove=False, eat_more_attachments=False, gmail=False, min_size=0,
-                 before_date=None):
+                 before_date=None, workers=1, max_memory=0, bulk_size=0, journal_path=None,
+                 since_last_run=False, plan=False, plan_bandwidth=1, blob_store=None, metrics=None,
+                 governor=None, deadline=None, policy=None):
         """Constructor.
 
         Arguments:
@@ -156,60 +565,212 @@ class RemoveAttachments(object):
         gmail -- Enable Gmail quirks
         min_size -- minimum size of mails to examine, in kB (int, 0 to disable)
         before_date -- only look at mails that arrived before this date (datetime.date or None to disable)
+        workers -- number of IMAP sessions processing mailboxes concurrently (int)
+        max_memory -- memory budget per mail in MB, larger mails are streamed through disk (int, 0 to disable)
+        bulk_size -- write CouchDB documents in _bulk_docs batches of up to this many MB (int, 0 to disable)
+        journal_path -- SQLite journal file remembering processed messages (string or None to disable)
+        since_last_run -- only look at messages that arrived after the last complete run (needs a journal)
+        plan -- only estimate what a run would do from message and part sizes, see report_plan() afterwards
+        plan_bandwidth -- assumed IMAP transfer rate for the duration estimate of plan, in MB/s
+        blob_store -- URL of the store for attachment contents, see blobstore.open_store() (default: CouchDB)
+        metrics -- instrument.Metrics collecting phase timings and IMAP traffic (default: a new one)
+        governor -- throttle.Governor limiting the IMAP transfers of all sessions (default: no limits)
+        deadline -- time.time() after which no further mails are started, see _out_of_time() (default: none)
+        policy -- policy.Policy selecting the mails and attachments to take (default: all attachments)
         """
         if None in (server, username, password):
             raise RemoveAttachmentsException("Server, username and password are all required.")
 
+        if plan and not remove and cdb_server is None:
+            # planning is mostly done before removing, estimate that
+            remove = True
         if not remove and cdb_server is None:
             raise RemoveAttachmentsException("No action specified (expected a CouchDB server, or the " \
                                              "remove option, or both)")
 
+        if since_last_run and not journal_path:
+            raise RemoveAttachmentsException("Processing only new mails requires a journal.")
+
+        if blob_store and cdb_server is None:
+            raise RemoveAttachmentsException("A blob store needs a CouchDB server for the mail documents.")
+
+        self.server = server
+        self.port = port
+        self.ssl = ssl
+        self.username = username
+        self.password = password
+        self.metrics = metrics or instrument.Metrics('removeattachments')
+        self.governor = governor or throttle.Governor()
+        self.deadline = deadline
+        self.imap = self._connect_imap()
+
+        self.searchstr = ''
+        self.policy = policy
+        self.excluded_uids = set(excluded_uids)
+        if policy is not None:
+            self.excluded_uids.update(policy.exclude_uids)
+        self.remove = remove
+        self.min_size = min_size * 1024
+        self.before_date = before_date
+        self.eat_more_attachments = eat_more_attachments or False
+        self.only_mailbox = only_mailbox
+        self.gmail = gmail or False
+        self.cdb_server = cdb_server
+        self.cdb_db = cdb_db
+        self.workers = max(1, workers or 1)
+        self.max_memory = (max_memory or 0) * 1024 * 1024
+        self.stats = defaultdict(int)
+        # ids of attachment blobs known to be completely stored, shared by all workers
+        self.known_blobs = set()
+        # dedup key -> journal state of the messages processed so far in this run, shared by all workers. With
+        # Gmail, a message shows up in the mailbox of every label it has, see _dedup_key().
+        self.seen_mails = {}
+        # UID -> dedup key of the candidate messages of the current mailbox
+        self.dedup_keys = {}
+        # UIDVALIDITY of the mailbox being processed, verified when selecting it again after reconnecting
+        self.uidvalidity = None
+        self.blob_store = None
+        if blob_store:
+            try:
+                self.blob_store = blobstore.open_store(blob_store)
+            except blobstore.BlobStoreException, e:
+                raise RemoveAttachmentsException(str(e))
+        self.bulk_size = (bulk_size or 0) * 1024 * 1024
+        self.pending_docs = []
+        self.pending_blobs = {}
+        self.pending_bytes = 0
+        self.existing_docs = set()
+        # (uid, flags, idate, text) of stripped mails waiting to be appended, see _flush_appends()
+        self.pending_appends = []
+        self.pending_append_bytes = 0
+        # UIDs of originals whose stripped copy has been appended, to be deleted at the next checkpoint
+        self.pending_removals = []
+        self.needs_expunge = False
+        # mailbox -> estimate, filled in by all workers; None unless planning
+        self.plan = None
+        if plan:
+            self.plan = {}
+        self.plan_bandwidth = plan_bandwidth
+        self.db = self._connect_db()
+        self.journal_path = journal_path
+        self.since_last_run = since_last_run
+        self.journal = self._open_journal()
+
+    def _connect_imap(self):
+        """Open and log into a new IMAP session."""
         logging.debug("Connecting to IMAP server")
         try:
-            if ssl:
-                self.imap = IMAP4_SSL(server, port)
+            if self.ssl:
+                imap = IMAP4_SSL(self.server, self.port)
             else:
-                self.imap = IMAP4(server, port)
+                imap = IMAP4(self.server, self.port)
         except socket.error, e:
             raise RemoveAttachmentsException("Could not connect to IMAP server: " + str(e))
         except Exception, e:
             logging.exception(e)
             raise RemoveAttachmentsException("Could not connect to IMAP server")
+        instrument.instrument_imap(imap, self.metrics)
+        throttle.govern_imap(imap, self.governor)
 
         try:
-            self.imap.login(username, password)
+            imap.login(self.username, self.password)
         except IMAP4.error, e:
             raise RemoveAttachmentsException("Could not authenticate: " + str(e))
         except Exception, e:
             logging.exception(e)
             raise RemoveAttachmentsException("Could not authenticate")
 
-        self.searchstr = ''
-        self.remove = remove
-        self.min_size = min_size * 1024
-        self.before_date = before_date
-        self.eat_more_attachments = eat_more_attachments or False
-        self.only_mailbox = only_mailbox
-        self.gmail = gmail or False
-        self.cdb_server = cdb_server
-        self.cdb_db = cdb_db
+        # servers often announce extensions like UIDPLUS only to authenticated clients
+        typ, data = imap.capability()
+        if typ == 'OK' and data and data[-1]:
+            imap.capabilities = tuple(data[-1].upper().split())
+        return imap
 
-        if cdb_server:
-            cdb_db = cdb_db or "attachments"
-            logging.debug("Connecting to CouchDB")
+    def _reconnect(self, mailbox=None):
+        """Replace the dropped IMAP session with a new one, selecting mailbox again unless it is None.
+
+        Tries up to MAX_RECONNECTS times with exponentially growing waits. The mailbox must still have the
+        UIDVALIDITY it had when processing started, otherwise the UIDs looked up so far are meaningless.
+        """
+        try:
+            self.imap.shutdown()
+        except Exception:
+            pass
+        delay = RECONNECT_DELAY
+        for attempt in range(1, MAX_RECONNECTS + 1):
+            logging.info("Reconnecting to the IMAP server in %ds (attempt %d of %d)", delay, attempt,
+                         MAX_RECONNECTS)
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
             try:
-                self.db_server = couchdb.client.Server(cdb_server)
-                if cdb_db in self.db_server:
-                    self.db = self.db_server[cdb_db]
-                else:
-                    self.db = self.db_server.create(cdb_db)
-            except socket.error, e:
-                raise RemoveAttachmentsException("CouchDB socket error: " + str(e))
-            except Exception, e:
-                logging.exception(e)
-                raise RemoveAttachmentsException("CouchDB error")
-        else:
-            self.db = None
+                with self.metrics.phase('reconnect'):
+                    self.imap = self._connect_imap()
+                    if mailbox is not None:
+                        uidvalidity, uidnext = self._select_mailbox(mailbox)
+            except SESSION_ERRORS + (RemoveAttachmentsException, ), e:
+                logging.warning("Reconnecting failed: %s", e)
+                continue
+            self.stats['reconnects'] += 1
+            if mailbox is not None and (uidvalidity is None or uidvalidity != self.uidvalidity):
+                raise ReconnectException("Cannot resume %s, its UIDVALIDITY changed from %s to %s" % (
+                    mailbox, self.uidvalidity, uidvalidity))
+            return
+        raise ReconnectException("Could not reconnect to the IMAP server after %d attempts" % MAX_RECONNECTS)
+
+    def _reconnecting(self, mailbox, function, *args):
+        """Call function(*args) and return its result, calling it again on a new session if the session drops.
+
+        mailbox is the selected mailbox, or None. function must be safe to call again after it was
+        interrupted, so it must not keep a reference to the old session.
+        """
+        retries = 0
+        while True:
+            try:
+                return function(*args)
+            except SESSION_ERRORS, e:
+                if isinstance(e, IMAP4.readonly) or retries >= MAX_RETRIES:
+                    raise
+                retries += 1
+                logging.warning("IMAP session dropped: %s", e)
+                self.governor.throttled("session error: %s" % e)
+                self._reconnect(mailbox)
+
+    def _out_of_time(self):
+        """Whether the deadline has passed.
+
+        Mailboxes are left after the mail at hand then, with all work done so far checkpointed. The journal
+        remembers it, so the next run carries on where this one stopped.
+        """
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def _has_capability(self, name):
+        """Whether the IMAP server announced the capability name."""
+        return name in self.imap.capabilities
+
+    def _connect_db(self):
+        """Open the CouchDB database, creating it if needed. Returns None if archiving is disabled."""
+        if not self.cdb_server or self.plan is not None:
+            return None
+
+        cdb_db = self.cdb_db or "attachments"
+        logging.debug("Connecting to CouchDB")
+        try:
+            db_server = couchdb.client.Server(self.cdb_server)
+            if cdb_db in db_server:
+                return db_server[cdb_db]
+            else:
+                return db_server.create(cdb_db)
+        except socket.error, e:
+            raise RemoveAttachmentsException("CouchDB socket error: " + str(e))
+        except Exception, e:
+            logging.exception(e)
+            raise RemoveAttachmentsException("CouchDB error")
+
+    def _open_journal(self):
+        """Open the processing journal of this account. Returns None if the journal is disabled."""
+        if not self.journal_path:
+            return None
+        return journal.Journal(self.journal_path, "%s@%s:%s" % (self.username, self.server, self.port))
 
     def run(self):
         """Run the filtering process"""
@@ -231,6 +792,7 @@ class RemoveAttachments(object):
             typ, data = self.imap.list('')
             if typ != "OK":
                 raise RemoveAttachmentsException("LIST not OK")
+            mailboxes = []
             for ent in data:
                 split = split_response(ent)
                 if len(split) != 3:
@@ -239,34 +801,332 @@ class RemoveAttachments(object):
                 if split[2][0] != "string":
                     logging.error("Unrecognised non-string response %s", split[2][1])
                     continue
-                self._process_mailbox(split[2][1])
+                mailboxes.append(split[2][1])
+
+            if self.workers > 1 and len(mailboxes) > 1:
+                self._run_workers(mailboxes)
+            else:
+                for mailbox in mailboxes:
+                    self._process_mailbox(mailbox)
+
+        self._logout()
+        if self.journal is not None:
+            self.journal.close()
+        self.stats.update(self.governor.stats)
+        self._log_summary()
+
+    def _spawn_worker(self):
+        """Create a copy of this instance with its own IMAP session, CouchDB connection and statistics.
 
-        self.imap.logout()
+        Raises RemoveAttachmentsException if any of them cannot be opened, the session is logged out then.
+        """
+        worker = copy.copy(self)
+        worker.imap = self._connect_imap()
+        try:
+            worker.db = self._connect_db()
+            worker.journal = self._open_journal()
+        except:
+            worker._logout()
+            raise
+        worker.stats = defaultdict(int)
+        worker.pending_docs = []
+        worker.pending_blobs = {}
+        worker.pending_bytes = 0
+        worker.existing_docs = set()
+        worker.pending_removals = []
+        worker.pending_appends = []
+        return worker
+
+    def _logout(self):
+        """Log out of the IMAP session, ignoring errors of sessions that are gone already."""
+        try:
+            self.imap.logout()
+        except (IMAP4.error, socket.error):
+            pass
 
-    def _lookup_uids(self, mset):
+    def _run_workers(self, mailboxes):
+        """Process mailboxes concurrently over a pool of IMAP sessions.
+
+        Every worker owns a session and therefore its own SELECT state. Mailboxes are handed out one at a
+        time, so each mailbox is selected, expunged and closed by the same session. This instance is used as
+        the first worker. The statistics of the other workers are merged into it afterwards.
+        """
+        count = min(self.workers, len(mailboxes))
+        if self.gmail and count > GMAIL_MAX_SESSIONS:
+            logging.warning("Gmail allows at most %d concurrent IMAP sessions, using %d workers",
+                            GMAIL_MAX_SESSIONS, GMAIL_MAX_SESSIONS)
+            count = GMAIL_MAX_SESSIONS
+        logging.debug("Processing %d mailboxes with %d workers", len(mailboxes), count)
+        self.governor.set_max_sessions(count)
+
+        pool = [self]
+        try:
+            for i in range(count - 1):
+                try:
+                    pool.append(self._spawn_worker())
+                except (RemoveAttachmentsException, IMAP4.error, socket.error), e:
+                    # the server may allow fewer sessions than we asked for, make do with the others
+                    logging.warning("Could not open the session of another worker: %s", e)
+            if len(pool) < count:
+                logging.warning("Processing mailboxes with %d of %d workers", len(pool), count)
+                self.governor.set_max_sessions(len(pool))
+
+            queue = Queue.Queue()
+            for mailbox in mailboxes:
+                queue.put(mailbox)
+            threads = []
+            for num, worker in enumerate(pool):
+                thread = threading.Thread(target=worker._work_queue, args=(queue, ), name="worker-%d" % num)
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+        finally:
+            for worker in pool[1:]:
+                worker._logout()
+                if worker.journal is not None:
+                    worker.journal.close()
+                for key, value in worker.stats.items():
+                    self.stats[key] += value
+
+    def _work_queue(self, queue):
+        """Worker thread body: process mailboxes from queue until it is empty.
+
+        While the server is throttling, the governor lets fewer workers work at the same time.
+        """
+        while True:
+            with self.governor.session():
+                try:
+                    mailbox = queue.get_nowait()
+                except Queue.Empty:
+                    break
+                self._process_mailbox(mailbox)
+
+    def _log_summary(self):
+        """Log the statistics collected during the run."""
+        logging.info("Pre-scan skipped %d of %d mails without attachments, saving %d bytes of downloads",
+                     self.stats['prescan_skipped'], self.stats['prescan_skipped'] + self.stats['candidates'],
+                     self.stats['prescan_bytes_saved'])
+        if self.stats['streamed_mails'] or self.stats['streamed_sections']:
+            logging.info("Streamed %d mails and %d attachment sections exceeding the memory budget "
+                         "through disk",
+                         self.stats['streamed_mails'], self.stats['streamed_sections'])
+        if self.stats['dedup_hits'] or self.stats['uploaded_bytes']:
+            logging.info("Uploaded %d bytes of attachments, deduplication saved %d bytes in %d attachments",
+                         self.stats['uploaded_bytes'], self.stats['dedup_bytes_saved'],
+                         self.stats['dedup_hits'])
+        if self.stats['archived_sections_mails']:
+            logging.info("Archived %d mails from header and attachment sections, fetching %d of %d bytes",
+                         self.stats['archived_sections_mails'], self.stats['archived_sections_bytes'],
+                         self.stats['archived_sections_size'])
+        if self.stats['duplicate_mails']:
+            logging.info("Handled %d mails seen in another mailbox from their metadata, saving %d bytes of "
+                         "downloads", self.stats['duplicate_mails'], self.stats['duplicate_bytes_saved'])
+        if self.stats['throttle_signals']:
+            logging.info("The IMAP server throttled %d times, waited %d seconds for it",
+                         self.stats['throttle_signals'], self.stats['throttle_seconds'])
+        if self.stats['unfinished_mailboxes']:
+            logging.info("Ran out of time, %d mailboxes are left for the next run",
+                         self.stats['unfinished_mailboxes'])
+        if self.stats['reconnects']:
+            logging.info("Reconnected %d times after the IMAP session dropped", self.stats['reconnects'])
+        if self.stats['journal_skipped']:
+            logging.info("Journal skipped %d already processed mails", self.stats['journal_skipped'])
+        if self.stats['bulk_requests']:
+            logging.info("Wrote %d CouchDB documents in %d bulk requests",
+                         self.stats['bulk_docs'], self.stats['bulk_requests'])
+        self.metrics.log_summary()
+
+    def _lookup_uids(self, mailbox, first_uid=None, done=()):
+        """Search the selected mailbox and fetch the metadata of all matching messages.
+
+        Returns a list of dicts with the keys uid, flags, idate, size and rules, sorted by UID. Messages
+        listed in excluded_uids or done (a collection of int UIDs) and messages below first_uid are left out.
+        With a policy, every rule applying to mailbox is searched for separately, rules is the list of the
+        rules matching the message then, otherwise None.
+        """
         logging.debug("UID lookup...")
+        searches = [(None, self.searchstr)]
+        if self.policy is not None:
+            searches = [(rule, '(%s)' % ' '.join([self.searchstr[1:-1], rule.search]).strip())
+                        for rule in self.policy.rules_for(mailbox)]
+        rules = {}
+        for rule, searchstr in searches:
+            if first_uid is not None:
+                searchstr = '(UID %d:* %s)' % (first_uid, searchstr[1:-1])
+            logging.debug("IMAP search query is %s", searchstr)
+            with self.metrics.phase('search'):
+                typ, data = self.imap.uid('SEARCH', None, searchstr)
+            if typ != "OK":
+                raise Exception("Search not OK")
+            for uid_nr in (data and data[0] or '').split():
+                rules.setdefault(uid_nr, []).append(rule)
+
         uids = []
-        for num in mset.split():
-            typ, msg = self.imap.fetch(num, '(UID)')
+        for uid_nr in sorted(rules, key=int):
+            if uid_nr in self.excluded_uids:
+                logging.info("Skipping excluded UID %s", uid_nr)
+            elif int(uid_nr) in done:
+                self.stats['journal_skipped'] += 1
+            # "n:*" always matches the highest UID, even if it is lower than n
+            elif first_uid is None or int(uid_nr) >= first_uid:
+                uids.append(uid_nr)
+        messages = self._fetch_metadata(uids)
+        for message in messages:
+            message['rules'] = self.policy is not None and rules[message['uid']] or None
+        return messages
+
+    def _fetch_metadata(self, uids):
+        """Fetch FLAGS, INTERNALDATE and RFC822.SIZE for a list of UIDs in a few batched round trips.
+
+        With Gmail, the X-GM-MSGID or the Message-ID header is fetched as well for _dedup_key().
+        """
+        items = 'UID FLAGS INTERNALDATE RFC822.SIZE'
+        if self.gmail:
+            if self._has_capability('X-GM-EXT-1'):
+                items += ' X-GM-MSGID'
+            else:
+                items += ' BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]'
+        messages = []
+        for batch in chunks(uids, FETCH_BATCH_SIZE):
+            with self.metrics.phase('lookup'):
+                typ, data = self.imap.uid('FETCH', compress_uid_set(batch), '(%s)' % items)
             if typ != 'OK':
-                logging.warning("FETCH UID not OK, skipping message %s", num)
+                logging.warning("UID FETCH not OK, skipping %d messages", len(batch))
+                continue
+            wanted = set(batch)
+            for item in data:
+                if item is None:
+                    continue
+                header = None
+                if isinstance(item, TupleType):
+                    item, header = item
+                uid_nr = parse_uid(item)
+                # servers may send unsolicited FETCH responses for other messages (e.g. flag changes)
+                if uid_nr not in wanted:
+                    continue
+                wanted.discard(uid_nr)
+                message = {'uid': uid_nr,
+                           'flags': parse_flags(item),
+                           'idate': parse_internaldate(item),
+                           'size': parse_size(item)}
+                if self.gmail:
+                    message['key'] = self._dedup_key(parse_gm_msgid(item), header, message['size'])
+                messages.append(message)
+            if wanted:
+                logging.warning("No metadata returned for UIDs %s", compress_uid_set(wanted))
+
+        messages.sort(key=lambda message: int(message['uid']))
+        return messages
+
+    def _dedup_key(self, gm_msgid, header, size):
+        """Return the key identifying a message across mailboxes, None if there is none.
+
+        That is the Gmail message id if the server reports it, otherwise the Message-ID (taken from the
+        header string) together with the size.
+        """
+        if gm_msgid is not None:
+            return 'X-GM-MSGID ' + gm_msgid
+        message_id = header and email.parser.HeaderParser().parsestr(header)['message-id']
+        if not message_id or size is None:
+            return None
+        return 'Message-ID %s %d' % (message_id.strip(), size)
+
+    def _is_duplicate(self, key):
+        """Return whether a mail with the dedup key can be handled from its metadata, see _handle_duplicate().
+
+        Mails whose first copy was rewritten are processed again: the stripped version lives in the mailbox
+        of the first copy only, deleting this original would drop the mail from this mailbox (with Gmail,
+        the label would be lost).
+        """
+        return key in self.seen_mails and self.seen_mails[key] != journal.APPENDED
+
+    def _split_duplicates(self, messages):
+        """Split messages into those processed in another mailbox before (see _is_duplicate()) and the
+        others."""
+        duplicates = []
+        others = []
+        for message in messages:
+            if self._is_duplicate(message.get('key')):
+                duplicates.append(message)
             else:
-                uid_nr = parse_uid(msg[0])
-                if uid_nr not in excluded_uids:
-                    uids.append(uid_nr)
-                else:
-                    logging.info("Skipping excluded UID %s", uid_nr)
+                others.append(message)
+        return duplicates, others
 
-        return uids
+    def _prescan(self, messages):
+        """Fetch the BODYSTRUCTURE of messages in batches and return only those that have attachments.
+
+        The structure is evaluated with the same _part_is_attachment() rules that are applied to downloaded
+        mails, so only candidate messages need their bodies fetched. Each returned message dict gets a 'parts'
+        entry as returned by structure_parts(), or None if the structure could not be determined. Such
+        messages are kept as candidates.
+        """
+        by_uid = dict((message['uid'], message) for message in messages)
+        for batch in chunks(messages, FETCH_BATCH_SIZE):
+            with self.metrics.phase('prescan'):
+                typ, data = self.imap.uid('FETCH', compress_uid_set([message['uid'] for message in batch]),
+                                          '(UID BODYSTRUCTURE)')
+            if typ != 'OK':
+                logging.warning("BODYSTRUCTURE FETCH not OK, downloading %d messages unfiltered", len(batch))
+                continue
+            try:
+                response = parse_fetch_response(data)
+            except (IndexError, TypeError, ValueError, AttributeError):
+                logging.warning("Malformed BODYSTRUCTURE response, downloading %d messages unfiltered",
+                                len(batch))
+                continue
+            for num, items in response:
+                message = by_uid.get(items.get('UID'))
+                if message is None or not isinstance(items.get('BODYSTRUCTURE'), ListType):
+                    continue
+                try:
+                    message['parts'] = structure_parts(items['BODYSTRUCTURE'])
+                except (IndexError, TypeError, ValueError, AttributeError):
+                    logging.warning("Unparsable BODYSTRUCTURE for UID %s", message['uid'])
+
+        candidates = []
+        for message in messages:
+            parts = message.setdefault('parts', None)
+            if parts is not None and not [part for section, part, size in parts
+                                          if self._part_is_attachment(part, message['rules'], size)]:
+                logging.debug("No attachments in BODYSTRUCTURE of UID %s --> skip (%s bytes)",
+                              message['uid'], message['size'])
+                self.stats['prescan_skipped'] += 1
+                self.stats['prescan_bytes_saved'] += message['size'] or 0
+            else:
+                candidates.append(message)
+        self.stats['candidates'] += len(candidates)
+        return candidates
 
     def _process_mailbox(self, mailbox):
+        if self.policy is not None and not self.policy.rules_for(mailbox):
+            logging.debug("No policy rule applies to mailbox %s, skipping it", mailbox)
+            return
+        if self._out_of_time():
+            logging.info("Out of time, skipping mailbox %s", mailbox)
+            self.stats['unfinished_mailboxes'] += 1
+            return
         try:
-            self.__process_mailbox(mailbox)
+            with self.metrics.mailbox(mailbox):
+                if self.plan is not None:
+                    self._plan_mailbox(mailbox)
+                else:
+                    try:
+                        self.__process_mailbox(mailbox)
+                    finally:
+                        self._leave_mailbox(mailbox)
         except IMAP4.readonly, e:
             logging.info("Skipping mailbox %s as it is read-only", mailbox)
+        except SESSION_ERRORS, e:
+            # dropped sessions are a sign of the server throttling us, slow down the other sessions
+            self.governor.throttled("session error: %s" % e)
+            logging.warning("Error processing mailbox %s", mailbox)
+            logging.exception(e)
+            self.stats['failed_mailboxes'] += 1
         except Exception, e:
             logging.warning("Error processing mailbox %s", mailbox)
             logging.exception(e)
+            self.stats['failed_mailboxes'] += 1
 
     def __process_mailbox(self, mailbox):
         """Process an individual IMAP mailbox.
@@ -274,150 +1134,754 @@ class RemoveAttachments(object):
         If removing is enabled, the mailbox will be expunged during this function call.
         """
         logging.debug("Processing mailbox %s", mailbox)
-        self.imap.select(mailbox)
-
-        # recurse through every mailbox by looking at imap.list() output
-        typ, data = self.imap.search(None, self.searchstr)
-        if typ != "OK":
-            raise Exception("Search not OK")
-        if len(data) == 0 or len(data[0]) == 0:
-            return
+        self.uidvalidity, uidnext = self._reconnecting(None, self._select_mailbox, mailbox)
+        first_uid, done = self._open_mailbox_journal(mailbox)
 
         # In theory, we should be able to operate directly on the message sequence numbers returned by
-        # FETCH. According to the IMAP4rev1 specs, none of the operations we perform in the inner loop
+        # SEARCH. According to the IMAP4rev1 specs, none of the operations we perform in the inner loop
         # will affect the message sequencing. All new mails that we create (the ones without attachments)
         # are guaranteed to have higher sequence numbers and UIDs than the old ones.
         # Well, Gmail's IMAP server doesn't follow the specs here. When you APPEND a new mail to the
         # mailbox, it often ends up having a sequence number within the range that you had previously
         # SEARCHed for.
-        # We work around this by looking up the UIDs for all messages and working entirely with UIDs instead
-        # of sequence numbers.
-        uids = self._lookup_uids(data[0])
-
-        for uid in uids:
-            logging.debug("Retrieve mail with uid %s", uid)
-            typ, msg = self.imap.uid('FETCH', uid, '(FLAGS INTERNALDATE BODY.PEEK[])')
-            if typ != "OK":
-                #raise Exception("FETCH not OK")
-                print 'Fetch not OK: %s', uid
-                continue
-            if len(msg) < 1 or len(msg[0]) < 2:
-                #raise Exception("Malformed FETCH response")
-                print 'Malformed FETCH response'
-                continue
+        # We work around this by searching with UID SEARCH and working entirely with UIDs instead of
+        # sequence numbers. All per-message metadata is fetched up front in batches.
+        # If the session drops, it is replaced by a new one and processing resumes with the message at hand.
+        found = self._reconnecting(mailbox, self._lookup_uids, mailbox, first_uid, done)
+        # messages already processed in another mailbox need neither their structure nor their body
+        duplicates, others = self._split_duplicates(found)
+        candidates = self._reconnecting(mailbox, self._prescan, others)
+        messages = sorted(duplicates + candidates, key=lambda message: int(message['uid']))
+        self.dedup_keys = dict((message['uid'], message['key']) for message in messages if message.get('key'))
+        self.metrics.expect(len(messages), sum(message['size'] or 0 for message in messages))
+        if self.journal is not None:
+            candidates = set(message['uid'] for message in messages)
+            self.journal.record_many(mailbox, [message['uid'] for message in found
+                                               if message['uid'] not in candidates], journal.SKIPPED)
+        if messages and self.db is not None and self.bulk_size:
+            self.existing_docs = self._list_doc_ids(mailbox)
+
+        complete = True
+        for num, message in enumerate(messages):
+            if self._out_of_time():
+                logging.info("Out of time, leaving mailbox %s after %d of %d mails", mailbox, num,
+                             len(messages))
+                self.stats['unfinished_mailboxes'] += 1
+                complete = False
+                break
+            uid = message['uid']
+            key = message.get('key')
             try:
-                flags = None
-                for item in msg:
-                    flags = parse_flags(item)
-                    if flags is not None:
-                        break
-
-                idate = None
-                for item in msg:
-                    idate = parse_internaldate(item)
-                    if idate is not None:
-                        break
-                self._process_mail(mailbox, uid, flags, idate, msg[0][1])
+                if self._is_duplicate(key):
+                    state = self._handle_duplicate(mailbox, message, self.seen_mails[key])
+                else:
+                    state = self._reconnecting(mailbox, self._handle_message, mailbox, message)
+                if len(self.pending_appends) >= APPEND_BATCH_SIZE or \
+                        self.pending_append_bytes >= APPEND_BATCH_BYTES:
+                    # the archive documents of the stripped mails have to be written first
+                    self._checkpoint(mailbox)
+            except (ReconnectException, ArchiveException):
+                raise
             except Exception, e:
                 logging.warning("Error processing mail %s", uid)
                 logging.exception(e)
+                continue
+            finally:
+                self.metrics.message_done(message['size'])
+            # appended mails are journaled and remembered once the server confirmed the APPEND, see
+            # _flush_appends()
+            if state not in (None, journal.APPENDED):
+                if self.journal is not None:
+                    self.journal.record(mailbox, uid, state)
+                if key is not None:
+                    self.seen_mails.setdefault(key, state)
+            if (num + 1) % CHECKPOINT_INTERVAL == 0:
+                self._checkpoint(mailbox)
+
+        self._checkpoint(mailbox)
+        self._reconnecting(mailbox, self._finish_mailbox, mailbox, uidnext, complete)
+
+    def _leave_mailbox(self, mailbox):
+        """Delete the originals of all confirmed APPENDs before leaving mailbox after an error.
+
+        With a journal, the next run deletes them (see _open_mailbox_journal()). Without one nothing would
+        remember them, and both the original and its stripped copy would stay on the server. Errors are
+        logged only, as the error that made us leave the mailbox is on its way up already.
+        """
+        uids = self.pending_removals
+        if self.journal is not None or not uids:
+            return
+        try:
+            logging.info("Deleting %d originals of rewritten mails before leaving mailbox %s", len(uids),
+                         mailbox)
+            self._reconnecting(mailbox, self._flush_removals, mailbox)
+            if self.needs_expunge:
+                with self.metrics.phase('expunge'):
+                    self.imap.expunge()
+        except Exception, e:
+            logging.error("Could not delete the originals of the rewritten mails %s in %s, they are left "
+                          "next to their stripped copies", compress_uid_set(uids), mailbox)
+            logging.exception(e)
+        finally:
+            # they must never be deleted in another mailbox
+            self.pending_removals = []
+
+    def _finish_mailbox(self, mailbox, uidnext, complete=True):
+        """Expunge the deleted originals if needed and close the mailbox, journaled as done if complete."""
+        if self.needs_expunge:
+            with self.metrics.phase('expunge'):
+                self.imap.expunge()
+            if self.journal is not None:
+                self.journal.mark_expunged(mailbox)
+        if self.journal is not None:
+            if complete:
+                self.journal.finish_mailbox(mailbox, uidnext)
+            self.journal.commit()
+        self.imap.close()
 
-        if self.remove:
-            self.imap.expunge()
+    def _select_mailbox(self, mailbox, readonly=False):
+        """Select mailbox and return its UIDVALIDITY and UIDNEXT, None for those the server did not report."""
+        with self.metrics.phase('select'):
+            typ, data = self.imap.select(mailbox, readonly)
+        if typ != 'OK':
+            raise RemoveAttachmentsException("SELECT of %s not OK: %s" % (mailbox, data))
+        return self.imap.response('UIDVALIDITY')[1][0], self.imap.response('UIDNEXT')[1][0]
+
+    def _open_mailbox_journal(self, mailbox):
+        """Look up the selected mailbox in the journal.
+
+        Returns the first UID to search for (None for all) and the set of UIDs that need no further
+        processing.
+        """
+        self.needs_expunge = False
+        self.pending_removals = []
+        self.pending_appends = []
+        self.pending_append_bytes = 0
+        self.dedup_keys = {}
+        if self.journal is None:
+            return None, ()
+        if self.uidvalidity is None:
+            raise RemoveAttachmentsException("Server did not report the UIDVALIDITY of " + mailbox)
+        # planning must not change the journal, e.g. discard it after a change of the UIDVALIDITY
+        last_uidnext = self.journal.open_mailbox(mailbox, self.uidvalidity, readonly=self.plan is not None)
+        first_uid = None
+        if self.since_last_run:
+            first_uid = last_uidnext
+        states = self.journal.states(mailbox)
+        if self.remove and self.plan is None:
+            # an earlier run appended the stripped copies but did not get to delete the originals
+            self.pending_removals = [str(uid) for uid, state in sorted(states.items())
+                                     if state == journal.APPENDED]
+            if self.pending_removals:
+                logging.info("Deleting %d originals of rewritten mails left over by the last run",
+                             len(self.pending_removals))
+        return first_uid, self._journaled_uids(states)
+
+    def _plan_mailbox(self, mailbox):
+        """Estimate what processing mailbox would do, without downloading any message bodies.
+
+        Applies the same search, exclusion, journal and attachment rules as a real run but only fetches the
+        message sizes and BODYSTRUCTUREs. The mailbox is opened read-only.
+        """
+        logging.debug("Planning mailbox %s", mailbox)
+        start = time.time()
+        self.uidvalidity, uidnext = self._select_mailbox(mailbox, readonly=True)
+        entry = {'select_seconds': time.time() - start, 'messages': 0, 'bytes': 0, 'candidates': 0,
+                 'candidate_bytes': 0, 'unknown_structure': 0, 'attachments': 0, 'reclaimable_bytes': 0,
+                 'download_bytes': 0, 'upload_bytes': 0, 'archive_bytes': 0, 'commands': 0, 'duplicates': 0,
+                 'types': {}}
+        first_uid, done = self._open_mailbox_journal(mailbox)
+
+        found = self._lookup_uids(mailbox, first_uid, done)
+        entry['messages'] = len(found)
+        entry['bytes'] = sum(message['size'] or 0 for message in found)
+        duplicates, others = self._split_duplicates(found)
+        entry['duplicates'] = len(duplicates)
+        for message in self._prescan(others):
+            self._plan_message(entry, message)
+            if message.get('key') is not None:
+                self.seen_mails.setdefault(message['key'], None)
+        self.plan[mailbox] = entry
         self.imap.close()
 
-    def _part_is_attachment(self, part):
-        """Determine whether a mail part is an attachment by looking at its headers"""
-        attachment = part.get_param('attachment', missing, 'content-disposition')
-        if attachment is not missing:
-            return True
+    def _plan_message(self, entry, message):
+        """Add the estimate for a single candidate message to the plan entry of its mailbox."""
+        size = message['size'] or 0
+        entry['candidates'] += 1
+        entry['candidate_bytes'] += size
+        if message['parts'] is None:
+            # the real run will have to download the message to find out
+            entry['unknown_structure'] += 1
+            entry['download_bytes'] += size
+            entry['commands'] += 1
+            return
+
+        attachments = []
+        for section, part, part_size in message['parts']:
+            if not self._part_is_attachment(part, message['rules'], part_size):
+                continue
+            # attachments inside an attached message go away with it
+            if [outer for outer, size in attachments if section.startswith(outer + '.')]:
+                continue
+            attachments.append((section, part_size))
+            types = entry['types'].setdefault(part.get_content_type(), {'attachments': 0, 'bytes': 0})
+            types['attachments'] += 1
+            types['bytes'] += part_size
+        reclaimable = sum(part_size for section, part_size in attachments)
+        entry['attachments'] += len(attachments)
+        entry['reclaimable_bytes'] += reclaimable
+        if self.cdb_server:
+            entry['archive_bytes'] += reclaimable
+
+        if self.cdb_server and not self.remove:
+            # header and attachment sections only, see _archive_mail_sections()
+            top_level = sum(part_size for section, part, part_size in message['parts'] if '.' not in section)
+            entry['download_bytes'] += max(size - top_level, 0) + reclaimable
+            entry['commands'] += 1 + len(attachments)
+            return
+        entry['download_bytes'] += size
+        entry['commands'] += 1
+        if self.max_memory and size * MEMORY_FACTOR > self.max_memory:
+            entry['commands'] += size // max(self.max_memory // (2 * MEMORY_FACTOR), 64 * 1024)
+        if self.remove:
+            entry['upload_bytes'] += size - reclaimable + NOTICE_SIZE * len(attachments)
+            # stripped mails are appended in pipelined batches if possible, originals deleted in batches
+            if not self._has_capability('LITERAL+') or entry['candidates'] % APPEND_BATCH_SIZE == 1:
+                entry['commands'] += 1
+            if entry['candidates'] % CHECKPOINT_INTERVAL == 1:
+                entry['commands'] += self._removal_commands()
+
+    def report_plan(self, out=None):
+        """Print the collected plan as a table, or as JSON to the file object out."""
+        total = defaultdict(int)
+        types = {}
+        for entry in self.plan.values():
+            for key, value in entry.items():
+                if key not in ('types', 'select_seconds'):
+                    total[key] += value
+            for mimetype, counts in entry['types'].items():
+                merged = types.setdefault(mimetype, {'attachments': 0, 'bytes': 0})
+                merged['attachments'] += counts['attachments']
+                merged['bytes'] += counts['bytes']
+        # the fastest SELECT is the best guess for a plain round trip
+        rtt = min([entry['select_seconds'] for entry in self.plan.values()] or [0])
+        transfer = total['download_bytes'] + total['upload_bytes'] + total['archive_bytes']
+        seconds = transfer / (self.plan_bandwidth * 1024.0 * 1024.0) + total['commands'] * rtt
+        seconds /= self.workers
+        estimate = {'transfer_bytes': transfer, 'commands': total['commands'], 'round_trip_seconds': rtt,
+                    'bandwidth_mb_per_second': self.plan_bandwidth, 'workers': self.workers,
+                    'seconds': int(seconds)}
+
+        if out is not None:
+            json.dump({'mailboxes': self.plan, 'total': total, 'types': types, 'estimate': estimate}, out,
+                      indent=2, sort_keys=True)
+            return
+
+        print "%-40s %9s %10s %9s %10s %10s" % ('Mailbox', 'Messages', 'Size', 'With att.', 'Att. size',
+                                              'Reclaims')
+        rows = sorted(self.plan.items()) + [('Total', total)]
+        for mailbox, entry in rows:
+            print "%-40s %9d %10s %9d %10s %10s" % (mailbox, entry['messages'], format_size(entry['bytes']),
+                                                  entry['candidates'], format_size(entry['candidate_bytes']),
+                                                  format_size(entry['reclaimable_bytes']))
+        print
+        print "%-40s %9s %10s" % ('MIME type', 'Count', 'Size')
+        for mimetype, counts in sorted(types.items(), key=lambda item: -item[1]['bytes']):
+            print "%-40s %9d %10s" % (mimetype, counts['attachments'], format_size(counts['bytes']))
+        print
+        if total['unknown_structure']:
+            print "%d messages have an unknown structure and were counted as downloads" % \
+                total['unknown_structure']
+        if total['duplicates']:
+            print "%d messages were counted in another mailbox already" % total['duplicates']
+        print "Estimated run: download %s, upload %s, archive %s in %d IMAP commands" % (
+            format_size(total['download_bytes']), format_size(total['upload_bytes']),
+            format_size(total['archive_bytes']), total['commands'])
+        print "About %s at %s MB/s with %d ms round trips and %d workers" % (
+            format_duration(seconds), self.plan_bandwidth, rtt * 1000, self.workers)
+
+    def _journaled_uids(self, states):
+        """Return the set of UIDs that need no further processing according to the journal states."""
+        done = set()
+        for uid, state in states.items():
+            # archived messages still need their attachments removed if removing is enabled
+            if state != journal.ARCHIVED or not self.remove:
+                done.add(uid)
+        return done
+
+    def _checkpoint(self, mailbox):
+        """Write all queued CouchDB documents and stripped mails, then delete the originals and commit the
+        journal.
+
+        The originals may only be deleted once their attachments are safely archived and their stripped
+        copies appended, and the journal may only claim work that has been done. Only the IMAP commands are
+        retried after a session error, a failed CouchDB write aborts the mailbox (see _flush_docs()).
+        """
+        if self.db is not None and self.bulk_size:
+            with self.metrics.phase('upload'):
+                self._flush_docs()
+        with self.metrics.phase('append'):
+            self._reconnecting(mailbox, self._flush_appends, mailbox)
+        with self.metrics.phase('expunge'):
+            self._reconnecting(mailbox, self._flush_removals, mailbox)
+        if self.journal is not None:
+            self.journal.commit()
+
+    def _flush_removals(self, mailbox):
+        """Delete the originals of all rewritten mails with a few commands on compressed UID sets.
+
+        With Gmail, deleting a mail only removes its labels. To delete it properly, it has to be moved into
+        Trash, where Gmail deletes it after 30 days. Servers supporting MOVE do that in one command. With
+        UIDPLUS, only the deleted originals are expunged right away, otherwise the whole mailbox is expunged
+        once it is done.
+        """
+        uids = self.pending_removals
+        self.pending_removals = []
+        if not uids:
+            return
+        uid_set = compress_uid_set(uids)
+        logging.debug("Deleting %d original mails", len(uids))
+        if self.gmail and self._has_capability('MOVE'):
+            commands = [('MOVE', uid_set, "[Gmail]/Trash")]
+        else:
+            commands = []
+            if self.gmail:
+                commands.append(('COPY', uid_set, "[Gmail]/Trash"))
+            commands.append(('STORE', uid_set, '+FLAGS.SILENT', '(\\Deleted)'))
+            if self._has_capability('UIDPLUS'):
+                commands.append(('EXPUNGE', uid_set))
+        try:
+            for command in commands:
+                typ, data = self.imap.uid(*command)
+                if typ != 'OK':
+                    raise RemoveAttachmentsException("UID %s of %d mails not OK: %s" % (command[0], len(uids),
+                                                                                       data))
+        except SESSION_ERRORS:
+            # deleting them again on the next session does no harm
+            self.pending_removals = uids + self.pending_removals
+            raise
+
+        if commands[-1][0] in ('MOVE', 'EXPUNGE'):
+            state = journal.EXPUNGED
+        else:
+            state = journal.REWRITTEN
+            self.needs_expunge = True
+        if self.journal is not None:
+            self.journal.record_many(mailbox, uids, state)
+
+    def _removal_commands(self):
+        """Number of IMAP commands _flush_removals() needs per batch."""
+        if self.gmail and self._has_capability('MOVE'):
+            return 1
+        return 1 + int(self.gmail) + int(self._has_capability('UIDPLUS'))
+
+    def _handle_message(self, mailbox, message):
+        """Archive and/or remove the attachments of a single message.
+
+        Returns the journal state of the message, or None if it could not be processed.
+        """
+        uid = message['uid']
+        if self.db is not None and not self.remove and message['parts'] is not None:
+            # archive-only runs never need the full message
+            return self._archive_mail_sections(mailbox, message)
+
+        if self.max_memory and (message['size'] or 0) * MEMORY_FACTOR > self.max_memory:
+            return self._process_mail_streamed(mailbox, message)
+
+        logging.debug("Retrieve mail with uid %s (%s bytes)", uid, message['size'])
+        with self.metrics.phase('fetch'):
+            typ, msg = self.imap.uid('FETCH', uid, '(BODY.PEEK[])')
+        if typ != "OK":
+            #raise Exception("FETCH not OK")
+            print 'Fetch not OK: %s', uid
+            return None
+        if len(msg) < 1 or len(msg[0]) < 2:
+            #raise Exception("Malformed FETCH response")
+            print 'Malformed FETCH response'
+            return None
+        return self._process_mail(mailbox, uid, message['flags'], message['idate'], msg[0][1],
+                                  message['rules'])
+
+    def _handle_duplicate(self, mailbox, message, state):
+        """Handle a message that was processed in another mailbox of this run before, from its metadata only.
+
+        state is the journal state of the first copy, which is returned for this one as well: its attachments
+        are archived already, or it had none to take. Rewritten first copies are no duplicates in this sense,
+        see _is_duplicate().
+        """
+        logging.debug("Mail with uid %s was processed in another mailbox already", message['uid'])
+        self.stats['duplicate_mails'] += 1
+        self.stats['duplicate_bytes_saved'] += message['size'] or 0
+        return state
+
+    def _part_is_attachment(self, part, rules=None, size=None):
+        """Determine whether a mail part is an attachment to take by looking at its headers.
+
+        rules are the policy rules matching the mail (None without a policy), one of them has to select the
+        attachment. size is the encoded size of the part body, it defaults to the size of a mimestream part.
+        """
+        attachment = part.get_param('attachment', missing, 'content-disposition') is not missing
 
         # hmm, some of my mails have PDFs attached which aren't marked as attachments. so let's add this
         # optional 2nd metric for attachment detection
-        if self.eat_more_attachments \
+        if not attachment and self.eat_more_attachments \
                 and 'Content-Transfer-Encoding' in part \
                 and part['Content-Transfer-Encoding'] == 'base64' \
                 and get_filename_from_part(part) is not None:
-            return True
-
-        return False
-
-    def _process_mail(self, mailbox, uid, flags, idate, msg):
-        """Process the attachments (if any) on an individual mail"""
-        parser = email.parser.Parser()
-        mail = parser.parsestr(msg)
-        found_attachment = False
-        doc_id = None
-
+            attachment = True
+
+        if not attachment or rules is None:
+            return attachment
+        if size is None and hasattr(part, 'body_size'):
+            size = part.body_size()
+        filename = part.get_filename()
+        if isinstance(filename, unicode):
+            filename = filename.encode('utf-8')
+        return policy.Policy.wants(rules, part.get_content_type(), filename, size)
+
+    def _ensure_message_id(self, mail, uid):
+        """Give mails without a Message-ID header a stable fake one derived from their headers."""
         if 'message-id' not in mail:
             mail['message-id'] = "%s@fakeid.hudora.biz" % hashlib.sha1(repr(mail._headers)).hexdigest()
             logging.warning(" mail %s: no Message-ID, using fake-id %s", uid, mail['message-id'])
 
         logging.debug("Message-ID: %s", mail['message-id'])
 
+    def _archive_mail_sections(self, mailbox, message):
+        """Archive the attachments of a mail without downloading the whole message.
+
+        Only the header and the BODYSTRUCTURE sections that _save_mail_to_db() would store are fetched.
+        The sections are fetched and decoded one at a time, so only a single attachment is held in memory.
+        Attachments too large for the max_memory budget are decoded chunk by chunk through disk instead.
+        """
+        uid = message['uid']
+        logging.debug("Retrieve header of mail with uid %s (%s bytes)", uid, message['size'])
+        header = self._fetch_section(uid, 'HEADER')
+        if header is None:
+            return None
+        mail = email.parser.HeaderParser().parsestr(header)
+        self._ensure_message_id(mail, uid)
+        self.stats['archived_sections_bytes'] += len(header)
+
+        sections = [(section, part, size) for section, part, size in message['parts']
+                    if self._part_is_attachment(part, message['rules'], size)]
+        with self.metrics.phase('upload'):
+            self._save_mail_to_db(mailbox, mail, self._fetch_attachment_sections(uid, sections))
+        self.stats['archived_sections_mails'] += 1
+        self.stats['archived_sections_size'] += message['size'] or 0
+        return journal.ARCHIVED
+
+    def _fetch_section(self, uid, section):
+        """Fetch BODY.PEEK[<section>] of a single mail, returns None on failure."""
+        with self.metrics.phase('fetch'):
+            typ, data = self.imap.uid('FETCH', uid, '(BODY.PEEK[%s])' % section)
+        if typ != 'OK':
+            logging.warning("FETCH of section %s not OK: %s", section, uid)
+            return None
+        for num, items in parse_fetch_response(data):
+            if items.get('UID') == uid and 'BODY[%s]' % section in items:
+                return items['BODY[%s]' % section] or ''
+        logging.warning("Malformed FETCH response for section %s of %s", section, uid)
+        return None
+
+    def _fetch_attachment_sections(self, uid, sections):
+        """Generate (part, decoded payload) tuples for the given BODYSTRUCTURE sections of a mail."""
+        for section, part, size in sections:
+            cte = str(part.get('content-transfer-encoding', '')).lower().strip()
+            if self.max_memory and size * MEMORY_FACTOR > self.max_memory and cte not in mimestream.UUENCODE:
+                payload = self._fetch_section_decoded(uid, section, size, cte)
+                try:
+                    yield part, payload
+                finally:
+                    payload.close()
+                continue
+
+            body = self._fetch_section(uid, section)
+            if body is None:
+                continue
+            self.stats['archived_sections_bytes'] += len(body)
+            # the header-only part knows its Content-Transfer-Encoding, so let the email package decode
+            part.set_payload(body)
+            yield part, part.get_payload(decode=True)
+            part.set_payload(None)
+
+    def _fetch_section_decoded(self, uid, section, size, cte):
+        """Fetch a large BODYSTRUCTURE section in chunks and return it decoded as a rewound file object."""
+        logging.debug("Stream section %s of mail with uid %s (%s bytes)", section, uid, size)
+        decoder = mimestream.transfer_decoder(cte)
+        out = tempfile.SpooledTemporaryFile(max_size=self.max_memory // MEMORY_FACTOR)
+        for chunk in self._fetch_chunks(uid, section, size):
+            self.stats['archived_sections_bytes'] += len(chunk)
+            with self.metrics.phase('parse'):
+                if decoder is not None:
+                    chunk = decoder.decode(chunk)
+                out.write(chunk)
+        if decoder is not None:
+            out.write(decoder.flush())
+        out.seek(0)
+        self.stats['streamed_sections'] += 1
+        return out
+
+    def _process_mail(self, mailbox, uid, flags, idate, msg, rules=None):
+        """Process the attachments (if any) on an individual mail, returns its journal state.
+
+        The mail is parsed in place with mimestream, so its string is never copied or re-serialized. rules
+        are the policy rules matching the mail, see _part_is_attachment().
+        """
+        with self.metrics.phase('parse'):
+            mail = mimestream.parse_string(msg)
+        return self._process_parsed(mailbox, uid, flags, idate, mail, rules)
+
+    def _fetch_chunks(self, uid, section, size):
+        """Generate the contents of BODY[<section>] of a mail in chunks of a fraction of max_memory.
+
+        Uses partial fetches (BODY.PEEK[<section>]<offset.length>), so imaplib never holds more than one
+        chunk. size is the expected size of the section if known, it saves the final empty fetch.
+        """
+        chunk_size = max(self.max_memory // (2 * MEMORY_FACTOR), 64 * 1024)
+        offset = 0
+        while True:
+            with self.metrics.phase('fetch'):
+                typ, data = self.imap.uid('FETCH', uid,
+                                          '(BODY.PEEK[%s]<%d.%d>)' % (section, offset, chunk_size))
+            if typ != 'OK':
+                raise RemoveAttachmentsException("Partial FETCH not OK: %s" % uid)
+            chunk = None
+            for num, items in parse_fetch_response(data):
+                if items.get('UID') == uid:
+                    chunk = items.get('BODY[%s]<%d>' % (section, offset)) or ''
+            if chunk is None:
+                raise RemoveAttachmentsException("Malformed partial FETCH response: %s" % uid)
+            yield chunk
+            offset += len(chunk)
+            if len(chunk) < chunk_size or (size and offset >= size):
+                break
+
+    def _fetch_streamed(self, uid, size):
+        """Download a mail in chunks into a mimestream.StreamParser and return the parsed root part.
+
+        Neither imaplib nor the parser ever hold more than a fraction of the max_memory budget.
+        """
+        parser = mimestream.StreamParser(spool_threshold=self.max_memory // MEMORY_FACTOR)
+        for chunk in self._fetch_chunks(uid, '', size):
+            with self.metrics.phase('parse'):
+                parser.feed(chunk)
+        with self.metrics.phase('parse'):
+            return parser.close()
+
+    def _process_mail_streamed(self, mailbox, message):
+        """Process a mail that is too large for the memory budget.
+
+        Works like _process_mail(), but the mail is spooled through disk and only its headers are parsed
+        into memory. Attachments are decoded chunk by chunk into temporary files before being archived.
+        """
+        uid = message['uid']
+        logging.debug("Stream mail with uid %s (%s bytes)", uid, message['size'])
+        mail = self._fetch_streamed(uid, message['size'])
+        self.stats['streamed_mails'] += 1
+        return self._process_parsed(mailbox, uid, message['flags'], message['idate'], mail, message['rules'])
+
+    def _process_parsed(self, mailbox, uid, flags, idate, mail, rules=None):
+        """Archive and/or remove the attachments of a mail parsed by mimestream, returns its journal state."""
+        doc_id = None
+        self._ensure_message_id(mail, uid)
+
         # quick first pass to see if we have an attachment
         for part in mail.walk():
-            if self._part_is_attachment(part):
-                found_attachment = True
+            if self._part_is_attachment(part, rules):
                 break
-
-        if not found_attachment:
-            logging.debug("No attachments --> skip (%d bytes)" % len(str(mail)))
-            return
+        else:
+            logging.debug("No attachments --> skip (%d bytes)" % mail.body_end)
+            return journal.SKIPPED
 
         if self.db is not None:
-            doc_id = self._save_mail_to_db(mailbox, mail)
+            with self.metrics.phase('upload'):
+                doc_id = self._save_mail_to_db(mailbox, mail, self._streamed_attachments(mail, rules))
         if self.remove:
-            self._remove_attachments(mail, doc_id, mailbox, uid, flags, idate)
+            with self.metrics.phase('rewrite'):
+                replaced = self._remove_attachments(mail, doc_id, mailbox, uid, flags, idate, rules)
+            if replaced:
+                return journal.APPENDED
+        if self.db is not None:
+            return journal.ARCHIVED
+        return journal.SKIPPED
 
-    def _remove_attachments(self, mail, doc_id, mailbox, uid, flags, idate):
-        """Remove the attachments from a mail, replacing them with explanatory messages."""
-        logging.debug("Remove attachments")
+    def _streamed_attachments(self, mail, rules=None):
+        """Generate (part, decoded payload file) tuples for the attachment parts of a mimestream mail."""
+        for part in mail.walk():
+            if part.is_multipart() or not self._part_is_attachment(part, rules):
+                continue
+            payload = part.decoded(self.max_memory // MEMORY_FACTOR)
+            try:
+                yield part, payload
+            finally:
+                payload.close()
+
+    def _remove_attachments(self, mail, doc_id, mailbox, uid, flags, idate, rules=None):
+        """Remove the attachments from a mimestream mail, replacing them with explanatory messages.
 
-        if idate is not None:
-            idate = '"' + idate + '"'
+        Everything else is copied byte for byte from the spool, so headers and untouched parts are kept
+        exactly as they are. Returns True if the mail was replaced.
+        """
+        logging.debug("Remove attachments")
+        eol = '\n'
+        if mail.raw_headers().endswith('\r\n'):
+            eol = '\r\n'
+
+        def replace(part):
+            if not self._part_is_attachment(part, rules):
+                return None
+            headers = mimestream.strip_headers(part.raw_headers(), ('Content-Type', 'Content-Disposition',
+                                                                    'Content-Transfer-Encoding'))
+            if not headers.strip():
+                headers = eol
+            return headers + self._attachment_notice(part, doc_id).replace('\n', eol)
+
+        out = tempfile.SpooledTemporaryFile(max_size=self.max_memory // MEMORY_FACTOR)
+        replaced = mimestream.splice(mail, replace, out) > 0
+        if replaced:
+            out.seek(0)
+            self._replace_mail(mailbox, uid, flags, idate, out.read())
+        out.close()
+        return replaced
+
+    def _attachment_notice(self, part, doc_id):
+        """The text replacing a removed attachment."""
+        notice = "An attachment in this email was moved into the attachments database, or removed.\n"
+        notice += "Filename: %s\n" % get_filename_from_part(part)
+        notice += "Content type: %s\n" % part.get_content_type()
+        if doc_id:
+            notice += "Database document ID: %s\n" % doc_id
+            notice += "http://intern.hudora.biz/attachmentarchive/" # %s\n" % (urllib.quote(doc_id))
+        return notice
+
+    def _replace_mail(self, mailbox, uid, flags, idate, text):
+        """Queue the stripped version of a mail for appending in place of the original.
+
+        The stripped mails are appended in batches by a checkpoint once APPEND_BATCH_SIZE or
+        APPEND_BATCH_BYTES is reached (see _checkpoint()), which then deletes the originals.
+        """
+        self.pending_appends.append((uid, flags, idate, imaplib.MapCRLF.sub(imaplib.CRLF, text)))
+        self.pending_append_bytes += len(text)
+
+    def _flush_appends(self, mailbox):
+        """Append all queued stripped mails, keeping their flags and internal dates.
+
+        With LITERAL+ (RFC 2088) the messages are sent as non-synchronizing literals without waiting for the
+        server: with MULTIAPPEND (RFC 3502) in a single APPEND command, otherwise as pipelined APPEND
+        commands. Other servers get one APPEND at a time. The originals of the appended mails are queued for
+        deletion and recorded in the journal, along with the UIDs of the new mails if the server reports
+        them with APPENDUID (UIDPLUS). The journal is committed by _checkpoint(), only after the archive
+        documents have been written. Raises RemoveAttachmentsException if any APPEND failed.
+
+        If the session drops, the mails whose APPEND was not confirmed are queued again. A mail the server
+        stored without getting to confirm it is appended twice then, but no original is deleted without a
+        confirmed copy.
+        """
+        batch = self.pending_appends
+        self.pending_appends = []
+        self.pending_append_bytes = 0
+        if not batch:
+            return
 
-        modified = False
+        logging.debug("Appending %d stripped mails", len(batch))
+        if self._has_capability('LITERAL+') and self._has_capability('MULTIAPPEND'):
+            groups = [batch]
+        else:
+            groups = [[item] for item in batch]
+        results = []
+        dropped = None
+        try:
+            if not self._has_capability('LITERAL+'):
+                for uid, flags, idate, text in batch:
+                    if idate is not None:
+                        idate = '"' + idate + '"'
+                    results.append(self.imap.append(mailbox, append_flags(flags), idate, text))
+            else:
+                tags = [self._send_append(mailbox, group) for group in groups]
+                for tag in tags:
+                    results.append(self.imap._command_complete('APPEND', tag))
+        except SESSION_ERRORS:
+            dropped = sys.exc_info()
+            for group in groups[len(results):]:
+                self.pending_appends.extend(group)
+                self.pending_append_bytes += sum(len(text) for uid, flags, idate, text in group)
+
+        appended = []
+        new_uids = []
+        failed = []
+        for group, (typ, data) in zip(groups, results):
+            if typ != 'OK':
+                failed.append((group, data))
+                continue
+            appended.extend(uid for uid, flags, idate, text in group)
+            uidvalidity, uids = parse_appenduid(data and data[-1])
+            if self.journal is not None and uidvalidity == self.journal.uidvalidity.get(mailbox):
+                new_uids.extend(uids)
+
+        self.pending_removals.extend(appended)
+        self.stats['appended_mails'] += len(appended)
+        for uid in appended:
+            if uid in self.dedup_keys:
+                self.seen_mails.setdefault(self.dedup_keys[uid], journal.APPENDED)
+        if self.journal is not None:
+            self.journal.record_many(mailbox, appended, journal.APPENDED)
+            # the stripped copies need no processing next time
+            self.journal.record_many(mailbox, new_uids, journal.SKIPPED)
+        if dropped is not None:
+            raise dropped[0], dropped[1], dropped[2]
+        if failed:
+            raise RemoveAttachmentsException("APPEND of %d mails not OK: %s" % (
+                sum(len(group) for group, data in failed), failed[0][1]))
+
+    def _send_append(self, mailbox, batch):
+        """Send an APPEND command for all (uid, flags, idate, text) in batch without waiting for a reply.
+
+        The messages are sent as non-synchronizing literals, so this needs LITERAL+ and, for more than one
+        message, MULTIAPPEND. Returns the tag of the command for imaplib's _command_complete().
+        """
+        tag = self.imap._new_tag()
+        data = '%s APPEND %s' % (tag, self.imap._checkquote(mailbox))
+        for uid, flags, idate, text in batch:
+            flags = append_flags(flags)
+            if flags:
+                data += ' ' + flags
+            if idate is not None:
+                data += ' "%s"' % idate
+            self.imap.send('%s {%d+}%s' % (data, len(text), imaplib.CRLF))
+            self.imap.send(text)
+            data = ''
+        self.imap.send(imaplib.CRLF)
+        return tag
+
+    def _mail_attachments(self, mail):
+        """Generate (part, decoded payload) tuples for all parts of a mail that are marked as attachments."""
         for part in mail.walk():
-            if not self._part_is_attachment(part):
+            attachment = part.get_param('attachment', missing, 'content-disposition')
+            if attachment is missing:
                 continue
+            yield part, part.get_payload(decode=True)
 
-            notice = "An attachment in this email was moved into the attachments database, or removed.\n"
-            notice += "Filename: %s\n" % get_filename_from_part(part)
-            notice += "Content type: %s\n" % part.get_content_type()
-            if doc_id:
-                notice += "Database document ID: %s\n" % doc_id
-                notice += "http://intern.hudora.biz/attachmentarchive/" # %s\n" % (urllib.quote(doc_id))
-            part.set_payload(notice)
-            for k, v in part.get_params():
-                part.del_param(k)
-            part.set_type('text/plain')
-            del part['Content-Transfer-Encoding']
-            del part['Content-Disposition']
-            del part['Content-Type']
-            modified = True
-
-        if modified:
-            self.imap.append(mailbox, flags, idate, mail.as_string())
-            if self.gmail:
-                # Deleting a mail from a Gmail IMAP server only deletes its labels. To delete it properly,
-                # we have to move it into Trash. And moving an email in IMAP terms is making a copy,
-                # marking the original as deleted, then expunging. The expunging is done later. Gmail will
-                # then delete the copy of the email with the attachments in 30 days time.
-                self.imap.uid('COPY', uid, "[Gmail]/Trash")
-
-            # unfortunately, with gmail, this STORE command will add a \Seen tag to the mail we just
-            # appended. In theory we could avoid this by putting the following STORE command above the
-            # COPY command, but in practice this actually overrides the COPY behaviour such that the mail
-            # is not moved into the Trash, so we have no option... :(
-            self.imap.uid('STORE', uid, '+FLAGS', '(\\Deleted)')
-
-    def _save_mail_to_db(self, mailbox, mail):
+    def _save_mail_to_db(self, mailbox, mail, attachments=None):
         """Save the attachments from a mail in a CouchDB document.
 
         Detects if the mail is already there (based on mailbox and message ID) - will not create duplicates.
+        The headers are taken from mail. The attachments are taken from attachments, an iterable of
+        (part, decoded payload) tuples, and default to the attachment parts of mail. The iterable is only
+        consumed if the document needs to be written.
+
+        Attachment contents are stored once per content in blob documents or the blob store (see
+        _store_blob()), the mail document references them in its attachment_refs by filename.
+
+        In bulk mode, mails which are not in CouchDB yet are queued for the next _bulk_docs request instead
+        (see _queue_mail_doc()).
         """
         doc_id = mailbox + "@@" + re.sub('[^\x21-\x7E]*', '', mail['message-id'])
+        if attachments is None:
+            attachments = self._mail_attachments(mail)
+        if self.bulk_size and doc_id not in self.existing_docs:
+            return self._queue_mail_doc(mailbox, mail, doc_id, attachments)
+
         doc = {"_attachments": {}}
         if doc_id in self.db:
             if self.db[doc_id]['done'] == True:
@@ -432,45 +1896,297 @@ class RemoveAttachments(object):
                 doc = self.db[doc_id]
         else:
             logging.debug("Add mail to CouchDB")
-        save_hdrs = ('to', 'from', 'date', 'subject', 'in-reply-to', 'references', 'message-id')
-        for hdr in save_hdrs:
-            if hdr in mail:
-                doc[hdr] = mail[hdr]
-        doc['mailbox'] = mailbox
-        doc['_id'] = doc_id
+        self._fill_mail_doc(doc, mailbox, mail, doc_id)
         doc['done'] = False
         new_doc_id = self.db.create(doc)
 
-        for part in mail.walk():
-            attachment = part.get_param('attachment', missing, 'content-disposition')
-            if attachment is missing:
-                continue
-
-            payload = part.get_payload(decode=True)
+        refs = {}
+        for part, payload in attachments:
             if not payload:
                 continue
 
-            filename = get_filename_from_part(part)
-            params = part.get_params()
-            if len(params) > 0 and '/' in params[0][0]:
-                mimetype = params[0][0]
-            else:
-                mimetype = 'application/octet-stream'
-
-            print len(payload)
-            print repr(filename)
-            print repr(mimetype)
-            print new_doc_id
-            self.db.put_attachment(self.db[new_doc_id], payload, filename, mimetype)
+            filename, mimetype = attachment_type(part)
+            blob_id, length = self._store_blob(payload, mimetype)
+            refs[filename] = self._blob_ref(blob_id, mimetype, length)
             logging.debug("Added attachment %s", filename)
 
         # modify document to mark it as complete
         doc = self.db[new_doc_id]
+        doc['attachment_refs'] = refs
         doc['done'] = True
         self.db[new_doc_id] = doc
         logging.debug("Created document %s", new_doc_id)
         return new_doc_id
 
+    def _fill_mail_doc(self, doc, mailbox, mail, doc_id):
+        """Copy the archived headers of mail into the CouchDB document doc."""
+        save_hdrs = ('to', 'from', 'date', 'subject', 'in-reply-to', 'references', 'message-id')
+        for hdr in save_hdrs:
+            if hdr in mail:
+                doc[hdr] = mail[hdr]
+        doc['mailbox'] = mailbox
+        doc['_id'] = doc_id
+
+    def _queue_mail_doc(self, mailbox, mail, doc_id, attachments):
+        """Queue the complete CouchDB document of a mail for the next _bulk_docs request.
+
+        The document is written in its final state with done=True, after the blob documents it references.
+        Returns the document id.
+        """
+        doc = {}
+        self._fill_mail_doc(doc, mailbox, mail, doc_id)
+        refs = {}
+        for part, payload in attachments:
+            if not payload:
+                continue
+            filename, mimetype = attachment_type(part)
+            blob_id, length = self._queue_blob(payload, mimetype)
+            refs[filename] = self._blob_ref(blob_id, mimetype, length)
+        doc['attachment_refs'] = refs
+        doc['done'] = True
+        logging.debug("Queued document %s", doc_id)
+        self._queue_doc(doc, len(repr(doc)))
+        return doc_id
+
+    def _queue_blob(self, payload, mimetype):
+        """Queue a blob document with the payload as inline attachment "content".
+
+        Payloads that are already stored or queued are not queued again. Payloads larger than the bulk
+        size, and all payloads if there is a blob store, are stored directly (see _store_blob()). Returns the
+        blob document id and the payload length.
+        """
+        if self.blob_store is not None:
+            return self._store_blob(payload, mimetype)
+        digest, length = hash_payload(payload)
+        blob_id = BLOB_PREFIX + digest
+        if blob_id in self.known_blobs or blob_id in self.pending_blobs:
+            self.stats['dedup_hits'] += 1
+            self.stats['dedup_bytes_saved'] += length
+            return blob_id, length
+        if length * 4 / 3 > self.bulk_size:
+            return self._store_blob(payload, mimetype)
+
+        if hasattr(payload, 'read'):
+            payload = payload.read()
+        data = base64.b64encode(payload)
+        blob = {'_id': blob_id, 'type': 'blob', 'sha256': digest, 'length': length, 'content_type': mimetype,
+                'done': True, '_attachments': {'content': {'content_type': mimetype, 'data': data}}}
+        self.pending_blobs[blob_id] = length
+        self._queue_doc(blob, len(data))
+        return blob_id, length
+
+    def _queue_doc(self, doc, size):
+        """Add a document of roughly size bytes to the next bulk request, flushing it if it is full."""
+        self.pending_docs.append(doc)
+        self.pending_bytes += size
+        if self.pending_bytes >= self.bulk_size:
+            self._flush_docs()
+
+    def _list_doc_ids(self, mailbox):
+        """Return the set of ids of all mail documents of mailbox in CouchDB, using a single request."""
+        prefix = mailbox + "@@"
+        rows = self.db.view('_all_docs', startkey=prefix, endkey=prefix + DOC_ID_RANGE_END)
+        return set(row.id for row in rows)
+
+    def _flush_docs(self):
+        """Write all queued documents, see _write_docs().
+
+        The queue is only cleared once every document has been written. If writing fails, the queued
+        stripped mails and the originals waiting for deletion are dropped, so no original is ever removed
+        without its archive document, and ArchiveException is raised. The documents stay queued for the
+        next flush.
+        """
+        if not self.pending_docs:
+            return
+        try:
+            self._write_docs(self.pending_docs, self.pending_blobs)
+        except Exception, e:
+            logging.warning("Dropping %d stripped mails to append and %d originals to delete",
+                            len(self.pending_appends), len(self.pending_removals))
+            self.pending_appends = []
+            self.pending_append_bytes = 0
+            self.pending_removals = []
+            raise ArchiveException("Could not write %d archive documents: %s" % (len(self.pending_docs), e))
+        self.pending_docs = []
+        self.pending_blobs = {}
+        self.pending_bytes = 0
+
+    def _write_docs(self, docs, blobs):
+        """Write docs with one _bulk_docs request, blobs maps the ids of the blob documents among them.
+
+        Blob documents which are already complete in CouchDB are dropped first, incomplete ones from
+        aborted runs are overwritten. Conflicts are resolved per document: a conflicting blob is being
+        stored concurrently, it is waited for and taken over if it does not complete (see _wait_for_blob()).
+        A conflicting mail document is overwritten unless it is already complete.
+        """
+        if blobs:
+            stored = {}
+            for row in self.db.view('_all_docs', keys=blobs.keys(), include_docs=True):
+                if row.doc is not None:
+                    stored[row.key] = row.doc
+            pending = []
+            for doc in docs:
+                old = stored.get(doc['_id'])
+                if old is None:
+                    pending.append(doc)
+                elif old.get('done'):
+                    self.known_blobs.add(doc['_id'])
+                    self.stats['dedup_hits'] += 1
+                    self.stats['dedup_bytes_saved'] += doc['length']
+                else:
+                    doc['_rev'] = old['_rev']
+                    pending.append(doc)
+            docs = pending
+
+        retry = []
+        for doc in self._bulk_update(docs):
+            if doc.get('type') == 'blob':
+                old = self._wait_for_blob(doc['_id'])
+                if old is not None and old.get('done'):
+                    logging.debug("Attachment %s was uploaded concurrently", doc['_id'])
+                    self.known_blobs.add(doc['_id'])
+                    self.stats['dedup_hits'] += 1
+                    self.stats['dedup_bytes_saved'] += doc['length']
+                    continue
+                logging.warning("Concurrent upload of attachment %s did not complete, taking it over",
+                                doc['_id'])
+                doc.pop('_rev', None)
+                if old is not None:
+                    doc['_rev'] = old['_rev']
+                retry.append(doc)
+                continue
+            old = self.db.get(doc['_id'])
+            if old is None or old.get('done'):
+                logging.debug("Message %s is already in CouchDB", doc['_id'])
+                continue
+            logging.warning("Incomplete upload of %s detected, overwriting it", doc['_id'])
+            doc['_rev'] = old['_rev']
+            retry.append(doc)
+        for doc in self._bulk_update(retry):
+            raise RemoveAttachmentsException("Conflict writing document %s" % doc['_id'])
+
+    def _bulk_update(self, docs):
+        """Write docs with a single _bulk_docs request and return the documents that hit a conflict.
+
+        Raises RemoveAttachmentsException on any other per-document error.
+        """
+        if not docs:
+            return []
+        logging.debug("Writing %d documents to CouchDB", len(docs))
+        self.stats['bulk_requests'] += 1
+        conflicts = []
+        for doc, (success, doc_id, result) in zip(docs, self.db.update(docs)):
+            if success:
+                self.stats['bulk_docs'] += 1
+                if doc.get('type') == 'blob':
+                    self.known_blobs.add(doc_id)
+                    self.stats['uploaded_bytes'] += doc['length']
+            elif isinstance(result, couchdb.ResourceConflict):
+                conflicts.append(doc)
+            else:
+                raise RemoveAttachmentsException("Could not write document %s: %s" % (doc_id, result))
+        return conflicts
+
+    def _store_blob(self, payload, mimetype):
+        """Store an attachment payload once under its SHA-256 hash.
+
+        The content is the attachment "content" of the document BLOB_PREFIX + hash, or the content stored
+        under the hash in the blob store. The upload is skipped if that content is already complete.
+        Returns the blob document id and the payload length.
+        """
+        digest, length = hash_payload(payload)
+        blob_id = BLOB_PREFIX + digest
+        if self.blob_store is not None:
+            self._store_external_blob(blob_id, digest, payload, length, mimetype)
+            return blob_id, length
+        if blob_id in self.known_blobs:
+            blob = {'done': True}
+        else:
+            blob = self.db.get(blob_id)
+        if blob is not None and blob.get('done'):
+            logging.debug("Attachment %s is already in CouchDB", blob_id)
+            self.known_blobs.add(blob_id)
+            self.stats['dedup_hits'] += 1
+            self.stats['dedup_bytes_saved'] += length
+            return blob_id, length
+
+        if blob is None:
+            try:
+                self.db.create({'_id': blob_id, 'type': 'blob', 'sha256': digest, 'length': length,
+                                'content_type': mimetype, 'done': False})
+                blob = self.db[blob_id]
+            except couchdb.ResourceConflict:
+                # another worker is uploading the same content right now
+                blob = self._wait_for_blob(blob_id)
+                if blob is None:
+                    raise RemoveAttachmentsException("Attachment %s vanished during its upload" % blob_id)
+                if blob.get('done'):
+                    logging.debug("Attachment %s was uploaded concurrently", blob_id)
+                    self.known_blobs.add(blob_id)
+                    self.stats['dedup_hits'] += 1
+                    self.stats['dedup_bytes_saved'] += length
+                    return blob_id, length
+                logging.warning("Concurrent upload of attachment %s did not complete, taking it over",
+                                blob_id)
+
+        logging.debug("Uploading attachment %s (%d bytes)", blob_id, length)
+        try:
+            self.db.put_attachment(blob, payload, 'content', mimetype)
+            blob['done'] = True
+            self.db[blob_id] = blob
+        except couchdb.ResourceConflict:
+            # the upload we took over completed after all, or someone else took it over
+            blob = self._wait_for_blob(blob_id)
+            if blob is None or not blob.get('done'):
+                raise RemoveAttachmentsException("Conflict uploading attachment %s" % blob_id)
+            logging.debug("Attachment %s was uploaded concurrently", blob_id)
+            self.known_blobs.add(blob_id)
+            self.stats['dedup_hits'] += 1
+            self.stats['dedup_bytes_saved'] += length
+            return blob_id, length
+        self.known_blobs.add(blob_id)
+        self.stats['uploaded_bytes'] += length
+        return blob_id, length
+
+    def _wait_for_blob(self, blob_id):
+        """Wait for a concurrent upload of the blob document blob_id to complete.
+
+        Polls the document every BLOB_POLL_INTERVAL seconds and returns it as soon as it is done. Returns it
+        in its last state when BLOB_WAIT_SECONDS have passed, or None if it does not exist.
+        """
+        deadline = time.time() + BLOB_WAIT_SECONDS
+        while True:
+            blob = self.db.get(blob_id)
+            if blob is None or blob.get('done') or time.time() >= deadline:
+                return blob
+            logging.debug("Waiting for the concurrent upload of attachment %s", blob_id)
+            time.sleep(BLOB_POLL_INTERVAL)
+
+    def _store_external_blob(self, blob_id, digest, payload, length, mimetype):
+        """Store an attachment payload in the blob store unless it is there already."""
+        if blob_id in self.known_blobs or self.blob_store.exists(digest):
+            logging.debug("Attachment %s is already in the blob store", blob_id)
+            self.known_blobs.add(blob_id)
+            self.stats['dedup_hits'] += 1
+            self.stats['dedup_bytes_saved'] += length
+            return
+
+        logging.debug("Uploading attachment %s (%d bytes) to %s", blob_id, length, self.blob_store.url)
+        try:
+            self.blob_store.put(digest, payload, length, mimetype)
+        except blobstore.BlobStoreException, e:
+            raise RemoveAttachmentsException(str(e))
+        self.known_blobs.add(blob_id)
+        self.stats['uploaded_bytes'] += length
+
+    def _blob_ref(self, blob_id, mimetype, length):
+        """Return the attachment_refs entry of a stored attachment content."""
+        ref = {'blob': blob_id, 'content_type': mimetype, 'length': length}
+        if self.blob_store is not None:
+            ref['store'] = self.blob_store.url
+            ref['key'] = self.blob_store.key(blob_id[len(BLOB_PREFIX):])
+        return ref
+
 
 def die(msg):
     """Abort with an error message."""
@@ -497,8 +2213,8 @@ def parse_date(datestr):
         die("Date parsing error. Use format YYYY-MM-DD")
 
 
-def main():
-    """Parse command-line arguments and invoke the RemoveAttachments program class."""
+def make_parser():
+    """Return the OptionParser for the command-line arguments of RemoveAttachments."""
     parser = OptionParser()
     parser.add_option("-s", "--server", help="IMAP4 server")
     parser.add_option("--port", help="IMAP4 server port")
@@ -515,13 +2231,56 @@ def main():
     parser.add_option("-r", "--remove", help="Remove attachments after processing", action="store_true")
     parser.add_option("--eat-more-attachments", help="Use looser criteria for detecting attachments",
                       action="store_true")
+    parser.add_option("--policy", help="JSON file with rules selecting the mails and attachments to take, "
+                      "see policy.py (default: all attachments)")
     parser.add_option("--gmail", help="Enable Gmail quirks mode (see README) (default off)",
                       action="store_true")
+    parser.add_option("--max-memory", default=256,
+                      help="Stream mails through disk if parsing them would need more than this, in MB "
+                      "(0 to disable) [%default]")
+    parser.add_option("--blob-store", help="Store attachment contents at this URL instead of in CouchDB: "
+                      "file:///path, s3://bucket/prefix or s3+http://host:port/bucket/prefix (default: none)")
+    parser.add_option("--couchdb-bulk-size", default=0,
+                      help="Write CouchDB documents in _bulk_docs batches of up to this size, in MB "
+                      "(0 to disable) [%default]")
+    parser.add_option("--workers", default=1,
+                      help="Number of IMAP sessions processing mailboxes concurrently [%default]")
+    parser.add_option("--journal", help="SQLite file remembering processed mails, which are skipped in "
+                      "later runs (default: none)")
+    parser.add_option("--since-last-run", help="Only check mails that arrived since the last run (needs "
+                      "--journal)", action="store_true")
+    parser.add_option("--plan", help="Only estimate how much space a run would reclaim and how long it would "
+                      "take, without downloading any mails", action="store_true")
+    parser.add_option("--plan-json", help="Write the --plan estimate as JSON to this file ('-' for stdout)")
+    parser.add_option("--plan-bandwidth", default=1,
+                      help="IMAP transfer rate assumed by --plan, in MB/s [%default]")
+    instrument.add_options(parser)
+    throttle.add_options(parser)
     parser.add_option("-v", "--verbose", help="Log debug messages", action="store_true")
-    options = parser.parse_args()[0]
+    return parser
 
-    if options.verbose:
-        logging.getLogger().setLevel(logging.DEBUG)
+
+def settings_from_options(options):
+    """Check the parsed command-line arguments and return them as keyword arguments for RemoveAttachments.
+
+    Aborts if an argument is invalid.
+    """
+    try:
+        workers = int(options.workers)
+    except ValueError:
+        die("--workers requires integer argument")
+    try:
+        max_memory = int(options.max_memory)
+    except ValueError:
+        die("--max-memory requires integer argument")
+    try:
+        bulk_size = int(options.couchdb_bulk_size)
+    except ValueError:
+        die("--couchdb-bulk-size requires integer argument")
+    try:
+        plan_bandwidth = float(options.plan_bandwidth)
+    except ValueError:
+        die("--plan-bandwidth requires numeric argument")
 
     if options.before_date is not None:
         before_date = parse_date(options.before_date)
@@ -547,13 +2306,53 @@ def main():
         else:
             port = 143
 
+    attachment_policy = None
+    if options.policy is not None:
+        try:
+            attachment_policy = policy.load_policy(options.policy)
+        except policy.PolicyException, e:
+            die(str(e))
+
+    return dict(server=options.server, port=port, ssl=options.ssl, username=options.username,
+                password=options.password, only_mailbox=options.only_mailbox,
+                cdb_server=options.couchdb_server, cdb_db=options.couchdb_db, remove=options.remove,
+                eat_more_attachments=options.eat_more_attachments, gmail=options.gmail, min_size=min_size,
+                before_date=before_date, workers=workers, max_memory=max_memory, bulk_size=bulk_size,
+                journal_path=options.journal, since_last_run=options.since_last_run,
+                plan=options.plan or options.plan_json is not None, plan_bandwidth=plan_bandwidth,
+                blob_store=options.blob_store, policy=attachment_policy)
+
+
+def main():
+    """Parse command-line arguments and invoke the RemoveAttachments program class."""
+    options = make_parser().parse_args()[0]
+    settings = settings_from_options(options)
+    if settings['workers'] > 1:
+        logging.basicConfig(format="%(asctime)s %(threadName)s %(levelname)s %(message)s")
+
+    if options.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    metrics = instrument.from_options('removeattachments', options)
+    governor = throttle.from_options(options, settings['workers'])
+    program = None
     try:
-        RemoveAttachments(options.server, port, options.ssl, options.username, options.password,
-                          options.only_mailbox, options.couchdb_server, options.couchdb_db, options.remove,
-                          options.eat_more_attachments, options.gmail, min_size, before_date).run()
+        program = RemoveAttachments(metrics=metrics, governor=governor, **settings)
+        program.run()
+        if options.plan_json == '-':
+            program.report_plan(sys.stdout)
+        elif options.plan_json is not None:
+            plan_out = open(options.plan_json, 'w')
+            program.report_plan(plan_out)
+            plan_out.close()
+        elif settings['plan']:
+            program.report_plan()
     except RemoveAttachmentsException, e:
         logging.error(e)
         sys.exit(1)
+    finally:
+        # also after failures, the metrics tell how far the run got
+        instrument.write_outputs(metrics, options, getattr(program, 'stats', None))
 
 
 def doctests():
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright HUDORA GmbH 2009
+
+"""Benchmark the mail tools end to end against a synthetic mailbox.
+
+Generates a mailbox (see mailgen), serves it with the in-process fake IMAP server (see fakeimap) and runs
+each benchmark scenario as a separate process against it, on a fresh copy of the mailbox. Reports
+messages/s and MB/s over the mailbox, IMAP round trips, bytes transferred and the peak RSS of the tool.
+
+Results can be saved as JSON baseline (--save) and compared against one (--compare), which exits with
+status 1 if any scenario got worse by more than --tolerance percent.
+
+    python benchmark/bench.py --messages 200 --latency 5 --save baseline.json
+    python benchmark/bench.py --messages 200 --latency 5 --compare baseline.json
+"""
+
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from optparse import OptionParser
+
+import fakeimap
+import mailgen
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name -> (script relative to ROOT, arguments); {port} and {dir} are replaced with the server port and a
+# scratch directory
+SCENARIOS = [
+    ('removeattachments', ('RemoveAttachments.py', '-s 127.0.0.1 --port {port} -u bench -p bench '
+                           '--min-size 0 --remove')),
+    ('removeattachments-streamed', ('RemoveAttachments.py', '-s 127.0.0.1 --port {port} -u bench -p bench '
+                                    '--min-size 0 --remove --max-memory 1')),
+    ('imap2html', ('imap2html/imap2html.py', '--server 127.0.0.1 --port {port} --user bench --password bench '
+                   '--outputdir {dir}')),
+    ('departicularifier', ('departicularifier.py', '--server 127.0.0.1 --port {port} --no-ssl --user bench '
+                           '--password bench --sender scanner@ --dir {dir}')),
+]
+
+# Runs a command and writes its peak RSS to a file. ru_maxrss survives exec(), so a process forked from the
+# benchmark itself would report the size of the generated mailbox.
+LAUNCHER = """
+import os, sys
+pid = os.fork()
+if pid == 0:
+    os.execv(sys.argv[2], sys.argv[2:])
+pid, status, usage = os.wait4(pid, 0)
+open(sys.argv[1], 'w').write(str(usage.ru_maxrss))
+sys.exit(os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1)
+"""
+
+# metric -> (format, whether larger values are better)
+METRICS = [
+    ('seconds', '%.2f', False),
+    ('messages_per_second', '%.1f', True),
+    ('mb_per_second', '%.2f', True),
+    ('round_trips', '%d', False),
+    ('mb_transferred', '%.1f', False),
+    ('peak_rss_mb', '%.1f', False),
+]
+
+
+def load_store(mails, latency):
+    """Return a fresh MailStore with the mails in its INBOX."""
+    store = fakeimap.MailStore(latency=latency)
+    inbox = store.mailbox('INBOX')
+    for raw in mails:
+        inbox.add(raw)
+    return store
+
+
+def run_scenario(script, arguments, mails, latency):
+    """Run a tool against a fresh copy of the mailbox and return its metrics, None if it failed."""
+    store = load_store(mails, latency)
+    mailbox_bytes = sum(len(message.raw) for message in store.mailbox('INBOX').messages)
+    server = fakeimap.FakeIMAPServer(store)
+    scratch = tempfile.mkdtemp(prefix='bench')
+    rss_file = os.path.join(scratch, 'peak-rss')
+    log = tempfile.TemporaryFile()
+    command = [sys.executable, '-c', LAUNCHER, rss_file, sys.executable, os.path.join(ROOT, script)]
+    command += [arg.format(port=server.port, dir=scratch) for arg in arguments.split()]
+    try:
+        start = time.time()
+        status = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT, cwd=scratch)
+        seconds = time.time() - start
+        peak_rss = int(open(rss_file).read())
+    finally:
+        server.stop()
+        shutil.rmtree(scratch)
+
+    if status != 0:
+        log.seek(0)
+        sys.stderr.write('%s failed with status %d:\n%s\n' % (script, status, log.read()[-2000:]))
+        return None
+    transferred = store.stats['bytes_sent'] + store.stats['bytes_received']
+    return {
+        'seconds': seconds,
+        'messages_per_second': len(mails) / seconds,
+        'mb_per_second': mailbox_bytes / seconds / 1024 / 1024,
+        'round_trips': store.stats['commands'],
+        'mb_transferred': transferred / 1024.0 / 1024,
+        # ru_maxrss is in kB on Linux, but in bytes on Mac OS X
+        'peak_rss_mb': peak_rss / (sys.platform == 'darwin' and 1024.0 * 1024 or 1024.0),
+    }
+
+
+def print_results(results):
+    print '%-28s' % 'scenario' + ''.join('%20s' % name for name, fmt, better in METRICS)
+    for name, metrics in results:
+        if metrics is None:
+            print '%-28s failed' % name
+            continue
+        print '%-28s' % name + ''.join('%20s' % (fmt % metrics[metric]) for metric, fmt, better in METRICS)
+
+
+def compare(results, baseline, tolerance):
+    """Print the changes against the baseline results and return the number of regressions."""
+    old = dict(baseline['results'])
+    if baseline['profile'] != results['profile'] or baseline['latency'] != results['latency']:
+        print 'warning: the baseline was recorded with a different mailbox profile or latency'
+    regressions = 0
+    print '%-28s%-20s%14s%14s%10s' % ('scenario', 'metric', 'baseline', 'current', 'change')
+    for name, metrics in results['results']:
+        if metrics is None or old.get(name) is None:
+            continue
+        for metric, fmt, better in METRICS:
+            before, after = old[name][metric], metrics[metric]
+            change = before and (after - before) * 100.0 / before or 0
+            worse = (change < -tolerance) if better else (change > tolerance)
+            regressions += worse
+            print '%-28s%-20s%14s%14s%+9.1f%%%s' % (name, metric, fmt % before, fmt % after, change,
+                                                   worse and '  REGRESSION' or '')
+    return regressions
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [scenario ...]')
+    parser.description = 'Scenarios: ' + ', '.join(name for name, command in SCENARIOS)
+    parser.add_option('--messages', type='int', default=mailgen.DEFAULT_PROFILE['messages'],
+                      help='number of regular mails in the mailbox [%default]')
+    parser.add_option('--median-size', type='int', default=mailgen.DEFAULT_PROFILE['median_size'],
+                      help='median mail size, in kB [%default]')
+    parser.add_option('--max-size', type='int', default=mailgen.DEFAULT_PROFILE['max_size'],
+                      help='maximum mail size, in kB [%default]')
+    parser.add_option('--attachment-ratio', type='float', default=mailgen.DEFAULT_PROFILE['attachment_ratio'],
+                      help='share of mails with attachments [%default]')
+    parser.add_option('--partial-sets', type='int', default=mailgen.DEFAULT_PROFILE['partial_sets'],
+                      help='number of documents split into message/partial mails [%default]')
+    parser.add_option('--seed', type='int', default=mailgen.DEFAULT_PROFILE['seed'],
+                      help='random seed of the mailbox generator [%default]')
+    parser.add_option('--latency', type='float', default=0,
+                      help='latency added to every IMAP command, in ms [%default]')
+    parser.add_option('--save', help='save the results as JSON baseline to this file')
+    parser.add_option('--compare', help='compare the results against this JSON baseline')
+    parser.add_option('--tolerance', type='float', default=10,
+                      help='change in percent reported as regression by --compare [%default]')
+    options, args = parser.parse_args()
+
+    scenarios = [(name, command) for name, command in SCENARIOS if not args or name in args]
+    if not scenarios:
+        parser.error('unknown scenario, use one of: ' + ', '.join(name for name, command in SCENARIOS))
+
+    profile = dict(mailgen.DEFAULT_PROFILE, messages=options.messages, median_size=options.median_size,
+                   max_size=options.max_size, attachment_ratio=options.attachment_ratio,
+                   partial_sets=options.partial_sets, seed=options.seed)
+    mails = mailgen.generate(profile)
+    size = sum(len(mail) for mail in mails) / 1024.0 / 1024
+    print 'Mailbox: %d mails, %.1f MB, latency %g ms' % (len(mails), size, options.latency)
+    results = []
+    for name, (script, arguments) in scenarios:
+        results.append((name, run_scenario(script, arguments, mails, options.latency / 1000.0)))
+    print_results(results)
+
+    report = {'profile': profile, 'latency': options.latency, 'results': results,
+              'date': datetime.now().isoformat(), 'python': platform.python_version(),
+              'platform': platform.platform()}
+    # make the report look like a loaded baseline, with lists instead of tuples
+    report = json.loads(json.dumps(report))
+    if options.save:
+        out = open(options.save, 'w')
+        json.dump(report, out, indent=2, sort_keys=True)
+        out.close()
+    if options.compare:
+        baseline = json.load(open(options.compare))
+        if compare(report, baseline, options.tolerance):
+            sys.exit(1)
+    if None in [metrics for name, metrics in results]:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
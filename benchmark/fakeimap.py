@@ -0,0 +1,596 @@
+# -*- coding: utf-8 -*-
+# Copyright HUDORA GmbH 2009
+
+"""In-process fake IMAP4rev1 server for benchmarks.
+
+FakeIMAPServer serves the mailboxes of a MailStore from a thread of the calling process. It implements the
+subset of IMAP4rev1, UIDPLUS, LITERAL+, MULTIAPPEND and MOVE that the mail tools use, accepts any login and
+can add a fixed latency to every command to simulate a remote server. The store counts the commands (each
+one is a round trip unless pipelined) and the bytes transferred in each direction.
+
+>>> import imaplib
+>>> store = MailStore()
+>>> store.mailbox('INBOX').add('Subject: hi\\n\\nhello\\n')
+1
+>>> server = FakeIMAPServer(store)
+>>> imap = imaplib.IMAP4('127.0.0.1', server.port)
+>>> imap.login('user', 'password')[0], imap.select()
+('OK', ('OK', ['1']))
+>>> imap.uid('FETCH', '1', '(RFC822.SIZE BODY.PEEK[TEXT])')[1]
+[('1 (UID 1 RFC822.SIZE 22 BODY[TEXT] {7}', 'hello\\r\\n'), ')']
+>>> imap.logout()[0]
+'BYE'
+>>> server.stop()
+>>> store.stats['commands']
+5
+"""
+
+import email
+import email.utils
+import re
+import socket
+import SocketServer
+import threading
+import time
+from collections import defaultdict
+
+CAPABILITIES = ['IMAP4rev1', 'UIDPLUS', 'LITERAL+', 'MULTIAPPEND', 'MOVE']
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+
+def crlf(data):
+    """Convert the line endings of data to CRLF.
+
+    >>> crlf('a\\nb\\r\\n')
+    'a\\r\\nb\\r\\n'
+    """
+    return re.sub(r'\r?\n', '\r\n', data)
+
+
+def astring(value):
+    """Format value as IMAP quoted string, literal or NIL.
+
+    >>> astring(None), astring('a "b"'), astring('a\\nb')
+    ('NIL', '"a \\\\"b\\\\""', '{3}\\r\\na\\nb')
+    """
+    if value is None:
+        return 'NIL'
+    if '\r' in value or '\n' in value or len(value) > 1000:
+        return '{%d}\r\n%s' % (len(value), value)
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def param_list(params):
+    """Format the parameters returned by email.message.Message.get_params() as parenthesized list.
+
+    >>> param_list([('name', 'a.pdf'), ('filename', ('utf-8', '', 'caf\\xc3\\xa9.pdf'))])
+    '("name" "a.pdf" "filename*" "utf-8\\'\\'caf%C3%A9.pdf")'
+    """
+    if not params:
+        return 'NIL'
+    items = []
+    for key, value in params:
+        if isinstance(value, tuple):
+            # RFC 2231 encoded parameter, pass it on encoded like servers do
+            charset, language, value = value
+            key += '*'
+            value = email.utils.encode_rfc2231(value, charset, language)
+        items.append('%s %s' % (astring(key), astring(value)))
+    return '(%s)' % ' '.join(items)
+
+
+def disposition(part):
+    value = part.get('content-disposition')
+    if not value:
+        return 'NIL'
+    return '(%s %s)' % (astring(value.split(';')[0].strip()),
+                        param_list(part.get_params(header='content-disposition')[1:]))
+
+
+def bodystructure(part):
+    """Return the BODYSTRUCTURE of an email.message.Message parsed from a mail with CRLF line endings."""
+    params = part.get_params()
+    params = params and params[1:] or []
+    if part.is_multipart() and part.get_content_maintype() == 'multipart':
+        children = ''.join(bodystructure(child) for child in part.get_payload())
+        return '(%s %s %s %s NIL NIL)' % (children, astring(part.get_content_subtype()), param_list(params),
+                                          disposition(part))
+
+    encoding = part.get('content-transfer-encoding', '7bit').strip()
+    fields = '%s %s %s %s NIL %s' % (astring(part.get_content_maintype()),
+                                     astring(part.get_content_subtype()), param_list(params),
+                                     astring(part.get('content-id')), astring(encoding))
+    if part.get_content_type() == 'message/rfc822':
+        inner = part.get_payload()[0]
+        raw = inner.as_string()
+        return '(%s %d (NIL NIL NIL NIL NIL NIL NIL NIL NIL NIL) %s %d NIL %s NIL NIL)' % (
+            fields, len(raw), bodystructure(inner), raw.count('\r\n'), disposition(part))
+    body = part.get_payload()
+    if part.get_content_maintype() == 'text':
+        fields += ' %d %d' % (len(body), body.count('\r\n'))
+    else:
+        fields += ' %d' % len(body)
+    return '(%s NIL %s NIL NIL)' % (fields, disposition(part))
+
+
+def parse_sequence(sequence, largest):
+    """Return the set of numbers of an IMAP sequence set, * standing for largest.
+
+    >>> sorted(parse_sequence('1:3,7,9:*', 10))
+    [1, 2, 3, 7, 9, 10]
+    """
+    numbers = set()
+    for item in sequence.split(','):
+        ends = [largest if end == '*' else int(end) for end in item.split(':')]
+        numbers.update(range(min(ends), max(ends) + 1))
+    return numbers
+
+
+def parse_date(value):
+    """Return the timestamp of an IMAP date like 14-Nov-2009."""
+    day, month, year = value.split('-')
+    return time.mktime((int(year), MONTHS.index(month.capitalize()) + 1, int(day), 0, 0, 0, 0, 0, -1))
+
+
+def format_internaldate(timestamp):
+    return time.strftime('%d-%b-%Y %H:%M:%S +0000', time.gmtime(timestamp))
+
+
+def tokenize(line, literals):
+    """Split a command line into nested lists of atoms and strings.
+
+    Literals have been replaced by NUL bytes in line and are taken from literals. Brackets keep their
+    contents together, so BODY.PEEK[HEADER.FIELDS (FROM)] is a single atom.
+
+    >>> tokenize('A1 UID FETCH 1:* (FLAGS BODY.PEEK[HEADER.FIELDS (FROM TO)]) "x y" \\x00', ['lit'])
+    ['A1', 'UID', 'FETCH', '1:*', ['FLAGS', 'BODY.PEEK[HEADER.FIELDS (FROM TO)]'], 'x y', 'lit']
+    """
+    tokens = []
+    stack = [tokens]
+    pos = 0
+    while pos < len(line):
+        char = line[pos]
+        if char == ' ':
+            pos += 1
+        elif char == '(':
+            stack.append([])
+            stack[-2].append(stack[-1])
+            pos += 1
+        elif char == ')':
+            stack.pop()
+            pos += 1
+        elif char == '"':
+            end = pos + 1
+            value = ''
+            while line[end] != '"':
+                if line[end] == '\\':
+                    end += 1
+                value += line[end]
+                end += 1
+            stack[-1].append(value)
+            pos = end + 1
+        elif char == '\x00':
+            stack[-1].append(literals.pop(0))
+            pos += 1
+        else:
+            end = pos
+            depth = 0
+            while end < len(line) and (depth or line[end] not in ' ()'):
+                depth += {'[': 1, ']': -1}.get(line[end], 0)
+                end += 1
+            stack[-1].append(line[pos:end])
+            pos = end
+    return tokens
+
+
+class Message(object):
+    """A stored mail with CRLF line endings."""
+
+    def __init__(self, uid, raw, flags=(), internaldate=None, gm_msgid=None):
+        self.uid = uid
+        self.raw = crlf(raw)
+        self.flags = list(flags)
+        self.internaldate = internaldate or time.time()
+        self.gm_msgid = gm_msgid
+        self._parsed = None
+        self._bodystructure = None
+
+    def parsed(self):
+        if self._parsed is None:
+            self._parsed = email.message_from_string(self.raw)
+        return self._parsed
+
+    def bodystructure(self):
+        if self._bodystructure is None:
+            self._bodystructure = bodystructure(self.parsed())
+        return self._bodystructure
+
+    def section(self, spec):
+        """Return the contents of BODY[spec]."""
+        if spec == '':
+            return self.raw
+        header_end = self.raw.find('\r\n\r\n') + 4
+        if spec == 'HEADER' or spec.startswith('HEADER.FIELDS'):
+            return self.raw[:header_end]
+        if spec == 'TEXT':
+            return self.raw[header_end:]
+
+        numbers = spec.split('.')
+        suffix = None
+        if numbers[-1] in ('HEADER', 'MIME', 'TEXT'):
+            suffix = numbers.pop()
+        part = self.parsed()
+        for number in numbers:
+            if part.get_content_type() == 'message/rfc822':
+                part = part.get_payload()[0]
+            if part.is_multipart():
+                part = part.get_payload()[int(number) - 1]
+        if suffix == 'MIME':
+            raw = part.as_string()
+            return raw[:raw.find('\r\n\r\n') + 4]
+        if part.get_content_type() == 'message/rfc822':
+            part = part.get_payload()[0]
+            raw = part.as_string()
+            if suffix == 'HEADER':
+                return raw[:raw.find('\r\n\r\n') + 4]
+            return raw
+        if part.is_multipart():
+            raw = part.as_string()
+            return raw[raw.find('\r\n\r\n') + 4:]
+        return part.get_payload()
+
+
+class Mailbox(object):
+    """A mailbox, the messages are sorted by UID."""
+
+    def __init__(self, name, uidvalidity=1):
+        self.name = name
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.messages = []
+
+    def add(self, raw, flags=(), internaldate=None, gm_msgid=None):
+        """Add a mail and return its UID."""
+        message = Message(self.uidnext, raw, flags, internaldate, gm_msgid)
+        self.uidnext += 1
+        self.messages.append(message)
+        return message.uid
+
+
+class MailStore(object):
+    """The mailboxes of a fake account, shared by all sessions of a FakeIMAPServer.
+
+    latency is added to every command, in seconds. stats counts the commands, the commands by name and
+    the bytes received and sent.
+    """
+
+    def __init__(self, capabilities=CAPABILITIES, latency=0):
+        self.mailboxes = {}
+        self.capabilities = list(capabilities)
+        self.latency = latency
+        self.stats = defaultdict(int)
+        self.lock = threading.RLock()
+
+    def mailbox(self, name, create=True):
+        """Return the mailbox name, creating it if create is set. Returns None if it doesn't exist."""
+        if name.upper() == 'INBOX':
+            name = 'INBOX'
+        if name not in self.mailboxes and create:
+            self.mailboxes[name] = Mailbox(name)
+        return self.mailboxes.get(name)
+
+
+class IMAPHandler(SocketServer.StreamRequestHandler):
+    """An IMAP session. Commands are methods named do_<COMMAND> taking the arguments and the UID flag.
+
+    The response to a command is sent with a single write, pipelined commands are answered one after the
+    other.
+    """
+
+    wbufsize = -1
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def send(self, data):
+        self.server.store.stats['bytes_sent'] += len(data)
+        self.wfile.write(data)
+
+    def read_command(self):
+        """Read a command line with all its literals. Returns None at the end of the connection."""
+        line = self.rfile.readline()
+        if not line:
+            return None
+        literals = []
+        command = ''
+        while True:
+            line = line.rstrip('\r\n')
+            match = re.search(r'\{(\d+)(\+?)\}$', line)
+            if match is None:
+                command += line
+                break
+            command += line[:match.start()] + '\x00'
+            if not match.group(2):
+                self.send('+ Ready for literal data\r\n')
+                self.wfile.flush()
+            literals.append(self.rfile.read(int(match.group(1))))
+            self.server.store.stats['bytes_received'] += len(literals[-1])
+            line = self.rfile.readline()
+        self.server.store.stats['bytes_received'] += len(command)
+        return tokenize(command, literals)
+
+    def handle(self):
+        store = self.server.store
+        self.selected = None
+        self.send('* OK Fake IMAP4rev1 server ready\r\n')
+        self.wfile.flush()
+        while True:
+            tokens = self.read_command()
+            if tokens is None:
+                return
+            tag, command, args = tokens[0], tokens[1].upper(), tokens[2:]
+            uid = command == 'UID'
+            if uid:
+                command, args = args[0].upper(), args[1:]
+            store.stats['commands'] += 1
+            store.stats['command_' + command] += 1
+            if store.latency:
+                time.sleep(store.latency)
+            handler = getattr(self, 'do_' + command, None)
+            if handler is None:
+                self.send('%s BAD Unknown command %s\r\n' % (tag, command))
+                self.wfile.flush()
+                continue
+            try:
+                store.lock.acquire()
+                try:
+                    result = handler(args, uid)
+                finally:
+                    store.lock.release()
+            except Exception, e:
+                self.send('%s BAD %s\r\n' % (tag, e))
+            else:
+                if result == 'BYE':
+                    self.send('* BYE Logging out\r\n%s OK LOGOUT completed\r\n' % tag)
+                    return
+                self.send('%s %s\r\n' % (tag, result or 'OK %s completed' % command))
+            self.wfile.flush()
+
+    def do_CAPABILITY(self, args, uid):
+        self.send('* CAPABILITY %s\r\n' % ' '.join(self.server.store.capabilities))
+
+    def do_LOGIN(self, args, uid):
+        return 'OK [CAPABILITY %s] Logged in' % ' '.join(self.server.store.capabilities)
+
+    def do_LOGOUT(self, args, uid):
+        return 'BYE'
+
+    def do_NOOP(self, args, uid):
+        pass
+
+    def do_LIST(self, args, uid):
+        for name in sorted(self.server.store.mailboxes):
+            self.send('* LIST (\\HasNoChildren) "/" %s\r\n' % astring(name))
+
+    def do_SELECT(self, args, uid, readonly=False):
+        mailbox = self.server.store.mailbox(args[0], create=False)
+        if mailbox is None:
+            return 'NO No such mailbox'
+        self.selected = mailbox
+        self.send('* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)\r\n* %d EXISTS\r\n* 0 RECENT\r\n'
+                  '* OK [UIDVALIDITY %d] UIDs valid\r\n* OK [UIDNEXT %d] Predicted next UID\r\n'
+                  % (len(mailbox.messages), mailbox.uidvalidity, mailbox.uidnext))
+        return 'OK [%s] SELECT completed' % (readonly and 'READ-ONLY' or 'READ-WRITE')
+
+    def do_EXAMINE(self, args, uid):
+        return self.do_SELECT(args, uid, True)
+
+    def do_STATUS(self, args, uid):
+        mailbox = self.server.store.mailbox(args[0], create=False)
+        if mailbox is None:
+            return 'NO No such mailbox'
+        self.send('* STATUS %s (MESSAGES %d UIDNEXT %d UIDVALIDITY %d)\r\n'
+                  % (astring(mailbox.name), len(mailbox.messages), mailbox.uidnext, mailbox.uidvalidity))
+
+    def do_CREATE(self, args, uid):
+        self.server.store.mailbox(args[0])
+
+    def do_CLOSE(self, args, uid):
+        self._expunge(None, untagged=False)
+        self.selected = None
+
+    def _targets(self, sequence, uid):
+        """Return the (sequence number, message) tuples of a sequence set or UID set."""
+        messages = self.selected.messages
+        if uid:
+            wanted = parse_sequence(sequence, messages and messages[-1].uid or 0)
+            return [(num, message) for num, message in enumerate(messages, 1) if message.uid in wanted]
+        wanted = parse_sequence(sequence, len(messages))
+        return [(num, message) for num, message in enumerate(messages, 1) if num in wanted]
+
+    def _matches(self, message, criteria):
+        """Whether message matches the (AND-ed) list of SEARCH criteria."""
+        criteria = list(criteria)
+        while criteria:
+            key = criteria.pop(0)
+            if isinstance(key, list):
+                if not self._matches(message, key):
+                    return False
+                continue
+            key = key.upper()
+            if key == 'ALL':
+                continue
+            if key.replace('UN', '', 1) in ('ANSWERED', 'DELETED', 'DRAFT', 'FLAGGED', 'SEEN'):
+                flag = '\\' + key.replace('UN', '', 1).capitalize()
+                if (flag in message.flags) == key.startswith('UN'):
+                    return False
+            elif key in ('KEYWORD', 'UNKEYWORD'):
+                if (criteria.pop(0) in message.flags) == (key == 'UNKEYWORD'):
+                    return False
+            elif key == 'NOT':
+                if self._matches(message, [criteria.pop(0)]):
+                    return False
+            elif key == 'OR':
+                first, second = criteria.pop(0), criteria.pop(0)
+                if not self._matches(message, [first]) and not self._matches(message, [second]):
+                    return False
+            else:
+                value = criteria.pop(0)
+                if key == 'BEFORE' and not message.internaldate < parse_date(value):
+                    return False
+                if key == 'SINCE' and not message.internaldate >= parse_date(value):
+                    return False
+                if key == 'LARGER' and not len(message.raw) > int(value):
+                    return False
+                if key == 'SMALLER' and not len(message.raw) < int(value):
+                    return False
+                if key in ('FROM', 'TO', 'SUBJECT'):
+                    if value.lower() not in (message.parsed()[key] or '').lower():
+                        return False
+                if key == 'UID':
+                    last = self.selected.messages and self.selected.messages[-1].uid or 0
+                    if message.uid not in parse_sequence(value, last):
+                        return False
+        return True
+
+    def do_SEARCH(self, args, uid):
+        if args and not isinstance(args[0], list) and args[0].upper() == 'CHARSET':
+            args = args[2:]
+        found = [str(uid and message.uid or num) for num, message in enumerate(self.selected.messages, 1)
+                 if self._matches(message, args)]
+        self.send('* SEARCH %s\r\n' % ' '.join(found))
+
+    def _fetch_item(self, message, item):
+        """Return the FETCH response of a single data item."""
+        name = item.upper()
+        if name == 'UID':
+            return 'UID %d' % message.uid
+        if name == 'FLAGS':
+            return 'FLAGS (%s)' % ' '.join(message.flags)
+        if name == 'INTERNALDATE':
+            return 'INTERNALDATE "%s"' % format_internaldate(message.internaldate)
+        if name == 'RFC822.SIZE':
+            return 'RFC822.SIZE %d' % len(message.raw)
+        if name == 'X-GM-MSGID':
+            return 'X-GM-MSGID %d' % (message.gm_msgid or message.uid)
+        if name == 'BODYSTRUCTURE':
+            return 'BODYSTRUCTURE ' + message.bodystructure()
+        if name == 'RFC822':
+            return 'RFC822 {%d}\r\n%s' % (len(message.raw), message.raw)
+        if name == 'RFC822.HEADER':
+            data = message.section('HEADER')
+            return 'RFC822.HEADER {%d}\r\n%s' % (len(data), data)
+        match = re.match(r'BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?$', name)
+        if match is None:
+            raise ValueError('Unsupported FETCH item %s' % item)
+        data = message.section(match.group(1))
+        key = 'BODY[%s]' % match.group(1)
+        if match.group(2) is not None:
+            offset = int(match.group(2))
+            data = data[offset:offset + int(match.group(3))]
+            key += '<%d>' % offset
+        if not match.group(0).startswith('BODY.PEEK') and '\\Seen' not in message.flags:
+            message.flags.append('\\Seen')
+        return '%s {%d}\r\n%s' % (key, len(data), data)
+
+    def do_FETCH(self, args, uid):
+        items = args[1]
+        if not isinstance(items, list):
+            items = [items]
+        if len(items) == 1 and items[0].upper() in ('ALL', 'FAST'):
+            items = ['FLAGS', 'INTERNALDATE', 'RFC822.SIZE']
+        if uid and 'UID' not in [item.upper() for item in items]:
+            items = ['UID'] + items
+        for num, message in self._targets(args[0], uid):
+            data = ' '.join(self._fetch_item(message, item) for item in items)
+            self.send('* %d FETCH (%s)\r\n' % (num, data))
+
+    def do_STORE(self, args, uid):
+        mode = args[1].upper()
+        flags = args[2]
+        if not isinstance(flags, list):
+            flags = [flags]
+        for num, message in self._targets(args[0], uid):
+            if mode.startswith('+'):
+                message.flags.extend(flag for flag in flags if flag not in message.flags)
+            elif mode.startswith('-'):
+                message.flags = [flag for flag in message.flags if flag not in flags]
+            else:
+                message.flags = list(flags)
+            if not mode.endswith('.SILENT'):
+                self.send('* %d FETCH (FLAGS (%s)%s)\r\n'
+                          % (num, ' '.join(message.flags), uid and ' UID %d' % message.uid or ''))
+
+    def do_COPY(self, args, uid, move=False):
+        target = self.server.store.mailbox(args[1], create=False)
+        if target is None:
+            return 'NO [TRYCREATE] No such mailbox'
+        targets = self._targets(args[0], uid)
+        old_uids = [str(message.uid) for num, message in targets]
+        new_uids = [str(target.add(message.raw, message.flags, message.internaldate, message.gm_msgid))
+                    for num, message in targets]
+        copyuid = 'COPYUID %d %s %s' % (target.uidvalidity, ','.join(old_uids), ','.join(new_uids))
+        if not move:
+            return 'OK [%s] COPY completed' % copyuid
+        self.send('* OK [%s]\r\n' % copyuid)
+        for num, message in reversed(targets):
+            self.selected.messages.remove(message)
+            self.send('* %d EXPUNGE\r\n' % num)
+
+    def do_MOVE(self, args, uid):
+        return self.do_COPY(args, uid, True)
+
+    def _expunge(self, uids, untagged=True):
+        """Remove the messages flagged \\Deleted, only those in the set uids unless it is None."""
+        if self.selected is None:
+            return
+        messages = self.selected.messages
+        for num in range(len(messages), 0, -1):
+            message = messages[num - 1]
+            if '\\Deleted' in message.flags and (uids is None or message.uid in uids):
+                del messages[num - 1]
+                if untagged:
+                    self.send('* %d EXPUNGE\r\n' % num)
+
+    def do_EXPUNGE(self, args, uid):
+        uids = None
+        if uid:
+            uids = parse_sequence(args[0], self.selected.uidnext)
+        self._expunge(uids)
+
+    def do_APPEND(self, args, uid):
+        mailbox = self.server.store.mailbox(args[0], create=False)
+        if mailbox is None:
+            return 'NO [TRYCREATE] No such mailbox'
+        args = args[1:]
+        uids = []
+        # MULTIAPPEND: any number of [flags] [date] message
+        while args:
+            flags = ()
+            internaldate = None
+            if isinstance(args[0], list):
+                flags = args.pop(0)
+            if len(args) > 1 and re.match(r'\d+-\w+-\d{4} ', args[0]):
+                internaldate = time.mktime(time.strptime(args.pop(0)[:20].strip(), '%d-%b-%Y %H:%M:%S'))
+            uids.append(str(mailbox.add(args.pop(0), flags, internaldate)))
+        return 'OK [APPENDUID %d %s] APPEND completed' % (mailbox.uidvalidity, ','.join(uids))
+
+
+class FakeIMAPServer(SocketServer.ThreadingTCPServer):
+    """Serves a MailStore on a free port of 127.0.0.1 from a background thread until stop() is called."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, store, port=0):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', port), IMAPHandler)
+        self.store = store
+        self.port = self.server_address[1]
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
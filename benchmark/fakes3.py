@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+# Copyright HUDORA GmbH 2009
+
+"""In-process fake S3 server for tests and benchmarks of the S3 blob store.
+
+FakeS3Server serves buckets from memory from a thread of the calling process. It implements the subset of
+the S3 REST API that blobstore.S3Store uses with path-style bucket URLs: PUT, HEAD and GET of objects and
+multipart uploads (initiate, upload part, complete and abort). Signatures are not checked. Completing a
+multipart upload verifies the part list like S3 does, so wrong part numbers or ETags are rejected. The
+server counts the requests by kind. With fail_part set, uploads of the part with that number fail.
+
+>>> import httplib
+>>> server = FakeS3Server()
+>>> connection = httplib.HTTPConnection('127.0.0.1', server.port)
+>>> connection.request('PUT', '/bucket/a/b', 'hello', {'Content-Type': 'text/plain'})
+>>> response = connection.getresponse()
+>>> response.status, response.getheader('ETag'), response.read()
+(200, '"5d41402abc4b2a76b9719d911017c592"', '')
+>>> connection.request('GET', '/bucket/a/b')
+>>> connection.getresponse().read()
+'hello'
+>>> server.stop()
+>>> server.stats['put'], server.stats['get']
+(1, 1)
+"""
+
+import BaseHTTPServer
+import hashlib
+import re
+import socket
+import SocketServer
+import threading
+import time
+import urlparse
+from collections import defaultdict
+from email.utils import formatdate
+
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n'
+S3_NAMESPACE = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+def etag(data):
+    """Return the quoted ETag S3 reports for an object or part with the content data.
+
+    >>> etag('hello')
+    '"5d41402abc4b2a76b9719d911017c592"'
+    """
+    return '"%s"' % hashlib.md5(data).hexdigest()
+
+
+def parse_complete_upload(body):
+    """Return the (part number, ETag) tuples of a CompleteMultipartUpload request body.
+
+    >>> parse_complete_upload('<CompleteMultipartUpload><Part><PartNumber>1</PartNumber><ETag>"a"</ETag>'
+    ...                       '</Part><Part><PartNumber>2</PartNumber><ETag>"b"</ETag></Part>'
+    ...                       '</CompleteMultipartUpload>')
+    [(1, '"a"'), (2, '"b"')]
+    """
+    return [(int(num), tag) for num, tag in
+            re.findall(r'<Part>\s*<PartNumber>(\d+)</PartNumber>\s*<ETag>([^<]*)</ETag>\s*</Part>', body)]
+
+
+class S3Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handles the requests of a single connection to a FakeS3Server."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections.add(self.connection)
+
+    def finish(self):
+        with self.server.lock:
+            self.server.connections.discard(self.connection)
+        BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _parse(self):
+        """Return bucket, key and the query parameters of the request."""
+        parts = urlparse.urlsplit(self.path)
+        bucket, _, key = parts.path.lstrip('/').partition('/')
+        query = dict(urlparse.parse_qsl(parts.query, keep_blank_values=True))
+        return bucket, urlparse.unquote(key), query
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _respond(self, status, body='', headers=None, send_body=True):
+        self.send_response(status)
+        for name, value in sorted((headers or {}).items()):
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def _error(self, status, code, message):
+        self._respond(status, '%s<Error><Code>%s</Code><Message>%s</Message></Error>' % (XML_HEADER, code,
+                                                                                         message),
+                      {'Content-Type': 'application/xml'}, self.command != 'HEAD')
+
+    def _object(self, send_body):
+        bucket, key, query = self._parse()
+        self.server.count('get')
+        obj = self.server.objects.get(bucket, {}).get(key)
+        if obj is None:
+            return self._error(404, 'NoSuchKey', 'The specified key does not exist.')
+        data, content_type, modified = obj
+        self._respond(200, data, {'Content-Type': content_type, 'ETag': etag(data),
+                                  'Last-Modified': formatdate(modified, usegmt=True)}, send_body)
+
+    def do_HEAD(self):
+        self._object(False)
+
+    def do_GET(self):
+        self._object(True)
+
+    def do_PUT(self):
+        bucket, key, query = self._parse()
+        data = self._body()
+        if 'uploadId' in query:
+            self.server.count('upload_part')
+            if int(query['partNumber']) == self.server.fail_part:
+                return self._error(400, 'InvalidRequest', 'Part upload failed.')
+            with self.server.lock:
+                upload = self.server.uploads.get(query['uploadId'])
+                if upload is None:
+                    return self._error(404, 'NoSuchUpload', 'The specified upload does not exist.')
+                upload['parts'][int(query['partNumber'])] = data
+        else:
+            self.server.count('put')
+            with self.server.lock:
+                self.server.objects[bucket][key] = (data, self.headers.get('Content-Type'), time.time())
+        self._respond(200, '', {'ETag': etag(data)})
+
+    def do_POST(self):
+        bucket, key, query = self._parse()
+        body = self._body()
+        if 'uploads' in query:
+            self.server.count('initiate_upload')
+            with self.server.lock:
+                self.server.upload_counter += 1
+                upload_id = 'upload%d' % self.server.upload_counter
+                self.server.uploads[upload_id] = {'bucket': bucket, 'key': key, 'parts': {},
+                                                  'content_type': self.headers.get('Content-Type')}
+            return self._respond(200, '%s<InitiateMultipartUploadResult xmlns="%s"><Bucket>%s</Bucket>'
+                                 '<Key>%s</Key><UploadId>%s</UploadId></InitiateMultipartUploadResult>' % (
+                                     XML_HEADER, S3_NAMESPACE, bucket, key, upload_id),
+                                 {'Content-Type': 'application/xml'})
+
+        self.server.count('complete_upload')
+        with self.server.lock:
+            upload = self.server.uploads.get(query.get('uploadId'))
+            if upload is None:
+                return self._error(404, 'NoSuchUpload', 'The specified upload does not exist.')
+            listed = parse_complete_upload(body)
+            if not listed or [num for num, tag in listed] != sorted(set(num for num, tag in listed)):
+                return self._error(400, 'InvalidPartOrder', 'The list of parts was not in ascending order.')
+            for num, tag in listed:
+                if num not in upload['parts'] or etag(upload['parts'][num]) != tag:
+                    return self._error(400, 'InvalidPart', 'One or more of the specified parts could not '
+                                       'be found.')
+            data = ''.join(upload['parts'][num] for num, tag in listed)
+            self.server.objects[bucket][key] = (data, upload['content_type'], time.time())
+            del self.server.uploads[query['uploadId']]
+        self._respond(200, '%s<CompleteMultipartUploadResult xmlns="%s"><Location>/%s/%s</Location>'
+                      '<Bucket>%s</Bucket><Key>%s</Key><ETag>%s</ETag></CompleteMultipartUploadResult>' % (
+                          XML_HEADER, S3_NAMESPACE, bucket, key, bucket, key, etag(data)),
+                      {'Content-Type': 'application/xml'})
+
+    def do_DELETE(self):
+        bucket, key, query = self._parse()
+        self.server.count('abort_upload')
+        with self.server.lock:
+            if self.server.uploads.pop(query.get('uploadId'), None) is None:
+                return self._error(404, 'NoSuchUpload', 'The specified upload does not exist.')
+        self._respond(204)
+
+
+class FakeS3Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves buckets from memory on a free port of 127.0.0.1 from a background thread until stop().
+
+    objects maps bucket names to dicts of key: (data, content type, modification time), uploads maps the
+    ids of unfinished multipart uploads to their state. Buckets spring into existence when written to.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), S3Handler)
+        self.port = self.server_address[1]
+        self.objects = defaultdict(dict)
+        self.uploads = {}
+        self.upload_counter = 0
+        self.fail_part = None
+        self.stats = defaultdict(int)
+        self.lock = threading.Lock()
+        # open client connections, closed by stop() so no handler thread outlives the server
+        self.connections = set()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def count(self, kind):
+        with self.lock:
+            self.stats[kind] += 1
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+# Copyright HUDORA GmbH 2009
+
+"""Synthetic mailboxes for benchmarking the mail tools.
+
+generate() returns a list of raw mails resembling a real mailbox: message sizes follow a log-normal
+distribution, a configurable share of the mails carries attachments of a mix of types, text parts use a mix
+of charsets and transfer encodings, some mails are forwarded as message/rfc822 or nest multipart/alternative
+bodies, and scanner mails come split into message/partial sets like the ones departicularifier handles.
+
+The output only depends on the profile, so benchmark runs with the same profile work on identical mails.
+
+>>> profile = dict(DEFAULT_PROFILE, messages=20, median_size=4, partial_sets=1, partial_size=100,
+...                fragment_size=60)
+>>> mails = generate(profile)
+>>> len(mails)
+23
+>>> mails == generate(profile)
+True
+>>> len([mail for mail in mails if 'Content-Type: message/partial' in mail])
+3
+"""
+
+import base64
+import email.encoders
+import email.header
+import email.utils
+import math
+import random
+from email.mime.application import MIMEApplication
+from email.mime.base import MIMEBase
+from email.mime.message import MIMEMessage
+from email.mime.multipart import MIMEMultipart
+from email.mime.nonmultipart import MIMENonMultipart
+from email.mime.text import MIMEText
+
+DEFAULT_PROFILE = {
+    # number of regular mails, message/partial fragments come on top
+    'messages': 500,
+    # median and upper limit of the message size, in kB
+    'median_size': 40,
+    'max_size': 20 * 1024,
+    # spread of the log-normal size distribution
+    'size_sigma': 1.5,
+    # share of the mails with attachments
+    'attachment_ratio': 0.4,
+    # share of the mails with attachments that are forwarded as message/rfc822
+    'nested_ratio': 0.1,
+    # share of the attachments repeating the content of an earlier one
+    'duplicate_ratio': 0.1,
+    # (content type, file extension, weight) of the attachments
+    'attachment_types': [('application/pdf', 'pdf', 5), ('image/jpeg', 'jpg', 3),
+                         ('application/msword', 'doc', 2), ('application/zip', 'zip', 1),
+                         ('text/plain', 'txt', 1)],
+    # charsets of the text parts, with weights
+    'charsets': [('us-ascii', 3), ('utf-8', 4), ('iso-8859-1', 3), ('windows-1252', 1), ('koi8-r', 1)],
+    # number of scanned documents split into message/partial fragments
+    'partial_sets': 2,
+    # size of the scanned documents and of their fragments, in kB
+    'partial_size': 2 * 1024,
+    'fragment_size': 512,
+    'seed': 1,
+}
+
+SENDERS = ['Anna Schmidt <anna@example.com>', 'Jörg Müller <joerg@example.de>', 'billing@example.net',
+           'Иван Петров <ivan@example.ru>', 'noreply@shop.example.com', 'François <f@example.fr>']
+WORDS = (u'order invoice delivery meeting report quarter price offer Angebot Lieferung Rechnung über '
+         u'Grüße straße café naïve déjà счет заказ доставка').split()
+
+# pseudo random data repeated to fill attachments, so generating a mailbox doesn't take longer than the
+# benchmark itself
+POOL_SIZE = 256 * 1024
+
+
+class Generator(object):
+    """Generates the mails of a profile, see generate()."""
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.rng = random.Random(profile['seed'])
+        self.pool = ''.join(chr(self.rng.getrandbits(8)) for i in range(POOL_SIZE))
+        self.contents = []
+        self.count = 0
+        self.serial = 0
+
+    def _choice(self, weighted):
+        """Choose an item from a list of tuples whose last element is the weight."""
+        total = sum(item[-1] for item in weighted)
+        pick = self.rng.uniform(0, total)
+        for item in weighted:
+            pick -= item[-1]
+            if pick <= 0:
+                break
+        return item
+
+    def _size(self):
+        """Draw a message size in bytes from the log-normal size distribution."""
+        median = self.profile['median_size'] * 1024
+        size = int(self.rng.lognormvariate(math.log(median), self.profile['size_sigma']))
+        return max(512, min(size, self.profile['max_size'] * 1024))
+
+    def _data(self, size):
+        """Return size bytes of attachment content, distinct from all earlier contents."""
+        self.count += 1
+        offset = self.rng.randrange(POOL_SIZE)
+        data = '%08d' % self.count
+        while len(data) < size:
+            data += self.pool[offset:offset + size - len(data)]
+            offset = 0
+        return data[:size]
+
+    def _text(self, words):
+        """Return lines of random words, long texts repeat a sample of 50 lines."""
+        lines = [u' '.join(self.rng.choice(WORDS) for i in range(min(words, 12)))
+                 for line in range(min((words + 11) // 12, 50))]
+        text = u'\n'.join(lines)
+        return u'\n'.join([text] * max(1, words // 600))
+
+    def _boundary(self):
+        return '===============%d==' % self.rng.getrandbits(48)
+
+    def _multipart(self, subtype):
+        return MIMEMultipart(subtype, boundary=self._boundary())
+
+    def _text_part(self, words, subtype='plain'):
+        """Return a text part in a randomly chosen charset and transfer encoding."""
+        charset = self._choice(self.profile['charsets'])[0]
+        text = self._text(words)
+        if subtype == 'html':
+            text = u'<html><body><p>%s</p></body></html>' % text
+        part = MIMENonMultipart('text', subtype, charset=charset)
+        part.set_payload(text.encode(charset, 'replace'))
+        if charset == 'us-ascii':
+            email.encoders.encode_7or8bit(part)
+        elif self.rng.random() < 0.5:
+            email.encoders.encode_quopri(part)
+        else:
+            email.encoders.encode_base64(part)
+        return part
+
+    def _headers(self, mail, subject):
+        mail['From'] = self.rng.choice(SENDERS)
+        mail['To'] = 'benchmark@example.com'
+        mail['Subject'] = email.header.Header(subject, 'utf-8').encode()
+        mail['Date'] = email.utils.formatdate(1230768000 + self.rng.randrange(365 * 24 * 3600))
+        self.serial += 1
+        mail['Message-ID'] = '<bench%d.%d@example.com>' % (self.profile['seed'], self.serial)
+
+    def _attachment(self, size):
+        """Return an attachment part of about size bytes."""
+        mimetype, ext, weight = self._choice(self.profile['attachment_types'])
+        if self.contents and self.rng.random() < self.profile['duplicate_ratio']:
+            data = self.rng.choice(self.contents)
+        else:
+            data = self._data(size)
+            self.contents.append(data)
+        maintype, subtype = mimetype.split('/')
+        if maintype == 'text':
+            part = MIMEText(base64.b64encode(data), subtype)
+        elif maintype == 'application':
+            part = MIMEApplication(data, subtype)
+        else:
+            part = MIMEBase(maintype, subtype)
+            part.set_payload(data)
+            email.encoders.encode_base64(part)
+        filename = u'%s %d.%s' % (self.rng.choice(WORDS), self.count, ext)
+        part.add_header('Content-Disposition', 'attachment', filename=('utf-8', '', filename.encode('utf-8')))
+        return part
+
+    def mail(self):
+        """Generate a single regular mail."""
+        size = self._size()
+        subject = self._text(self.rng.randint(2, 8))
+        if self.rng.random() >= self.profile['attachment_ratio']:
+            if self.rng.random() < 0.3:
+                mail = self._multipart('alternative')
+                mail.attach(self._text_part(size // 14))
+                mail.attach(self._text_part(size // 14, 'html'))
+            else:
+                mail = self._text_part(size // 7)
+            self._headers(mail, subject)
+            return mail.as_string()
+
+        mail = self._multipart('mixed')
+        if self.rng.random() < 0.5:
+            body = self._multipart('alternative')
+            body.attach(self._text_part(80))
+            body.attach(self._text_part(80, 'html'))
+        else:
+            body = self._text_part(80)
+        mail.attach(body)
+        attachments = self.rng.choice([1, 1, 1, 2, 3])
+        for i in range(attachments):
+            # base64 grows the content by a third
+            mail.attach(self._attachment(size * 3 // (4 * attachments)))
+        self._headers(mail, subject)
+        if self.rng.random() < self.profile['nested_ratio']:
+            forward = self._multipart('mixed')
+            forward.attach(self._text_part(30))
+            forward.attach(MIMEMessage(mail))
+            self._headers(forward, u'Fwd: ' + subject)
+            mail = forward
+        return mail.as_string()
+
+    def partial_set(self):
+        """Generate a scanned document split into message/partial fragments (RFC 2046, section 5.2.2)."""
+        scan = self._multipart('mixed')
+        scan.attach(MIMEText('Scanned document'))
+        scan.attach(self._attachment(self.profile['partial_size'] * 1024))
+        self._headers(scan, u'Scan')
+        scan.replace_header('From', 'scanner@example.com')
+        raw = scan.as_string()
+        fragment_size = self.profile['fragment_size'] * 1024
+        fragments = [raw[offset:offset + fragment_size] for offset in range(0, len(raw), fragment_size)]
+        scan_id = scan['Message-ID'].strip('<>')
+        set_id = '"%s"' % scan_id
+        mails = []
+        for number, fragment in enumerate(fragments):
+            mails.append('From: scanner@example.com\nTo: benchmark@example.com\nSubject: Scan (%d/%d)\n'
+                         'Date: %s\nMessage-ID: <part%d.%s>\nMIME-Version: 1.0\n'
+                         'Content-Type: message/partial; id=%s; number=%d; total=%d\n\n%s'
+                         % (number + 1, len(fragments), scan['Date'], number + 1, scan_id, set_id,
+                            number + 1, len(fragments), fragment))
+        return mails
+
+
+def generate(profile=None):
+    """Return the raw mails (with LF line endings) of a profile, see DEFAULT_PROFILE for its keys."""
+    generator = Generator(profile or DEFAULT_PROFILE)
+    mails = [generator.mail() for i in range(generator.profile['messages'])]
+    for i in range(generator.profile['partial_sets']):
+        mails.extend(generator.partial_set())
+    return mails
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+# Copyright HUDORA GmbH 2009
+
+"""Stores for archived attachment contents outside of CouchDB.
+
+RemoveAttachments stores every attachment content once under its SHA-256 hash. By default the contents are
+CouchDB attachments of blob documents. With a blob store, CouchDB only keeps the mail documents, which
+reference the contents by hash, and the contents go to the store selected by open_store():
+
+    file:///var/archive/blobs            directory tree sharded by hash prefix
+    s3://bucket/prefix                   Amazon S3, credentials from AWS_ACCESS_KEY_ID/AWS_SECRET_ACCESS_KEY
+    s3+http://host:port/bucket/prefix    S3 compatible server, e.g. a local stand-in (s3+https likewise)
+
+Payloads are read from file objects in blocks, so no store ever needs a whole attachment in memory.
+
+>>> import shutil, StringIO
+>>> root = tempfile.mkdtemp()
+>>> store = open_store('file://' + root)
+>>> digest = hashlib.sha256('hello').hexdigest()
+>>> store.exists(digest)
+False
+>>> store.put(digest, StringIO.StringIO('hello'), 5, 'text/plain')
+>>> store.exists(digest), store.key(digest)[:6], store.open(digest).read()
+(True, '2c/f2/', 'hello')
+>>> shutil.rmtree(root)
+"""
+
+import hashlib
+import logging
+import os
+import Queue
+import tempfile
+import threading
+import urlparse
+from cStringIO import StringIO
+
+# size of the blocks read from payloads when copying them into a store
+COPY_BUFFER_SIZE = 256 * 1024
+# payloads up to this size are uploaded to S3 in a single request, larger ones as multipart uploads
+S3_PART_SIZE = 8 * 1024 * 1024
+# parts of a multipart upload that are uploaded at the same time
+S3_CONCURRENCY = 4
+
+
+class BlobStoreException(Exception):
+    """Exception type generated by the blob stores."""
+    pass
+
+
+def open_store(url):
+    """Return the blob store for url, see the module documentation for the supported URLs.
+
+    >>> open_store('file:///srv/blobs').url
+    'file:///srv/blobs'
+    >>> open_store('ftp://example.com/blobs')
+    Traceback (most recent call last):
+    ...
+    BlobStoreException: Unsupported blob store URL: ftp://example.com/blobs
+    """
+    parts = urlparse.urlsplit(url)
+    if parts.scheme == 'file':
+        return FileStore(parts.path)
+    if parts.scheme == 's3':
+        return S3Store(parts.netloc, parts.path.strip('/'))
+    if parts.scheme in ('s3+http', 's3+https'):
+        bucket, _, prefix = parts.path.strip('/').partition('/')
+        return S3Store(bucket, prefix, parts.hostname, parts.port, parts.scheme == 's3+https')
+    raise BlobStoreException("Unsupported blob store URL: %s" % url)
+
+
+def shard_key(digest):
+    """Return the key of a content hash, sharded into two levels of directories.
+
+    >>> shard_key('2cf24dba5fb0a30e26e83b2ac5b9e29e1b161e5c1fa7425e73043362938b9824')
+    '2c/f2/2cf24dba5fb0a30e26e83b2ac5b9e29e1b161e5c1fa7425e73043362938b9824'
+    """
+    return '%s/%s/%s' % (digest[:2], digest[2:4], digest)
+
+
+def read_blocks(payload, size=COPY_BUFFER_SIZE):
+    """Generate the contents of a payload given as string or file object in blocks of up to size bytes.
+
+    >>> list(read_blocks('hello', 2))
+    ['he', 'll', 'o']
+    """
+    if not hasattr(payload, 'read'):
+        payload = StringIO(payload)
+    while True:
+        data = payload.read(size)
+        if not data:
+            break
+        yield data
+
+
+class FileStore(object):
+    """Blob store in a local directory tree, see shard_key().
+
+    Contents are written to a temporary file next to their final location and renamed into place once
+    complete, so readers and concurrent writers of the same content never see partial files.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.url = 'file://' + root
+
+    def key(self, digest):
+        return shard_key(digest)
+
+    def path(self, digest):
+        return os.path.join(self.root, *self.key(digest).split('/'))
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def put(self, digest, payload, length, content_type):
+        """Store payload (string or file object of length bytes) under digest."""
+        path = self.path(digest)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created concurrently
+                if not os.path.isdir(directory):
+                    raise
+        out = tempfile.NamedTemporaryFile(dir=directory, prefix='.' + digest, delete=False)
+        try:
+            for data in read_blocks(payload):
+                out.write(data)
+            out.flush()
+            os.fsync(out.fileno())
+            out.close()
+            os.rename(out.name, path)
+        except:
+            out.close()
+            os.unlink(out.name)
+            raise
+
+    def open(self, digest):
+        """Return a file object reading the content stored under digest."""
+        return open(self.path(digest), 'rb')
+
+
+class S3Store(object):
+    """Blob store in an S3 bucket, keys are prefix/shard_key(digest).
+
+    Needs boto. Every thread uses its own S3 connection. Payloads larger than S3_PART_SIZE are uploaded as
+    multipart uploads: the parts are read from the payload one after the other and uploaded by up to
+    S3_CONCURRENCY threads at the same time, so at most S3_CONCURRENCY + 2 parts are held in memory.
+
+    The examples run against the fake S3 server of the benchmark suite:
+
+    >>> import sys, StringIO
+    >>> sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark'))
+    >>> import fakes3
+    >>> os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test') and None
+    >>> os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test') and None
+    >>> server = fakes3.FakeS3Server()
+    >>> store = open_store('s3+http://127.0.0.1:%d/attachments/blobs' % server.port)
+    >>> digest = hashlib.sha256('hello').hexdigest()
+    >>> store.exists(digest)
+    False
+    >>> store.put(digest, 'hello', 5, 'text/plain')
+    >>> store.exists(digest), store.key(digest)[:12], store.open(digest).read()
+    (True, 'blobs/2c/f2/', 'hello')
+    >>> server.objects['attachments'][store.key(digest)][1], server.stats['initiate_upload']
+    ('text/plain', 0)
+
+    Larger payloads are uploaded in parts and put together by complete_multipart_upload:
+
+    >>> store = S3Store('attachments', 'blobs', '127.0.0.1', server.port, False, part_size=1000,
+    ...                 concurrency=3)
+    >>> payload = ''.join(chr(i % 251) for i in range(4500))
+    >>> digest = hashlib.sha256(payload).hexdigest()
+    >>> store.put(digest, StringIO.StringIO(payload), len(payload), 'application/pdf')
+    >>> store.open(digest).read() == payload
+    True
+    >>> server.stats['upload_part'], server.stats['complete_upload'], server.uploads
+    (5, 1, {})
+
+    If a part fails, the upload is cancelled:
+
+    >>> server.fail_part = 3
+    >>> logging.disable(logging.CRITICAL)
+    >>> store.put(digest, 'x' + payload, len(payload) + 1, 'text/plain')  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    BlobStoreException: Upload of blobs/.../... failed: S3ResponseError: 400 Bad Request...
+    >>> logging.disable(logging.NOTSET)
+    >>> server.stats['abort_upload'], server.stats['complete_upload'], server.uploads
+    (1, 1, {})
+    >>> server.stop()
+    """
+
+    def __init__(self, bucket, prefix='', host=None, port=None, is_secure=True,
+                 part_size=S3_PART_SIZE, concurrency=S3_CONCURRENCY):
+        if not bucket:
+            bucket = os.environ.get('S3BUCKET')
+        if not bucket:
+            raise BlobStoreException("No S3 bucket given")
+        self.bucket_name = bucket
+        self.prefix = prefix
+        self.host = host
+        self.port = port
+        self.is_secure = is_secure
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.local = threading.local()
+        if host is None:
+            self.url = 's3://%s/%s' % (bucket, prefix)
+        else:
+            netloc = host
+            if port is not None:
+                netloc += ':%d' % port
+            self.url = '%s://%s/%s/%s' % (is_secure and 's3+https' or 's3+http', netloc, bucket, prefix)
+
+    def _bucket(self):
+        """Return the bucket object of the S3 connection of the calling thread."""
+        bucket = getattr(self.local, 'bucket', None)
+        if bucket is None:
+            try:
+                import boto.s3.connection
+            except ImportError:
+                raise BlobStoreException("The S3 blob store needs boto")
+            options = {'is_secure': self.is_secure}
+            if self.host is not None:
+                # S3 compatible servers generally don't support virtual-hosted buckets
+                options.update(host=self.host, port=self.port,
+                               calling_format=boto.s3.connection.OrdinaryCallingFormat())
+            connection = boto.s3.connection.S3Connection(**options)
+            bucket = connection.get_bucket(self.bucket_name, validate=False)
+            self.local.bucket = bucket
+        return bucket
+
+    def key(self, digest):
+        if self.prefix:
+            return self.prefix + '/' + shard_key(digest)
+        return shard_key(digest)
+
+    def exists(self, digest):
+        return self._bucket().get_key(self.key(digest)) is not None
+
+    def put(self, digest, payload, length, content_type):
+        """Store payload (string or file object of length bytes) under digest."""
+        headers = {'Content-Type': content_type}
+        if length <= self.part_size:
+            data = ''.join(read_blocks(payload))
+            self._bucket().new_key(self.key(digest)).set_contents_from_string(data, headers=headers)
+            return
+
+        upload = self._bucket().initiate_multipart_upload(self.key(digest), headers=headers)
+        logging.debug("Uploading %s in parts of %d bytes", upload.key_name, self.part_size)
+        parts = Queue.Queue(1)
+        etags = {}
+        errors = []
+        threads = [threading.Thread(target=self._upload_parts,
+                                    args=(upload.key_name, upload.id, parts, etags, errors))
+                   for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        try:
+            part_num = 0
+            for data in read_blocks(payload, self.part_size):
+                if errors:
+                    break
+                part_num += 1
+                parts.put((part_num, data))
+        finally:
+            for thread in threads:
+                parts.put(None)
+            for thread in threads:
+                thread.join()
+        if errors:
+            upload.cancel_upload()
+            raise BlobStoreException("Upload of %s failed: %s" % (upload.key_name, errors[0]))
+        # MultiPartUpload.complete_upload() would list the uploaded parts again
+        xml = ''.join('<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>' % (num, etags[num])
+                      for num in sorted(etags))
+        xml = '<CompleteMultipartUpload>%s</CompleteMultipartUpload>' % xml
+        self._bucket().complete_multipart_upload(upload.key_name, upload.id, xml)
+
+    def _upload_parts(self, key_name, upload_id, parts, etags, errors):
+        """Upload the (number, data) tuples from the queue parts until a None is read from it.
+
+        The ETags of the uploaded parts are added to the dict etags, exceptions to the list errors.
+        """
+        import boto.s3.multipart
+        upload = boto.s3.multipart.MultiPartUpload(self._bucket())
+        upload.key_name = key_name
+        upload.id = upload_id
+        while True:
+            item = parts.get()
+            if item is None:
+                break
+            if errors:
+                continue
+            part_num, data = item
+            try:
+                key = upload.upload_part_from_file(StringIO(data), part_num, size=len(data))
+                etags[part_num] = key.etag
+            except Exception, e:
+                logging.exception(e)
+                errors.append(e)
+
+    def open(self, digest):
+        """Return a file object reading the content stored under digest."""
+        key = self._bucket().get_key(self.key(digest))
+        if key is None:
+            raise BlobStoreException("No content %s in %s" % (digest, self.url))
+        return key
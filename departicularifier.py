@@ -5,14 +5,17 @@ See  http://blogs.23.nu/c0re/2008/11/departicularifier-for-nrg-mp-161-scanfaxpri
 
 Created 2008-11-01 by Maximillian Dornseif. You may consider it BSD licensed.'''
 
-import email
 import mimetypes
 import getpass
 import os
 import sys
 import imaplib
+import tempfile
 from optparse import OptionParser
 
+import instrument
+import mimestream
+
 
 __revision__ = '$Revision: 3958 $'
 
@@ -24,6 +27,11 @@ parser.description = __doc__
 parser.set_usage('usage: %prog --user=you@example.com [options].\nTry %prog --help for details.')
 parser.add_option('--server', action='store', type='string', default='mail.hudora.biz',
                   help='hostname of the IMAPS server where the messages are stored (default: "%default")')
+parser.add_option('--port', action='store', type='int',
+                  help='IMAP port (default: %d, or %d with --no-ssl)'
+                  % (imaplib.IMAP4_SSL_PORT, imaplib.IMAP4_PORT))
+parser.add_option('--no-ssl', action='store_false', dest='ssl', default=True,
+                  help='Connect without SSL')
 parser.add_option('--user', action='store', type='string',
                   help='User name for logging into the server (default: "%default")')
 parser.add_option('--password', action='store', type='string', default=0,
@@ -34,9 +42,11 @@ parser.add_option('--sender', action='store', type='string', default='scanner@',
                   help='Sender whose messages to process (default: "%default")')
 parser.add_option('--dir', action='store', type='string', default='.',
                   help='Destination directory (default: "%default")')
+instrument.add_options(parser)
 
 
 options, args = parser.parse_args()
+metrics = instrument.from_options('departicularifier', options)
 
 if not options.user:
     print "username not set"
@@ -45,62 +55,86 @@ if not options.password:
     print "connecting to %r as %r." % (options.server, options.user)
     options.password = getpass.getpass()
 
-M = imaplib.IMAP4_SSL(options.server)
+if options.ssl:
+    M = imaplib.IMAP4_SSL(options.server, options.port or imaplib.IMAP4_SSL_PORT)
+else:
+    M = imaplib.IMAP4(options.server, options.port or imaplib.IMAP4_PORT)
+instrument.instrument_imap(M, metrics)
 M.login(options.user, options.password)
-M.select(options.folder, readonly=True)
-
-typ, messagenums = M.search(None, '(FROM "%s")' % options.sender)
-
-fileparts = {}
-
-for num in messagenums[0].split():
-    typ, msg_data = M.fetch(num, '(RFC822)')
-    for response_part in msg_data:
-        if isinstance(response_part, tuple):
-            msg = email.message_from_string(response_part[1])
-            if msg.get_content_type() == 'message/partial':
-                msginfo = dict(msg.get_params('content-type'))
-                if msginfo['id'] not in fileparts:
-                    fileparts[msginfo['id']] = [''] * int(msginfo['total'])
-                fileparts[msginfo['id']][int(msginfo['number'])-1] = msg.get_payload()[0]
-            
-            sys.stdout.write('%s %s\r' % ( msg['message-id'], msg['subject']),)
-            sys.stdout.flush()
-    
-print
-
-for fileid in fileparts.keys():
-    combined = []
-    for part in fileparts[fileid]:
-        boundary = dict(msg.get_params('content-type')).get('boundary', None)
-        if hasattr(part, 'as_string'):
-            text = part.as_string()
-        else:
-            text = str(part)
-        if boundary:
-            text = text.strip('\r\n') # .strip('--%s--' % boundary).strip('\r\n')
-        combined.append(text)
-    
-    open(fileid,'w').write(''.join(combined))
-    msg = email.message_from_string(''.join(combined))
-    
-    counter = 0
-    for part in msg.walk():
-            # multipart/* are just containers
-            if part.get_content_maintype() == 'multipart':
-                continue
-            if part['content-disposition'] and part['content-disposition'].startswith('attachment'):
-                filename = part.get_filename()
-                if not filename:
-                    ext = mimetypes.guess_extension(part.get_content_type())
-                    if not ext:
-                        ext = '.bin'
-                    filename = 'part-%03d%s' % (counter, ext)
-                counter += 1
-                filename = filename.replace('/', '_')
-                filename = os.path.join(options.dir, filename)
-                print "writing %s" % (filename,)
-                fp = open(filename, 'wb')
-                fp.write(part.get_payload(decode=True))
-                fp.close()
-            
+
+with metrics.mailbox(options.folder):
+    with metrics.phase('select'):
+        M.select(options.folder, readonly=True)
+
+    with metrics.phase('search'):
+        typ, messagenums = M.search(None, '(FROM "%s")' % options.sender)
+    metrics.expect(len(messagenums[0].split()), 0)
+
+    fileparts = {}
+
+    for num in messagenums[0].split():
+        with metrics.phase('fetch'):
+            typ, msg_data = M.fetch(num, '(RFC822)')
+        for response_part in msg_data:
+            if isinstance(response_part, tuple):
+                with metrics.phase('parse'):
+                    msg = mimestream.parse_string(response_part[1])
+                    if msg.get_content_type() == 'message/partial':
+                        msginfo = dict(msg.get_params('content-type'))
+                        if msginfo['id'] not in fileparts:
+                            fileparts[msginfo['id']] = [None] * int(msginfo['total'])
+                        # keep the raw fragment, which goes to disk if it is large
+                        fragment = tempfile.SpooledTemporaryFile(max_size=mimestream.DEFAULT_SPOOL_THRESHOLD)
+                        for data in msg.iter_raw():
+                            fragment.write(data)
+                        fileparts[msginfo['id']][int(msginfo['number'])-1] = fragment
+
+                sys.stdout.write('%s %s\r' % ( msg['message-id'], msg['subject']),)
+                sys.stdout.flush()
+                metrics.message_done(len(response_part[1]))
+
+    print
+
+    for fileid in fileparts.keys():
+        # the original message is the concatenation of the fragments, stream it into the file and the parser
+        with metrics.phase('reassemble'):
+            out = open(fileid, 'wb')
+            parser = mimestream.StreamParser()
+            for fragment in fileparts[fileid]:
+                if fragment is None:
+                    continue
+                fragment.seek(0)
+                while True:
+                    data = fragment.read(mimestream.COPY_BUFFER_SIZE)
+                    if not data:
+                        break
+                    out.write(data)
+                    parser.feed(data)
+                fragment.close()
+            out.close()
+            msg = parser.close()
+
+        counter = 0
+        for part in msg.walk():
+                # multipart/* are just containers
+                if part.get_content_maintype() == 'multipart':
+                    continue
+                if part['content-disposition'] and part['content-disposition'].startswith('attachment'):
+                    filename = part.get_filename()
+                    if isinstance(filename, unicode):
+                        filename = filename.encode('utf-8')
+                    if not filename:
+                        ext = mimetypes.guess_extension(part.get_content_type())
+                        if not ext:
+                            ext = '.bin'
+                        filename = 'part-%03d%s' % (counter, ext)
+                    counter += 1
+                    filename = filename.replace('/', '_')
+                    filename = os.path.join(options.dir, filename)
+                    print "writing %s" % (filename,)
+                    with metrics.phase('write'):
+                        fp = open(filename, 'wb')
+                        part.decode_to(fp)
+                        fp.close()
+
+instrument.write_outputs(metrics, options)
@@ -4,6 +4,8 @@
 """Views für vermischte interne Seiten in der HUDORA Webapplikation."""
 
 import operator
+import os
+import sys
 
 from django.template import RequestContext
 from django.shortcuts import render_to_response
@@ -17,6 +19,34 @@ from produktpass.models import Product
 import couchdb
 import urlparse
 
+# blobstore.py gehoert zu RemoveAttachments und liegt eine Ebene ueber diesem Verzeichnis
+TOOLBOX_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if TOOLBOX_DIR not in sys.path:
+    sys.path.insert(0, TOOLBOX_DIR)
+import blobstore
+
+
+# die nach Inhalt (SHA-256) abgelegten Attachments haben IDs mit diesem Prefix, siehe RemoveAttachments
+BLOB_PREFIX = 'blob-sha256-'
+BLOB_RANGE_END = BLOB_PREFIX + u'\ufff0'
+
+
+def message_rows(db, skip, limit):
+    """Return limit rows of _all_docs starting at row skip, without the blob documents.
+
+    Die Blobs bilden einen zusammenhaengenden Schluesselbereich. Wir blaettern durch die Bereiche davor und
+    danach, damit jede Seite voll wird.
+    """
+    # Anzahl der Dokumente vor den Blobs
+    before = db.view('_all_docs', startkey=BLOB_PREFIX, limit=0).offset
+    rows = []
+    if skip < before:
+        rows = list(db.view('_all_docs', endkey=BLOB_PREFIX, inclusive_end=False, skip=skip, limit=limit))
+    if len(rows) < limit:
+        rows.extend(db.view('_all_docs', startkey=BLOB_RANGE_END, skip=max(skip - before, 0),
+                            limit=limit - len(rows)))
+    return rows
+
 
 def attachmentarchive_index(request):
     start = int(request.GET.get('start', '0'))
@@ -28,7 +58,8 @@ def attachmentarchive_index(request):
     if query and (query.strip() in db):
         return HttpResponseRedirect('./%s/' % urllib.quote(query.strip()))
 
-    results = db.view('_all_docs', limit=perpage, skip=start)
+    # die nach Inhalt abgelegten Attachments sind keine Nachrichten
+    results = message_rows(db, start, perpage)
     return render_to_response('hdMailviewer/attachmentarchive_index.html',
                               {'title': 'Urbersicht archivierte Attachments', 
                                # wir erzwingen volle tausenderschritte
@@ -40,7 +71,9 @@ def attachmentarchive_message(request, messagekey):
     server = couchdb.client.Server('http://couchdb1.local.hudora.biz:5984/')
     db = server['attachments']
     doc = db[messagekey]
-    doc['attachments'] = doc['_attachments'] # needed for django Template engine
+    doc['attachments'] = dict(doc.get('_attachments', {})) # needed for django Template engine
+    # neuere Datensaetze verweisen auf nach Inhalt (SHA-256) abgelegte Blobs
+    doc['attachments'].update(doc.get('attachment_refs', {}))
     return render_to_response('hdMailviewer/attachmentarchive_message.html',
                               {'title': 'archivierte Attachments: %s (%s)' % (doc.get('subject'), doc.get('date')),
                                'key': messagekey,
@@ -52,6 +85,16 @@ def attachmentarchive_attachment(request, messagekey, attachmentkey):
     db = server['attachments']
     doc = db[messagekey]
     
+    ref = doc.get('attachment_refs', {}).get(attachmentkey)
+    if ref and 'store' in ref:
+        # Inhalt liegt ausserhalb der CouchDB (RemoveAttachments --blob-store), blockweise ausliefern
+        content = blobstore.open_store(ref['store']).open(ref['blob'][len(BLOB_PREFIX):])
+        return HttpResponse(blobstore.read_blocks(content), mimetype=ref['content_type'])
+    if ref:
+        response = HttpResponse(mimetype=ref['content_type'])
+        response.write(db.get_attachment(ref['blob'], 'content'))
+        return response
+
     attachment = doc['_attachments'][attachmentkey]
     response = HttpResponse(mimetype=attachment['content_type'])
     response.write(db.get_attachment(doc, attachmentkey))
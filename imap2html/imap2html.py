@@ -4,20 +4,51 @@
 import os
 import sys
 import email
+import hashlib
+import itertools
 import mimetypes
 import cgi
 import socket
+import sqlite3
 import time
+import calendar
 import logging
 import re
 import urllib
+import multiprocessing
+import threading
+import Queue
 
+from collections import defaultdict, deque
+from contextlib import contextmanager
 from email.header import decode_header
 from imaplib import IMAP4
 from imaplib import IMAP4_SSL
+from imaplib import IMAP4_PORT
+from imaplib import IMAP4_SSL_PORT
 from optparse import OptionParser
 
+try:
+    import instrument
+    import mimestream
+    import policy
+    import throttle
+except ImportError:
+    # running from a checkout, the shared modules live in the top level directory
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+    import instrument
+    import mimestream
+    import policy
+    import throttle
+
 options = None
+metrics = None
+governor = None
+# counters of the run, written with the metrics
+stats = defaultdict(int)
+stats_lock = threading.Lock()
+# the output directory of the folder the calling thread archives, see folder_output()
+local = threading.local()
 
 message_template = """
 <html>
@@ -66,11 +97,15 @@ list_template = """
     <body>
         <p>
             <b>Show</b>&nbsp;
+            <a href="../index.html">all folders</a>&nbsp;|&nbsp;
             <a href="index.html">all</a>&nbsp;|&nbsp;
             <a href="by-sender.html">by sender</a>&nbsp;|&nbsp;
             <a href="by-subject.html">by subject</a>&nbsp;|&nbsp;
             <a href="by-date.html">by date</a>
         </p>
+        <p>
+            {navigation}
+        </p>
         <p>
             <table width="100%">
                 <tr align="left">
@@ -81,9 +116,20 @@ list_template = """
                 {table}
             </table>
         </p>
+        <p>
+            {navigation}
+        </p>
     <body>
 <html>"""
 
+list_row_template = """
+    <tr>
+        <td><a href="{id}/message.html">{sender}</a></td>
+        <td><a href="{id}/message.html">{subject}</a></td>
+        <td nowrap><a href="{id}/message.html">{date}</a></td>
+    </tr>
+    """
+
 overview_template = """
 <html>
     <head>
@@ -98,6 +144,43 @@ overview_template = """
 <html>"""
 
 
+# reply and forward prefixes stripped from subjects, like "Re: ", "AW: " or "Fwd[2]: "
+SUBJECT_PREFIX = re.compile(r'^\s*((re|aw|antw|fw|fwd|wg|sv|tr)(\[\d+\])?\s*:\s*)+', re.IGNORECASE)
+
+# kinds of groups of the overview pages, in the order of the fields of MessageIndex.keys()
+GROUP_KINDS = ('sender', 'subject', 'day', 'month', 'year')
+
+
+# number of messages whose sizes are looked up with one UID FETCH
+FETCH_BATCH_SIZE = 50
+
+FETCH_UID = re.compile(r'\bUID (\d+)', re.IGNORECASE)
+FETCH_SIZE = re.compile(r'\bRFC822\.SIZE (\d+)', re.IGNORECASE)
+
+LIST_RESPONSE = re.compile(r'^\((?P<flags>[^)]*)\) (?P<delimiter>"(?:[^"\\]|\\.)*"|NIL) (?P<name>.*)$')
+
+# name of the manifest in the output directory
+MANIFEST_NAME = 'manifest.sqlite'
+
+MANIFEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS mailboxes (
+    mailbox TEXT NOT NULL PRIMARY KEY,
+    uidvalidity INTEGER NOT NULL,
+    page_size INTEGER
+);
+CREATE TABLE IF NOT EXISTS messages (
+    mailbox TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    uid INTEGER NOT NULL,
+    sender TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    date INTEGER NOT NULL,
+    rendered INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (mailbox, uidvalidity, uid)
+);
+"""
+
+
 def is_attachment(part):
     if part['content-disposition'] and part['content-disposition'].startswith('attachment'):
         return True
@@ -116,6 +199,9 @@ def extract_header(key, headers):
 
 
 def decode_string(string):
+    if isinstance(string, unicode):
+        # already decoded, like RFC 2231 encoded filenames
+        return string.encode('utf-8')
     result = ''
     try:
         for text, enc in decode_header(string):
@@ -128,19 +214,61 @@ def decode_string(string):
     return result
 
 
-def save_file(filename, data, *dirs):
-    path = options.outputdir
+def count(name, value=1):
+    """Add value to a counter of the run."""
+    with stats_lock:
+        stats[name] += value
+
+
+def folder_dirname(mailbox):
+    """Name of the directory of a folder in the output directory.
+
+    Characters other than letters, digits, dots, dashes and underscores are replaced, and a hash of the
+    name is added if anything was replaced, so different folders never share a directory.
+    >>> folder_dirname('INBOX'), folder_dirname('Archive/2009')
+    ('INBOX', 'Archive_2009-1bfa2ff9')
+    """
+    name = re.sub(r'[^A-Za-z0-9_.-]', '_', mailbox).lstrip('.')
+    if name != mailbox:
+        name += '-' + hashlib.md5(mailbox).hexdigest()[:8]
+    return name
+
+
+@contextmanager
+def folder_output(mailbox):
+    """Write the files of the calling thread to the directory of mailbox in the with block."""
+    path = os.path.join(options.outputdir, folder_dirname(mailbox))
+    if not os.path.isdir(path):
+        os.mkdir(path)
+    local.outputdir = path
+    try:
+        yield
+    finally:
+        local.outputdir = None
+
+
+def output_path(filename, *dirs):
+    path = getattr(local, 'outputdir', None) or options.outputdir
     for subdir in dirs:
         path = os.path.join(path, subdir)
         if not os.path.isdir(path):
             os.mkdir(path)
-    path = os.path.join(path, filename)
+    return os.path.join(path, filename)
 
-    fd = open(path, 'wb')
+
+def save_file(filename, data, *dirs):
+    fd = open(output_path(filename, *dirs), 'wb')
     fd.write(data)
     fd.close()
 
 
+def save_part(filename, part, *dirs):
+    """Decode the body of a mimestream part chunk by chunk into a file."""
+    fd = open(output_path(filename, *dirs), 'wb')
+    part.decode_to(fd)
+    fd.close()
+
+
 def process_options():
     """Process options passed via command line args."""
     global options
@@ -151,6 +279,8 @@ def process_options():
                     help="IMAP user")
     parser.add_option("--password", dest="password", type="string",
                     help="IMAP password")
+    parser.add_option("--port", dest="port", type="int",
+                    help="IMAP port (default: %d, or %d with --ssl)" % (IMAP4_PORT, IMAP4_SSL_PORT))
     parser.add_option("--ssl", dest="ssl", action="store_true", default=False,
                     help="use SSL")
     parser.add_option("--outputdir", dest="outputdir", type="string",
@@ -159,10 +289,27 @@ def process_options():
                     help="only check messages send before this date (format YYYY-MM-DD)")
     parser.add_option("--minsize", dest="minsize", type="int", default=0,
                     help="only check messages bigger than this size, in kB [%default]")
+    parser.add_option("--include", dest="include", action="append", metavar="PATTERN",
+                    help="archive the folders matching this shell pattern, may be given several times "
+                    "(default: INBOX)")
+    parser.add_option("--exclude", dest="exclude", action="append", default=[], metavar="PATTERN",
+                    help="skip the folders matching this shell pattern, may be given several times")
+    parser.add_option("--workers", dest="workers", type="int", default=1,
+                    help="number of IMAP sessions archiving folders at the same time [%default]")
+    parser.add_option("--full", dest="full", action="store_true", default=False,
+                    help="archive all messages again, not only the ones missing in the output directory")
     parser.add_option("--remove", dest="remove", action="store_true", default=False,
                     help="remove messages from server after processing")
+    parser.add_option("--page-size", dest="page_size", type="int", default=500,
+                    help="number of messages on a page of the message lists [%default]")
+    parser.add_option("--max-memory", dest="max_memory", type="int", default=256,
+                    help="memory budget per message, larger messages are spooled to disk, in MB [%default]")
+    parser.add_option("--jobs", dest="jobs", type="int", default=1,
+                    help="number of processes rendering messages while more are fetched [%default]")
     parser.add_option("--debug", dest="debug", action="store_true", default=False,
                     help="log debug messages")
+    instrument.add_options(parser)
+    throttle.add_options(parser)
 
     options, args = parser.parse_args()
 
@@ -179,15 +326,141 @@ def process_options():
     if not options.password:
         print 'Password option required, exit'
         sys.exit(1)
+    if options.page_size < 1:
+        print 'Page size must be at least 1, exit'
+        sys.exit(1)
+    if options.jobs < 1 or options.workers < 1:
+        print 'Jobs and workers must be at least 1, exit'
+        sys.exit(1)
+    if not options.include:
+        options.include = ['INBOX']
+
+
+def spool_threshold():
+    """Size above which message data is moved from memory to temporary files."""
+    return options.max_memory * 1024 * 1024 / 4
+
+
+def fetch_message(imap, uid, size=None):
+    """Fetch a message in chunks into a mimestream parser and return the parsed root part.
+
+    Every chunk is at most an eighth of the memory budget, so large messages never have to fit into memory.
+    size is the RFC822.SIZE of the message if known, it saves the final empty fetch. A partial fetch beyond
+    the end of the message may return an empty string or NIL instead of a literal, this ends the message.
+    """
+    parser = mimestream.StreamParser(spool_threshold())
+    chunk_size = max(spool_threshold() / 2, 64 * 1024)
+    offset = 0
+    while True:
+        with metrics.phase('fetch'):
+            typ, data = imap.uid('FETCH', uid, '(BODY[]<%d.%d>)' % (offset, chunk_size))
+        if typ != 'OK' or not data:
+            raise IMAP4.error('Unable to fetch message with uid %s' % uid)
+        chunk = ''
+        if isinstance(data[0], tuple):
+            chunk = data[0][1] or ''
+        with metrics.phase('parse'):
+            parser.feed(chunk)
+        offset += len(chunk)
+        if len(chunk) < chunk_size or (size and offset >= size):
+            break
+    with metrics.phase('parse'):
+        return parser.close()
+
+
+def parse_fetch_data(data):
+    """Return the (uid, size, body) tuples of the messages in the data of a UID FETCH response.
+
+    size is None without RFC822.SIZE, body None without BODY[].
+    >>> parse_fetch_data(['1 (UID 17 RFC822.SIZE 5)', ('2 (RFC822.SIZE 3 BODY[] {3}', 'bye'), ' UID 18)'])
+    [('17', 5, None), ('18', 3, 'bye')]
+    """
+    messages = []
+    for pos, item in enumerate(data):
+        body = None
+        if isinstance(item, tuple):
+            item, body = item
+            # the items after the body come as separate string
+            if pos + 1 < len(data) and isinstance(data[pos + 1], str):
+                item += data[pos + 1]
+        elif not isinstance(item, str) or item.startswith(')') or item.startswith(' '):
+            continue
+        uid = FETCH_UID.search(item)
+        size = FETCH_SIZE.search(item)
+        if uid:
+            messages.append((uid.group(1), size and int(size.group(1)), body))
+    return messages
+
+
+def fetch_messages(imap, uids):
+    """Fetch the messages with uids and generate (uid, data) tuples.
+
+    Small messages are fetched in batches with a single UID FETCH and data is the raw mail. Large messages
+    are fetched chunk by chunk with fetch_message() and data is the parsed root part. A batch is at most as
+    large as a chunk of a large message.
+    """
+    chunk_size = max(spool_threshold() / 2, 64 * 1024)
+    for start in range(0, len(uids), FETCH_BATCH_SIZE):
+        batch = uids[start:start + FETCH_BATCH_SIZE]
+        with metrics.phase('lookup'):
+            typ, data = imap.uid('FETCH', ','.join(batch), '(RFC822.SIZE)')
+        if typ != 'OK':
+            raise IMAP4.error('Unable to fetch the sizes of messages %s' % ','.join(batch))
+        sizes = dict((uid, size) for uid, size, body in parse_fetch_data(data))
+
+        large = []
+        small = []
+        total = 0
+        for uid in batch:
+            if sizes.get(uid) is None:
+                logging.warning('Message with uid %s is gone, skipping it', uid)
+            elif sizes[uid] > chunk_size:
+                large.append(uid)
+            else:
+                if total + sizes[uid] > chunk_size:
+                    for item in _fetch_small(imap, small):
+                        yield item
+                    small = []
+                    total = 0
+                small.append(uid)
+                total += sizes[uid]
+        for item in _fetch_small(imap, small):
+            yield item
+        for uid in large:
+            logging.debug('Fetch message with uid %s' % uid)
+            yield uid, fetch_message(imap, uid, sizes[uid])
+
+
+def _fetch_small(imap, uids):
+    """Fetch the raw mails of uids with a single UID FETCH and return a list of (uid, data) tuples."""
+    if not uids:
+        return []
+    logging.debug('Fetch messages with uids %s' % ','.join(uids))
+    with metrics.phase('fetch'):
+        typ, data = imap.uid('FETCH', ','.join(uids), '(BODY[])')
+    if typ != 'OK':
+        raise IMAP4.error('Unable to fetch messages %s' % ','.join(uids))
+    bodies = dict((uid, body) for uid, size, body in parse_fetch_data(data) if body is not None)
+    for uid in uids:
+        if uid not in bodies:
+            logging.warning('Message with uid %s is gone, skipping it', uid)
+    return [(uid, bodies[uid]) for uid in uids if uid in bodies]
 
 
 def parse_message(data):
-    "Parse raw mail into components"
+    """Parse raw mail into components.
+
+    data is either the raw mail or a mimestream part. Attachments are returned as (filename, part) tuples,
+    their payloads are only decoded when saved.
+    """
     text = []
     html = []
     headers = []
     attachments = []
-    message = email.message_from_string(data)
+    if isinstance(data, mimestream.StreamPart):
+        message = data
+    else:
+        message = mimestream.parse_string(data)
 
     for item in message.items():
         headers.append((item[0], decode_string(item[1])))
@@ -196,13 +469,13 @@ def parse_message(data):
         if part.get_content_maintype() == 'multipart':
             continue
         elif part.get_content_type() == 'text/plain' and not is_attachment(part):
-            payload = part.get_payload(decode=True)
+            payload = part.decoded_string()
             enc = part.get_content_charset(None)
             if enc and enc != 'utf-8':
                 payload = unicode(payload, enc, 'replace').encode('utf-8', 'replace')
             text.append(payload)
         elif part.get_content_type() == 'text/html' and not is_attachment(part):
-            html.append(part.get_payload(decode=True))
+            html.append(part.decoded_string())
         else:
             filename = part.get_filename()
             if filename:
@@ -213,96 +486,367 @@ def parse_message(data):
                 if not ext:
                     ext = '.bin'
                 filename = 'file' + ext
-            data = part.get_payload(decode=True)
-            if data:
-                attachments.append((filename, data))
+            if part.body_size() and not part.is_multipart():
+                attachments.append((filename, part))
 
     return ((text, html), headers, attachments)
 
 
 def process_message(uid, data):
-    message, headers, attachments = parse_message(data)
+    with metrics.phase('parse'):
+        message, headers, attachments = parse_message(data)
 
-    html = generate_message(message, headers, attachments)
-    save_file('message.html', html, str(uid))
+    with metrics.phase('render'):
+        html = generate_message(message, headers, attachments)
 
-    counter = 0
-    for item in message[1]:
-        save_file('original-html-%d.html' % counter, item, str(uid))
-        counter += 1
+    with metrics.phase('write'):
+        save_file('message.html', html, str(uid))
 
-    counter = 0
-    for item in attachments:
-        save_file(item[0], item[1], str(uid), 'part-' + str(counter))
-        counter += 1
+        counter = 0
+        for item in message[1]:
+            save_file('original-html-%d.html' % counter, item, str(uid))
+            counter += 1
+
+        counter = 0
+        for item in attachments:
+            save_part(item[0], item[1], str(uid), 'part-' + str(counter))
+            counter += 1
 
     return headers
 
 
-def process_overviews(msg_list):
-    file_id = 0
-    template = """
-    <a href="{filename}.html">{linkname}</a>({count})<br>
+def normalize_subject(subject):
+    """Strip reply and forward prefixes and redundant whitespace from a subject, so replies group with it.
+
+    >>> normalize_subject('Re: AW:  Fwd[2]: Rechnung   4711 ')
+    'Rechnung 4711'
+    >>> normalize_subject('Re: ')
+    '(No Subject)'
     """
+    subject = ' '.join(SUBJECT_PREFIX.sub('', subject).split())
+    return subject or '(No Subject)'
 
-    by_sender = {}
-    by_subject = {}
-    by_date = {}
 
-    for item in msg_list:
-        by_sender[item[1]] = by_sender.get(item[1], 0) + 1
-        by_subject[item[2]] = by_subject.get(item[2], 0) + 1
+def group_filename(kind, key):
+    """Name of the page of a group, the same for a group in every run.
 
-        strtime = time.strftime('%Y-%m-%d', item[3])
-        by_date[strtime] = by_date.get(strtime, 0) + 1
+    >>> group_filename('day', '2009-11-04')
+    'day-68ffceb918.html'
+    """
+    return '%s-%s.html' % (kind, hashlib.md5(key).hexdigest()[:10])
 
-    links = ''
-    for key, val in by_sender.iteritems():
-        sublist = filter(lambda x: x[1] == key, msg_list)
-        html = generate_list_of_messages(sublist, key)
-        save_file(str(file_id) + '.html', html)
 
-        links = links + template.format(filename=str(file_id),
-                                        linkname=cgi.escape(key),
-                                        count=val)
+class MessageIndex(object):
+    """The processed messages grouped by sender, subject, day, month and year in a single pass.
 
-        file_id = file_id + 1
+    Messages are (uid, sender, subject, date struct) tuples. messages and the groups of every kind in groups
+    (kind -> key -> list of messages) are sorted by date.
 
-    html = overview_template.format(body=links, title='Messages by sender')
-    save_file('by-sender.html', html)
+    >>> index = MessageIndex([('7', 'b@example.com', 'Re: Offer', time.gmtime(86400 * 40)),
+    ...                       ('3', 'a@example.com', 'Offer', time.gmtime(0))])
+    >>> [item[0] for item in index.groups['subject']['Offer']]
+    ['3', '7']
+    >>> sorted(index.groups['month']), sorted(index.groups['year'])
+    (['1970-01', '1970-02'], ['1970'])
+    """
 
-    links = ''
-    for key, val in by_subject.iteritems():
-        sublist = filter(lambda x: x[2] == key, msg_list)
-        html = generate_list_of_messages(sublist, key)
-        save_file(str(file_id) + '.html', html)
+    def __init__(self, msg_list):
+        self.messages = sorted(msg_list, key=lambda item: item[3])
+        self.groups = dict((kind, {}) for kind in GROUP_KINDS)
+        for item in self.messages:
+            for kind, key in zip(GROUP_KINDS, self.keys(item)):
+                self.groups[kind].setdefault(key, []).append(item)
+
+    @staticmethod
+    def keys(item):
+        """Return the keys of the groups of a message, one for every kind in GROUP_KINDS."""
+        day = time.strftime('%Y-%m-%d', item[3])
+        return (item[1], normalize_subject(item[2]), day, day[:7], day[:4])
+
+    def __len__(self):
+        return len(self.messages)
+
+
+class Manifest(object):
+    """The messages archived in an output directory, keyed by mailbox, UIDVALIDITY and UID.
+
+    It keeps the (uid, sender, subject, date struct) tuples the overview pages are made of, so a run only
+    needs to fetch the messages archived since the last one. Messages whose group pages have not been
+    written yet are pending. Every worker thread uses its own Manifest. Messages are committed as they are
+    added, so the workers never hold the lock of the manifest for long. Other changes become durable with
+    commit().
+
+    >>> manifest = Manifest(':memory:')
+    >>> manifest.open_mailbox('INBOX', 7)
+    set([])
+    >>> manifest.add('INBOX', ('12', 'a@example.com', 'Offer', time.gmtime(0)))
+    >>> manifest.open_mailbox('INBOX', 7)
+    set(['12'])
+    >>> [item[:3] for item in manifest.pending('INBOX')]
+    [('12', 'a@example.com', 'Offer')]
+    >>> manifest.page_size('INBOX') is None
+    True
+    >>> manifest.mark_rendered('INBOX', 500)
+    >>> manifest.pending('INBOX'), len(manifest.messages('INBOX')), manifest.page_size('INBOX')
+    ([], 1, 500)
+    >>> manifest.folders()
+    [('INBOX', 1)]
+    >>> manifest.forget('INBOX', ['12'])
+    >>> manifest.open_mailbox('INBOX', 7), manifest.page_size('INBOX') is None
+    (set([]), True)
+    >>> manifest.open_mailbox('INBOX', 8)
+    set([])
+    >>> manifest.page_size('INBOX') is None
+    True
+    """
 
-        links = links + template.format(filename=str(file_id),
-                                        linkname=cgi.escape(key),
-                                        count=val)
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=60)
+        # senders and subjects are utf-8 encoded str
+        self.conn.text_factory = str
+        self.conn.executescript(MANIFEST_SCHEMA)
+        self._upgrade()
+        self.uidvalidity = {}
+
+    def _upgrade(self):
+        """Add the page_size column to manifests written before it was kept per mailbox."""
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(mailboxes)")]
+        if 'page_size' in columns:
+            return
+        try:
+            with self.conn:
+                self.conn.execute("ALTER TABLE mailboxes ADD COLUMN page_size INTEGER")
+        except sqlite3.OperationalError:
+            # added by another worker meanwhile
+            if 'page_size' not in [row[1] for row in self.conn.execute("PRAGMA table_info(mailboxes)")]:
+                raise
+
+    def open_mailbox(self, mailbox, uidvalidity):
+        """Start archiving mailbox and return the set of its UIDs archived already.
+
+        Forgets all messages of the mailbox if its UIDVALIDITY has changed since they were archived.
+        """
+        uidvalidity = int(uidvalidity)
+        self.uidvalidity[mailbox] = uidvalidity
+        row = self.conn.execute("SELECT uidvalidity FROM mailboxes WHERE mailbox = ?", (mailbox, )).fetchone()
+        if row is None or row[0] != uidvalidity:
+            if row is not None:
+                logging.warning('UIDVALIDITY of %s changed, archiving all of its messages again', mailbox)
+            self.conn.execute("DELETE FROM messages WHERE mailbox = ?", (mailbox, ))
+            self.conn.execute("INSERT OR REPLACE INTO mailboxes (mailbox, uidvalidity) VALUES (?, ?)",
+                              (mailbox, uidvalidity))
+            self.conn.commit()
+        rows = self.conn.execute("SELECT uid FROM messages WHERE mailbox = ? AND uidvalidity = ?",
+                                 (mailbox, uidvalidity))
+        return set(str(uid) for uid, in rows)
+
+    def add(self, mailbox, item):
+        """Record an archived message, a (uid, sender, subject, date struct) tuple, as pending, and commit."""
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO messages (mailbox, uidvalidity, uid, sender, subject, "
+                              "date) VALUES (?, ?, ?, ?, ?, ?)",
+                              (mailbox, self.uidvalidity[mailbox], int(item[0]), item[1], item[2],
+                               calendar.timegm(item[3])))
+
+    def forget(self, mailbox, uids):
+        """Remove messages from mailbox, so they are archived again, and commit.
+
+        All pages of the mailbox are out of date then.
+        """
+        with self.conn:
+            self.conn.executemany("DELETE FROM messages WHERE mailbox = ? AND uidvalidity = ? AND uid = ?",
+                                  [(mailbox, self.uidvalidity[mailbox], int(uid)) for uid in uids])
+            self.conn.execute("UPDATE mailboxes SET page_size = NULL WHERE mailbox = ?", (mailbox, ))
+
+    def _select(self, mailbox, condition=''):
+        rows = self.conn.execute("SELECT uid, sender, subject, date FROM messages WHERE mailbox = ? AND "
+                                 "uidvalidity = ?" + condition, (mailbox, self.uidvalidity[mailbox]))
+        return [(str(uid), sender, subject, time.gmtime(date)) for uid, sender, subject, date in rows]
+
+    def messages(self, mailbox):
+        """Return all archived messages of mailbox."""
+        return self._select(mailbox)
+
+    def pending(self, mailbox):
+        """Return the messages of mailbox added since the last mark_rendered()."""
+        return self._select(mailbox, ' AND rendered = 0')
+
+    def mark_rendered(self, mailbox, page_size):
+        """Record that the pages of all messages of mailbox have been written with page_size, and commit."""
+        with self.conn:
+            self.conn.execute("UPDATE messages SET rendered = 1 WHERE mailbox = ? AND uidvalidity = ?",
+                              (mailbox, self.uidvalidity[mailbox]))
+            self.conn.execute("UPDATE mailboxes SET page_size = ? WHERE mailbox = ?", (page_size, mailbox))
+
+    def page_size(self, mailbox):
+        """Return the page size the list pages of mailbox were last written with, None if unknown."""
+        row = self.conn.execute("SELECT page_size FROM mailboxes WHERE mailbox = ?", (mailbox, )).fetchone()
+        return row and row[0]
+
+    def folders(self):
+        """Return (mailbox, number of messages) tuples for all archived mailboxes."""
+        rows = self.conn.execute("SELECT mailboxes.mailbox, COUNT(uid) FROM mailboxes LEFT JOIN messages "
+                                 "ON messages.mailbox = mailboxes.mailbox "
+                                 "AND messages.uidvalidity = mailboxes.uidvalidity "
+                                 "GROUP BY mailboxes.mailbox ORDER BY mailboxes.mailbox")
+        return rows.fetchall()
+
+    def commit(self):
+        """Make all recorded changes durable."""
+        self.conn.commit()
+
+    def close(self):
+        """Commit and close the manifest."""
+        self.conn.commit()
+        self.conn.close()
+
+
+def group_link(kind, key, messages):
+    """Return the link to the page of a group for the overview pages."""
+    return '<a href="%s">%s</a>(%d)' % (group_filename(kind, key), cgi.escape(key), len(messages))
+
+
+def render_message(uid, data):
+    """Parse and render a raw mail in a worker process.
+
+    Returns the seconds spent on parsing and rendering as list of (phase, seconds) tuples, the headers and
+    the files to write as (filename, data, dirs) tuples.
+    """
+    started = time.time()
+    message, headers, attachments = parse_message(data)
+    parsed = time.time()
+    files = [('message.html', generate_message(message, headers, attachments), (str(uid), ))]
+    for counter, item in enumerate(message[1]):
+        files.append(('original-html-%d.html' % counter, item, (str(uid), )))
+    for counter, (filename, part) in enumerate(attachments):
+        files.append((filename, part.decoded_string(), (str(uid), 'part-' + str(counter))))
+    return [('parse', parsed - started), ('render', time.time() - parsed)], headers, files
 
-        file_id = file_id + 1
 
-    html = overview_template.format(body=links, title='Messages by subject')
-    save_file('by-subject.html', html)
+class RenderPipeline(object):
+    """Renders raw mails on a pool of worker processes and writes the results on a thread of its own.
 
-    links = ''
-    for key, val in by_date.iteritems():
-        sublist = filter(lambda x: time.strftime('%Y-%m-%d', x[3]) == key, msg_list)
-        html = generate_list_of_messages(sublist, key)
-        save_file(str(file_id) + '.html', html)
+    The calling thread keeps fetching messages meanwhile. submit() blocks while twice as many messages as
+    there are workers are being rendered and as many are waiting to be written, so the number of messages in
+    memory is bounded.
+    """
 
-        links = links + template.format(filename=str(file_id),
-                                        linkname=cgi.escape(key),
-                                        count=val)
+    def __init__(self, pool, jobs, mailbox):
+        self.pool = pool
+        self.mailbox = mailbox
+        self.outputdir = getattr(local, 'outputdir', None)
+        self.limit = 2 * jobs
+        # (uid, AsyncResult) of the messages being rendered, oldest first
+        self.rendering = deque()
+        self.writing = Queue.Queue(jobs)
+        self.written = Queue.Queue()
+        self.writer = threading.Thread(target=self._write, name='writer')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def submit(self, uid, data):
+        """Render and write the raw mail data of uid."""
+        while len(self.rendering) >= self.limit:
+            self._collect()
+        self.rendering.append((uid, self.pool.apply_async(render_message, (uid, data))))
+
+    def _collect(self):
+        """Wait for the oldest message being rendered and pass it on to the writer."""
+        uid, result = self.rendering.popleft()
+        try:
+            with metrics.phase('wait'):
+                timings, headers, files = result.get()
+        except Exception, e:
+            logging.warning('Unable to process message with uid %s: %s' % (uid, e))
+            return
+        for phase, seconds in timings:
+            metrics.add_seconds(phase, seconds)
+        with metrics.phase('wait'):
+            self.writing.put((uid, headers, files))
+
+    def _write(self):
+        """Writer thread body: write the files of rendered messages until close() is called."""
+        local.outputdir = self.outputdir
+        with metrics.mailbox(self.mailbox):
+            while True:
+                item = self.writing.get()
+                if item is None:
+                    break
+                uid, headers, files = item
+                try:
+                    with metrics.phase('write'):
+                        for filename, data, dirs in files:
+                            save_file(filename, data, *dirs)
+                except (IOError, OSError), e:
+                    logging.warning('Unable to write message with uid %s: %s' % (uid, e))
+                else:
+                    self.written.put((uid, headers))
+
+    def done(self):
+        """Return the (uid, headers) tuples of the messages written since the last call."""
+        items = []
+        while True:
+            try:
+                items.append(self.written.get_nowait())
+            except Queue.Empty:
+                return items
+
+    def close(self):
+        """Wait until all submitted messages are written and return the ones done() did not return yet."""
+        while self.rendering:
+            self._collect()
+        self.writing.put(None)
+        self.writer.join()
+        return self.done()
 
-        file_id = file_id + 1
 
-    html = overview_template.format(body=links, title='Messages by date')
-    save_file('by-date.html', html)
+def process_overviews(msg_list, changed=None):
+    """Write the list of all messages, the overview pages and the pages of the groups.
 
-    html = generate_list_of_messages(msg_list, 'All messages')
-    save_file('index.html', html)
+    With a list of changed messages, only the pages of the groups they are in are written, the others are
+    left as they are. Returns the number of pages written.
+    """
+    index = MessageIndex(msg_list)
+    if changed is not None:
+        changed = set(group for item in changed for group in zip(GROUP_KINDS, MessageIndex.keys(item)))
+    pages = 0
+    for kind in GROUP_KINDS:
+        for key, messages in index.groups[kind].iteritems():
+            if changed is None or (kind, key) in changed:
+                pages += write_list_of_messages(group_filename(kind, key), messages, key)
+
+    for kind, title in (('sender', 'Messages by sender'), ('subject', 'Messages by subject')):
+        groups = index.groups[kind]
+        write_overview('by-%s.html' % kind, title, (group_link(kind, key, groups[key]) + '<br>\n'
+                                                    for key in sorted(groups, key=str.lower)))
+    write_overview('by-date.html', 'Messages by date', date_links(index))
+
+    pages += write_list_of_messages('index.html', index.messages, 'All messages')
+    return pages + 3
+
+
+def date_links(index):
+    """Generate the links of the by date overview: days under their months under their years."""
+    year = month = None
+    for day in sorted(index.groups['day']):
+        if day[:4] != year:
+            year = day[:4]
+            yield '<h2>%s</h2>\n' % group_link('year', year, index.groups['year'][year])
+        if day[:7] != month:
+            month = day[:7]
+            yield '<h3>%s</h3>\n' % group_link('month', month, index.groups['month'][month])
+        yield group_link('day', day, index.groups['day'][day]) + '<br>\n'
+
+
+def write_overview(filename, title, links):
+    """Write an overview page listing the html snippets of the iterable links."""
+    head, foot = overview_template.split('{body}')
+    fd = open(output_path(filename), 'wb')
+    fd.write(head.format(title=title))
+    for link in links:
+        fd.write(link)
+    fd.write(foot)
+    fd.close()
 
 
 def generate_message(message, headers, attachments):
@@ -356,24 +900,60 @@ def generate_message(message, headers, attachments):
                                     files=files)
 
 
-def generate_list_of_messages(msg_list, title=''):
-    """Generate a html representation of the message list."""
-    table = ''
-    template = """
-    <tr>
-        <td><a href="{id}/message.html">{sender}</a></td>
-        <td><a href="{id}/message.html">{subject}</a></td>
-        <td nowrap><a href="{id}/message.html">{date}</a></td>
-    </tr>
+def page_filename(filename, page):
+    """Name of page number page (counting from 1) of a list of messages.
+
+    >>> page_filename('index.html', 1), page_filename('index.html', 3)
+    ('index.html', 'index-3.html')
+    """
+    if page == 1:
+        return filename
+    base, ext = os.path.splitext(filename)
+    return '%s-%d%s' % (base, page, ext)
+
+
+def page_navigation(filename, page, pages, first, last, count):
+    """Return the links to the previous and next page and a summary of the page of a list.
+
+    first and last are the numbers of the first and last message on the page, count those of the list.
+    >>> for part in page_navigation('index.html', 2, 3, 501, 1000, 1200).split('&nbsp;|&nbsp;'):
+    ...     print part
+    <a href="index.html">&laquo; previous</a>
+    page 2 of 3, messages 501-1000 of 1200
+    <a href="index-3.html">next &raquo;</a>
     """
+    parts = []
+    if page > 1:
+        parts.append('<a href="%s">&laquo; previous</a>' % page_filename(filename, page - 1))
+    parts.append('page %d of %d, messages %d-%d of %d' % (page, pages, first, last, count))
+    if page < pages:
+        parts.append('<a href="%s">next &raquo;</a>' % page_filename(filename, page + 1))
+    return '&nbsp;|&nbsp;'.join(parts)
+
 
-    for item in msg_list:
-        table += template.format(id=item[0],
-                                sender=cgi.escape(item[1]),
-                                subject=cgi.escape(item[2]),
-                                date=time.strftime('%Y-%m-%d %H:%M', item[3]))
+def write_list_of_messages(filename, msg_list, title=''):
+    """Write the message list as html pages of options.page_size messages and return the number of pages.
 
-    return list_template.format(title=cgi.escape(title), table=table)
+    Rows are written out one by one, so the memory needed doesn't grow with the length of the list.
+    """
+    count = len(msg_list)
+    pages = max(1, (count + options.page_size - 1) // options.page_size)
+    head, foot = list_template.split('{table}')
+    items = iter(msg_list)
+    for page in range(1, pages + 1):
+        first = (page - 1) * options.page_size
+        last = min(first + options.page_size, count)
+        navigation = page_navigation(filename, page, pages, min(first + 1, count), last, count)
+        fd = open(output_path(page_filename(filename, page)), 'wb')
+        fd.write(head.format(title=cgi.escape(title), navigation=navigation))
+        for item in itertools.islice(items, last - first):
+            fd.write(list_row_template.format(id=item[0],
+                                              sender=cgi.escape(item[1]),
+                                              subject=cgi.escape(item[2]),
+                                              date=time.strftime('%Y-%m-%d %H:%M', item[3])))
+        fd.write(foot.format(navigation=navigation))
+        fd.close()
+    return pages
 
 
 def get_search_string():
@@ -395,14 +975,244 @@ def get_search_string():
     return search_str
 
 
-def main():
-    processed = []
-    uids = []
+def record_message(manifest, mailbox, uid, headers):
+    """Add an archived message to the manifest."""
+    subject_header = extract_header('Subject', headers)
+    if not subject_header:
+        subject_header = '(No Subject)'
+    date_struct = email.utils.parsedate(extract_header('Date', headers))
+    if not date_struct:
+        logging.warning('Unable to parse date for message with uid %s' % uid)
+        date_struct = time.gmtime(0)
+    manifest.add(mailbox, (uid,
+                           extract_header('From', headers),
+                           subject_header,
+                           date_struct))
+    count('fetched_messages')
+
+
+def archive_mailbox(imap, search_str, manifest, pool=None, mailbox='INBOX'):
+    """Archive the messages of mailbox matching search_str that are not in the manifest yet.
+
+    With a pool of worker processes, messages are parsed and rendered by the workers while the next ones are
+    fetched.
+    """
+    with metrics.phase('select'):
+        typ, data = imap.select(mailbox)
+    if typ != 'OK':
+        raise IMAP4.error('Unable to select %s: %s' % (mailbox, data))
+    uidvalidity = imap.response('UIDVALIDITY')[1][0]
+    if uidvalidity is None:
+        raise IMAP4.error('Server did not report the UIDVALIDITY of %s' % mailbox)
+    archived = manifest.open_mailbox(mailbox, uidvalidity)
+    # output directories of the single folder layout have the messages of INBOX at the top level
+    missing = [uid for uid in archived if not os.path.exists(os.path.join(output_path(uid), 'message.html'))]
+    if missing:
+        logging.warning('%d archived messages of %s are missing from the output directory, archiving them '
+                        'again', len(missing), mailbox)
+        manifest.forget(mailbox, missing)
+        archived.difference_update(missing)
+    if options.full:
+        archived = set()
+
+    with metrics.phase('search'):
+        typ, data = imap.uid('SEARCH', search_str)
+    if typ != 'OK':
+        raise IMAP4.error('Unable to search %s: %s' % (mailbox, data))
+    found = data[0].split()
+    uids = [uid for uid in found if uid not in archived]
+    logging.info('%d of %d messages in %s are archived already', len(found) - len(uids), len(found), mailbox)
+    count('archived_messages', len(found) - len(uids))
+    metrics.expect(len(uids), 0)
+
+    pipeline = pool and RenderPipeline(pool, options.jobs, mailbox)
+    try:
+        for uid, message in fetch_messages(imap, uids):
+            if pipeline and isinstance(message, str):
+                pipeline.submit(uid, message)
+                metrics.message_done(len(message))
+            else:
+                # large messages are spooled to disk, they are processed right away
+                try:
+                    headers = process_message(uid, message)
+                except:
+                    logging.warning('Unable to process message with uid %s: %s' % (uid, sys.exc_info()[1]))
+                else:
+                    record_message(manifest, mailbox, uid, headers)
+                    archived.add(uid)
+                metrics.message_done(isinstance(message, str) and len(message) or message.body_end)
+            for uid, headers in pipeline and pipeline.done() or []:
+                record_message(manifest, mailbox, uid, headers)
+                archived.add(uid)
+    finally:
+        for uid, headers in pipeline and pipeline.close() or []:
+            record_message(manifest, mailbox, uid, headers)
+            archived.add(uid)
+        manifest.commit()
+
+    with metrics.phase('overview'):
+        started = time.time()
+        changed = manifest.pending(mailbox)
+        if options.full or manifest.page_size(mailbox) != options.page_size:
+            # all pages are out of date
+            changed = None
+        if changed != []:
+            msg_list = manifest.messages(mailbox)
+            pages = process_overviews(msg_list, changed)
+            manifest.mark_rendered(mailbox, options.page_size)
+            count('overview_pages', pages)
+            logging.info('Wrote %d overview pages for %d messages in %.1fs', pages, len(msg_list),
+                         time.time() - started)
+
+    # remove archived messages
+    if options.remove:
+        with metrics.phase('expunge'):
+            for uid in found:
+                if uid in archived:
+                    imap.uid('STORE', uid, '+FLAGS', '(\\Deleted)')
+                    logging.debug('Delete message with uid %s' % uid)
+            imap.expunge()
+
 
+def parse_list_response(item):
+    """Return the name of the mailbox in a LIST response, None if it can't be selected.
+
+    >>> parse_list_response('(\\\\HasNoChildren) "/" "Archive/2009"')
+    'Archive/2009'
+    >>> parse_list_response('(\\\\Noselect \\\\HasChildren) "/" "[Gmail]"') is None
+    True
+    >>> parse_list_response(('() "." {6}', 'Sent "'))
+    'Sent "'
+    """
+    literal = None
+    if isinstance(item, tuple):
+        item, literal = item
+    match = LIST_RESPONSE.match(item or '')
+    if match is None:
+        logging.warning('Unrecognised LIST response: %r' % (item, ))
+        return None
+    if '\\noselect' in match.group('flags').lower():
+        return None
+    if literal is not None:
+        return literal
+    name = match.group('name')
+    if name.startswith('"'):
+        name = re.sub(r'\\(.)', r'\1', name[1:-1])
+    return name
+
+
+def select_folders(names, include, exclude):
+    """Return the folders in names matching a pattern of include and none of exclude.
+
+    The patterns are those of the attachment policies (see policy.glob_regex()), brackets match themselves.
+    >>> select_folders(['INBOX', 'Sent', 'Archive/2008', 'Archive/2009'], ['INBOX', 'Archive/*'],
+    ...                ['*/2008'])
+    ['INBOX', 'Archive/2009']
+    >>> select_folders(['INBOX', '[Gmail]/Sent Mail', '[Gmail]/Trash'], ['*'], ['[Gmail]/Trash'])
+    ['INBOX', '[Gmail]/Sent Mail']
+    """
+    include = policy.glob_regex(include)
+    exclude = policy.glob_regex(exclude)
+    return [name for name in names
+            if include is not None and include.match(name) and not (exclude and exclude.match(name))]
+
+
+def connect():
+    """Open an IMAP session and log in."""
+    if options.ssl:
+        imap = IMAP4_SSL(options.server, options.port or IMAP4_SSL_PORT)
+    else:
+        imap = IMAP4(options.server, options.port or IMAP4_PORT)
+    instrument.instrument_imap(imap, metrics)
+    throttle.govern_imap(imap, governor)
+    imap.login(options.user, options.password)
+    return imap
+
+
+def list_folders(imap):
+    """Return the folders to archive, in the order the server lists them."""
+    with metrics.phase('list'):
+        typ, data = imap.list()
+    if typ != 'OK':
+        raise IMAP4.error('Unable to list the folders: %s' % data)
+    names = [parse_list_response(item) for item in data if item is not None]
+    return select_folders([name for name in names if name is not None], options.include, options.exclude)
+
+
+def archive_folders(imap, queue, search_str, pool, results):
+    """Worker thread body: archive the folders from queue until it is empty.
+
+    imap is the session of the worker, None to open one. The wall-clock seconds spent on every folder, or
+    None if it failed, are added to the dict results.
+    """
+    manifest = Manifest(os.path.join(options.outputdir, MANIFEST_NAME))
+    try:
+        while True:
+            with governor.session():
+                try:
+                    mailbox = queue.get_nowait()
+                except Queue.Empty:
+                    break
+                started = time.time()
+                try:
+                    if imap is None:
+                        imap = connect()
+                    with metrics.mailbox(mailbox):
+                        with folder_output(mailbox):
+                            archive_mailbox(imap, search_str, manifest, pool, mailbox)
+                    imap.close()
+                    results[mailbox] = time.time() - started
+                except (IMAP4.error, socket.error, IOError, OSError, sqlite3.Error), e:
+                    logging.error('Unable to archive %s: %s' % (mailbox, e))
+                    results[mailbox] = None
+                    if isinstance(e, (IMAP4.abort, socket.error)):
+                        # the session is gone, the next folder gets a new one
+                        imap = None
+    finally:
+        manifest.close()
+        if imap is not None:
+            try:
+                imap.logout()
+            except (IMAP4.error, socket.error):
+                pass
+
+
+def write_folder_index(manifest):
+    """Write the top level index.html listing the archived folders."""
+    template = """
+    <a href="{dir}/index.html">{name}</a>({count})&nbsp;
+    <a href="{dir}/by-sender.html">by sender</a>&nbsp;|&nbsp;
+    <a href="{dir}/by-subject.html">by subject</a>&nbsp;|&nbsp;
+    <a href="{dir}/by-date.html">by date</a><br>
+    """
+    write_overview('index.html', 'Folders', (template.format(dir=urllib.pathname2url(folder_dirname(name)),
+                                                             name=cgi.escape(name), count=count)
+                                             for name, count in manifest.folders()))
+
+
+def log_folder_summary(results):
+    """Log the throughput of every folder archived in this run."""
+    summary = metrics.summary()['mailboxes']
+    for mailbox, seconds in sorted(results.items()):
+        if seconds is None:
+            logging.info('Folder %s failed' % mailbox)
+            continue
+        counters = summary.get(mailbox, {})
+        messages = counters.get('messages', 0)
+        size = counters.get('message_bytes', 0)
+        seconds = max(seconds, 0.001)
+        logging.info('Folder %s: %d messages, %s in %s, %.1f messages/s, %s/s' % (
+            mailbox, messages, instrument.format_size(size), instrument.format_duration(seconds),
+            messages / seconds, instrument.format_size(size / seconds)))
+
+
+def main():
     process_options()
+    global metrics, governor
+    metrics = instrument.from_options('imap2html', options)
+    governor = throttle.from_options(options, options.workers)
 
-    if options.debug:
-        logging.basicConfig(level=logging.DEBUG)
+    logging.basicConfig(level=options.debug and logging.DEBUG or logging.INFO)
 
     if not os.path.isdir(options.outputdir):
         try:
@@ -414,54 +1224,34 @@ def main():
     search_str = get_search_string()
     logging.debug('IMAP search string is %s' % search_str)
 
-    try:
-        if options.ssl:
-            imap = IMAP4_SSL(options.server)
-        else:
-            imap = IMAP4(options.server)
-        imap.login(options.user, options.password)
-        imap.select()
-
-        typ, msg_nums = imap.search(None, search_str)
-
-        # fetch messages uids
-        for num in msg_nums[0].split():
-            typ, msg = imap.fetch(num, '(UID)')
-            if typ != 'OK':
-                logging.warning('Unable to fetch uid, skipping message %s', num)
-                continue
-            m = re.match(r".*UID\s+(\d+).*", msg[0])
-            uids.append(m.groups()[0])
-
-        for uid in uids:
-            typ, data = imap.uid('FETCH', uid, '(RFC822)')
-            logging.debug('Fetch message with uid %s' % uid)
+    pool = None
+    if options.jobs > 1:
+        # started before connecting, so the workers don't inherit the IMAP connection
+        pool = multiprocessing.Pool(options.jobs)
 
-            try:
-                headers = process_message(uid, data[0][1])
-            except:
-                logging.warning('Unable to process message with uid %s: %s' % (uid, sys.exc_info()[1]))
-            else:
-                subject_header = extract_header('Subject', headers)
-                if not subject_header:
-                    subject_header = '(No Subject)'
-                date_struct = email.utils.parsedate(extract_header('Date', headers))
-                if not date_struct:
-                    logging.warning('Unable to parse date for message with uid %s' % uid)
-                    date_struct = time.gmtime(0)
-                processed.append((uid,
-                                extract_header('From', headers),
-                                subject_header,
-                                date_struct))
-
-        process_overviews(processed)
-
-        # remove processed messages
-        if options.remove:
-            for item in processed:
-                imap.uid('STORE', item[0], '+FLAGS', '(\\Deleted)')
-                logging.debug('Delete message with uid %s' % item[0])
-            imap.expunge()
+    results = {}
+    try:
+        imap = connect()
+        folders = list_folders(imap)
+        logging.info('Archiving %d folders: %s' % (len(folders), ', '.join(folders)))
+        queue = Queue.Queue()
+        for mailbox in folders:
+            queue.put(mailbox)
+        workers = min(options.workers, len(folders)) or 1
+        governor.set_max_sessions(workers)
+        threads = []
+        for num in range(workers):
+            thread = threading.Thread(target=archive_folders, name='worker-%d' % num,
+                                      args=(num == 0 and imap or None, queue, search_str, pool, results))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        manifest = Manifest(os.path.join(options.outputdir, MANIFEST_NAME))
+        write_folder_index(manifest)
+        manifest.close()
+        log_folder_summary(results)
 
     except socket.error, e:
         logging.critical('Unable to connect to the IMAP server: %s' % str(e))
@@ -475,9 +1265,15 @@ def main():
     except IOError as (errno, strerror):
         logging.critical('IO error({0}): {1}'.format(errno, strerror))
         sys.exit(1)
-
-    imap.close()
-    imap.logout()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        stats['folders'] = len(results)
+        stats['failed_folders'] = len([mailbox for mailbox in results if results[mailbox] is None])
+        instrument.write_outputs(metrics, options, stats)
+
+    if stats['failed_folders']:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+# Copyright HUDORA GmbH 2009
+
+"""Run time instrumentation shared by the IMAP tools.
+
+A Metrics object times the phases of a run (SEARCH, metadata lookup, body fetch, MIME parsing, CouchDB
+upload, APPEND, EXPUNGE, ...) and counts the IMAP commands and the bytes sent and received in each of them,
+per mailbox and in total. Phase times are exclusive: while a nested phase runs, the time goes to it alone.
+Time spent in a mailbox outside of any phase counts as phase "other", so the phase times of a mailbox add up
+to the time spent in it.
+
+    metrics = Metrics('removeattachments', progress_interval=60)
+    instrument_imap(imap, metrics)
+    with metrics.mailbox('INBOX'):
+        with metrics.phase('search'):
+            imap.uid('SEARCH', None, 'ALL')
+        metrics.expect(2, 2048)
+        ...
+        metrics.message_done(1024)
+    metrics.finish()
+    metrics.write_json('run.json')
+    metrics.write_prometheus('/var/lib/node_exporter/removeattachments.prom')
+
+The Prometheus file is meant for the textfile collector of the node exporter. Commands sent outside of any
+mailbox (LOGIN, LIST, ...) belong to mailbox "".
+
+>>> metrics = Metrics('test')
+>>> with metrics.mailbox('INBOX'):
+...     with metrics.phase('fetch'):
+...         metrics.imap_command()
+...         metrics.imap_bytes(received=100)
+...     metrics.message_done(100)
+>>> summary = metrics.summary()
+>>> summary['total']['commands'], summary['total']['bytes_received'], summary['total']['messages']
+(1, 100, 1)
+>>> sorted(summary['mailboxes']['INBOX']['phases'])
+['fetch', 'other']
+"""
+
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# counters kept for every mailbox and phase
+PHASE_COUNTERS = ('seconds', 'calls', 'commands', 'bytes_sent', 'bytes_received')
+# counters kept for every mailbox
+MAILBOX_COUNTERS = ('messages', 'message_bytes', 'expected_messages', 'expected_bytes')
+
+# phase of the time and IMAP commands outside of any other phase
+OTHER_PHASE = 'other'
+
+
+def format_size(num):
+    """Format a byte count for humans.
+
+    >>> format_size(512)
+    '512 B'
+    >>> format_size(1536)
+    '1.5 kB'
+    >>> format_size(30 * 1024 ** 3)
+    '30.0 GB'
+    """
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if num < 1024 or unit == 'GB':
+            break
+        num /= 1024.0
+    if unit == 'B':
+        return '%d B' % num
+    return '%.1f %s' % (num, unit)
+
+
+def format_duration(seconds):
+    """Format a duration in seconds for humans.
+
+    >>> format_duration(42)
+    '42s'
+    >>> format_duration(7384)
+    '2h03m'
+    """
+    seconds = int(seconds)
+    if seconds < 60:
+        return '%ds' % seconds
+    if seconds < 3600:
+        return '%dm%02ds' % (seconds // 60, seconds % 60)
+    return '%dh%02dm' % (seconds // 3600, seconds % 3600 // 60)
+
+
+def prometheus_labels(labels):
+    """Format a list of (name, value) tuples as label set of the Prometheus text format.
+
+    >>> prometheus_labels([('tool', 'imap2html'), ('mailbox', 'Sent "old"\\\\x')])
+    '{tool="imap2html",mailbox="Sent \\\\"old\\\\"\\\\\\\\x"}'
+    """
+    escaped = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append('%s="%s"' % (name, value))
+    return '{' + ','.join(escaped) + '}'
+
+
+def write_atomically(path, text):
+    """Replace the file at path with text, so readers never see a partially written file."""
+    directory = os.path.dirname(os.path.abspath(path))
+    out = tempfile.NamedTemporaryFile(dir=directory, prefix='.' + os.path.basename(path), delete=False)
+    try:
+        out.write(text)
+        out.close()
+        os.rename(out.name, path)
+    except:
+        out.close()
+        os.unlink(out.name)
+        raise
+
+
+class Metrics(object):
+    """Phase timings and IMAP traffic of a run, see the module documentation.
+
+    A Metrics object may be shared by threads. The current mailbox and phase are kept per thread, so every
+    thread should work on its own IMAP session. With a progress_interval (in seconds), message_done() writes a
+    line with the throughput and the estimated time left to progress_out at most that often. labels are
+    (name, value) tuples added to every Prometheus series, to tell the runs of several accounts apart.
+    """
+
+    def __init__(self, tool, progress_interval=0, progress_out=None, labels=None):
+        self.tool = tool
+        self.labels = list(labels or [])
+        self.progress_interval = progress_interval
+        self.progress_out = progress_out or sys.stderr
+        self.started = time.time()
+        self.finished = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # (mailbox, phase) -> counter -> value
+        self.phases = defaultdict(lambda: defaultdict(int))
+        # mailbox -> counter -> value
+        self.mailboxes = defaultdict(lambda: defaultdict(int))
+        self.last_progress = self.started
+
+    def _stack(self):
+        """Return the [phase, started] entries of the phases running in the calling thread."""
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def _current(self):
+        """Return the (mailbox, phase) the calling thread is working on."""
+        stack = self._stack()
+        return getattr(self.local, 'mailbox', ''), stack and stack[-1][0] or OTHER_PHASE
+
+    def _add(self, key, counter, value):
+        with self.lock:
+            self.phases[key][counter] += value
+
+    @contextmanager
+    def mailbox(self, name):
+        """Attribute everything the calling thread does in the with block to mailbox name."""
+        self.local.mailbox = name
+        with self.lock:
+            self.mailboxes[name]
+        try:
+            with self.phase(OTHER_PHASE):
+                yield
+        finally:
+            self.local.mailbox = ''
+
+    @contextmanager
+    def phase(self, name):
+        """Time the with block as phase name, pausing the phase it is nested in."""
+        stack = self._stack()
+        now = time.time()
+        if stack:
+            self._add(self._current(), 'seconds', now - stack[-1][1])
+        stack.append([name, now])
+        self._add(self._current(), 'calls', 1)
+        try:
+            yield
+        finally:
+            now = time.time()
+            self._add(self._current(), 'seconds', now - stack[-1][1])
+            stack.pop()
+            if stack:
+                stack[-1][1] = now
+
+    def add_seconds(self, name, seconds):
+        """Count seconds spent on phase name for the current mailbox elsewhere, e.g. in a worker process."""
+        key = (self._current()[0], name)
+        with self.lock:
+            self.phases[key]['seconds'] += seconds
+            self.phases[key]['calls'] += 1
+
+    def imap_command(self):
+        """Count an IMAP command (a round trip) in the current mailbox and phase."""
+        self._add(self._current(), 'commands', 1)
+
+    def imap_bytes(self, sent=0, received=0):
+        """Count bytes sent to and received from the IMAP server in the current mailbox and phase."""
+        key = self._current()
+        with self.lock:
+            self.phases[key]['bytes_sent'] += sent
+            self.phases[key]['bytes_received'] += received
+
+    def expect(self, messages, size):
+        """Announce messages (of size bytes in total, 0 if unknown) to be processed in the current mailbox.
+
+        The ETA of the progress lines is based on the announced sizes, or on the message count without them.
+        """
+        mailbox = self._current()[0]
+        with self.lock:
+            self.mailboxes[mailbox]['expected_messages'] += messages
+            self.mailboxes[mailbox]['expected_bytes'] += size
+
+    def message_done(self, size):
+        """Count a processed message of size bytes in the current mailbox, and report progress if due."""
+        mailbox = self._current()[0]
+        now = time.time()
+        with self.lock:
+            self.mailboxes[mailbox]['messages'] += 1
+            self.mailboxes[mailbox]['message_bytes'] += size or 0
+            report = self.progress_interval and now - self.last_progress >= self.progress_interval
+            if report:
+                self.last_progress = now
+        if report:
+            self.report_progress(mailbox)
+
+    def _totals(self):
+        """Return the sums of the mailbox counters over all mailboxes."""
+        totals = defaultdict(int)
+        with self.lock:
+            for counters in self.mailboxes.values():
+                for counter in MAILBOX_COUNTERS:
+                    totals[counter] += counters[counter]
+        return totals
+
+    def report_progress(self, mailbox=None):
+        """Write a progress line with throughput and ETA over all mailboxes to progress_out."""
+        totals = self._totals()
+        elapsed = max(time.time() - self.started, 0.001)
+        rate = totals['message_bytes'] / elapsed
+        line = "%s: %d/%d messages, %.1f messages/s, %s/s" % (
+            self.tool, totals['messages'], totals['expected_messages'], totals['messages'] / elapsed,
+            format_size(rate))
+        if totals['expected_bytes']:
+            left = totals['expected_bytes'] - totals['message_bytes']
+        else:
+            # message sizes unknown up front
+            rate = totals['messages'] / elapsed
+            left = totals['expected_messages'] - totals['messages']
+        if rate and left > 0:
+            line += ", ETA %s" % format_duration(left / rate)
+        if mailbox:
+            line += " (in %s)" % mailbox
+        self.progress_out.write(line + '\n')
+        self.progress_out.flush()
+
+    def finish(self):
+        """Stop the clock of the run."""
+        self.finished = time.time()
+
+    def summary(self):
+        """Return the metrics as dict with the keys tool, started, seconds, total, phases and mailboxes.
+
+        total holds the summed counters of all phases and mailboxes. phases maps phase names to their
+        counters summed over all mailboxes. mailboxes maps mailbox names to their counters, including a
+        phases dict of their own.
+        """
+        end = self.finished or time.time()
+        total = dict((counter, 0) for counter in PHASE_COUNTERS + MAILBOX_COUNTERS)
+        phases = {}
+        mailboxes = {}
+        with self.lock:
+            for name, counters in self.mailboxes.items():
+                mailboxes[name] = dict((counter, counters[counter]) for counter in MAILBOX_COUNTERS)
+                mailboxes[name]['phases'] = {}
+            for (name, phase), counters in self.phases.items():
+                entry = mailboxes.setdefault(name, dict((counter, 0) for counter in MAILBOX_COUNTERS))
+                entry.setdefault('phases', {})[phase] = dict((counter, counters[counter])
+                                                             for counter in PHASE_COUNTERS)
+                merged = phases.setdefault(phase, dict((counter, 0) for counter in PHASE_COUNTERS))
+                for counter in PHASE_COUNTERS:
+                    merged[counter] += counters[counter]
+                    entry[counter] = entry.get(counter, 0) + counters[counter]
+        for entry in mailboxes.values():
+            for counter in PHASE_COUNTERS + MAILBOX_COUNTERS:
+                entry.setdefault(counter, 0)
+                total[counter] += entry[counter]
+        return {'tool': self.tool, 'started': self.started, 'seconds': end - self.started,
+                'total': total, 'phases': phases, 'mailboxes': mailboxes}
+
+    def log_summary(self):
+        """Log the time, round trips and traffic of every phase."""
+        summary = self.summary()
+        for phase, counters in sorted(summary['phases'].items(), key=lambda item: -item[1]['seconds']):
+            logging.info("Phase %-10s %9.1fs %7d commands, %s sent, %s received", phase, counters['seconds'],
+                         counters['commands'], format_size(counters['bytes_sent']),
+                         format_size(counters['bytes_received']))
+
+    def write_json(self, path, extra=None):
+        """Write the summary() as JSON to path ('-' for stdout), with the dict extra under "counters"."""
+        summary = self.summary()
+        if extra is not None:
+            summary['counters'] = dict(extra)
+        text = json.dumps(summary, indent=2, sort_keys=True) + '\n'
+        if path == '-':
+            sys.stdout.write(text)
+        else:
+            write_atomically(path, text)
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text exposition format.
+
+        >>> metrics = Metrics('test', labels=[('account', 'joe')])
+        >>> [line for line in metrics.prometheus().splitlines() if line.startswith('mailtools_run_seconds')]
+        ... # doctest: +ELLIPSIS
+        ['mailtools_run_seconds{tool="test",account="joe"} ...']
+        """
+        summary = self.summary()
+        tool = [('tool', self.tool)] + self.labels
+        lines = []
+
+        def metric(name, kind, description, samples):
+            lines.append('# HELP mailtools_%s %s' % (name, description))
+            lines.append('# TYPE mailtools_%s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('mailtools_%s%s %r' % (name, prometheus_labels(tool + labels), float(value)))
+
+        phases = [(mailbox, phase, counters) for mailbox, entry in sorted(summary['mailboxes'].items())
+                  for phase, counters in sorted(entry['phases'].items())]
+        metric('run_seconds', 'gauge', 'Duration of the last run.', [([], summary['seconds'])])
+        metric('run_start_timestamp_seconds', 'gauge', 'Start of the last run.', [([], summary['started'])])
+        metric('phase_seconds', 'gauge', 'Time spent in a phase of the last run.',
+               [([('mailbox', mailbox), ('phase', phase)], counters['seconds'])
+                for mailbox, phase, counters in phases])
+        metric('imap_commands', 'gauge', 'IMAP commands sent in a phase of the last run.',
+               [([('mailbox', mailbox), ('phase', phase)], counters['commands'])
+                for mailbox, phase, counters in phases])
+        metric('imap_bytes', 'gauge', 'Bytes exchanged with the IMAP server in a phase of the last run.',
+               [([('mailbox', mailbox), ('phase', phase), ('direction', direction)],
+                 counters['bytes_' + direction])
+                for mailbox, phase, counters in phases for direction in ('sent', 'received')])
+        metric('messages', 'gauge', 'Messages processed in the last run.',
+               [([('mailbox', mailbox)], entry['messages'])
+                for mailbox, entry in sorted(summary['mailboxes'].items())])
+        metric('message_bytes', 'gauge', 'Size of the messages processed in the last run.',
+               [([('mailbox', mailbox)], entry['message_bytes'])
+                for mailbox, entry in sorted(summary['mailboxes'].items())])
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """Write the metrics as Prometheus textfile to path."""
+        write_atomically(path, self.prometheus())
+
+
+def instrument_imap(imap, metrics):
+    """Count the commands and the bytes sent and received by an imaplib session in metrics.
+
+    Wraps the methods imaplib uses internally for every command and all socket I/O on the instance, so
+    commands sent by hand with _new_tag() and send() are counted as well.
+    """
+    new_tag, send, read, readline = imap._new_tag, imap.send, imap.read, imap.readline
+
+    def counting_new_tag():
+        metrics.imap_command()
+        return new_tag()
+
+    def counting_send(data):
+        metrics.imap_bytes(sent=len(data))
+        return send(data)
+
+    def counting_read(size):
+        data = read(size)
+        metrics.imap_bytes(received=len(data))
+        return data
+
+    def counting_readline():
+        line = readline()
+        metrics.imap_bytes(received=len(line))
+        return line
+
+    imap._new_tag = counting_new_tag
+    imap.send = counting_send
+    imap.read = counting_read
+    imap.readline = counting_readline
+    return imap
+
+
+def add_options(parser):
+    """Add the instrumentation options to an optparse parser, see from_options()."""
+    parser.add_option("--metrics-json", help="Write phase timings and IMAP traffic as JSON to this file at "
+                      "the end of the run ('-' for stdout)")
+    parser.add_option("--metrics-prom", help="Write phase timings and IMAP traffic as Prometheus textfile "
+                      "to this file at the end of the run")
+    parser.add_option("--progress", type="int", default=0,
+                      help="Print throughput and ETA every this many seconds (0 to disable) [%default]")
+
+
+def from_options(tool, options, labels=None):
+    """Return the Metrics object for the options added by add_options(), see Metrics for labels."""
+    return Metrics(tool, progress_interval=options.progress, labels=labels)
+
+
+def write_outputs(metrics, options, extra=None):
+    """Finish the run and write the files requested with the options added by add_options()."""
+    metrics.finish()
+    if options.metrics_json:
+        metrics.write_json(options.metrics_json, extra)
+    if options.metrics_prom:
+        metrics.write_prometheus(options.metrics_prom)
@@ -0,0 +1,164 @@
+#!/opt/bin/python
+# -*- coding: utf-8 -*-
+# Copyright HUDORA GmbH 2009
+
+"""Local processing journal for RemoveAttachments.
+
+The journal is a SQLite database remembering what happened to every message that was looked at, keyed by
+account, mailbox, UIDVALIDITY and UID. UIDs are only meaningful together with the UIDVALIDITY of their
+mailbox, so all entries of a mailbox are dropped when its UIDVALIDITY changes.
+
+Changes are kept in memory until commit() writes them in a single short transaction. Several workers and
+processes can share a journal file without waiting for each other's locks.
+
+>>> journal = Journal(':memory:', 'user@imap.example.com:993')
+>>> journal.open_mailbox('INBOX', 1000) is None
+True
+>>> journal.record('INBOX', '17', SKIPPED)
+>>> journal.record_many('INBOX', ['20', '21'], REWRITTEN)
+>>> journal.finish_mailbox('INBOX', 22)
+>>> journal.states('INBOX')
+{}
+>>> journal.commit()
+>>> sorted(journal.states('INBOX').items())
+[(17, 'skipped'), (20, 'rewritten'), (21, 'rewritten')]
+>>> journal.mark_expunged('INBOX')
+>>> journal.commit()
+>>> sorted(journal.states('INBOX').items())
+[(17, 'skipped'), (20, 'expunged'), (21, 'expunged')]
+>>> journal.open_mailbox('INBOX', 1000)
+22
+>>> journal.open_mailbox('INBOX', 1001, readonly=True) is None
+True
+>>> journal.states('INBOX')
+{}
+>>> journal.open_mailbox('INBOX', 1000, readonly=True)
+22
+>>> journal.open_mailbox('INBOX', 1001) is None
+True
+>>> journal.states('INBOX')
+{}
+"""
+
+import logging
+import sqlite3
+from datetime import datetime
+
+# the message has no attachments
+SKIPPED = 'skipped'
+# the attachments are stored in CouchDB, the message itself is unchanged
+ARCHIVED = 'archived'
+# a copy without attachments was appended, the original is not deleted yet
+APPENDED = 'appended'
+# a copy without attachments was appended, the original is flagged \Deleted
+REWRITTEN = 'rewritten'
+# the original was expunged
+EXPUNGED = 'expunged'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mailboxes (
+    account TEXT NOT NULL,
+    mailbox TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    uidnext INTEGER,
+    PRIMARY KEY (account, mailbox)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    account TEXT NOT NULL,
+    mailbox TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    uid INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    updated TEXT NOT NULL,
+    PRIMARY KEY (account, mailbox, uidvalidity, uid)
+);
+"""
+
+
+class Journal(object):
+    """Processing journal of a single IMAP account.
+
+    Changes are written and become durable with commit(), except for open_mailbox() which commits at once.
+    Every RemoveAttachments worker uses its own Journal instance, a mailbox has to be opened with
+    open_mailbox() before its messages are looked up or recorded.
+    """
+
+    def __init__(self, path, account):
+        # workers are created by the main thread but each one only uses its connection from its own thread
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        self.account = account
+        self.uidvalidity = {}
+        # (statement, parameter rows) tuples waiting for commit()
+        self.pending = []
+
+    def open_mailbox(self, mailbox, uidvalidity, readonly=False):
+        """Start working on mailbox and return the UIDNEXT recorded by the last complete run, or None.
+
+        Invalidates all entries of the mailbox if its UIDVALIDITY has changed since they were recorded.
+        With readonly the journal is only looked up and never changed, entries recorded under a different
+        UIDVALIDITY are ignored instead.
+        """
+        uidvalidity = int(uidvalidity)
+        self.uidvalidity[mailbox] = uidvalidity
+        row = self.conn.execute("SELECT uidvalidity, uidnext FROM mailboxes "
+                                "WHERE account = ? AND mailbox = ?", (self.account, mailbox)).fetchone()
+        if row is not None and row[0] == uidvalidity:
+            return row[1]
+        if readonly:
+            return None
+
+        if row is not None:
+            logging.warning("UIDVALIDITY of %s changed, discarding its journal", mailbox)
+        self.conn.execute("DELETE FROM messages WHERE account = ? AND mailbox = ?", (self.account, mailbox))
+        self.conn.execute("INSERT OR REPLACE INTO mailboxes (account, mailbox, uidvalidity, uidnext) "
+                          "VALUES (?, ?, ?, NULL)", (self.account, mailbox, uidvalidity))
+        self.conn.commit()
+        return None
+
+    def states(self, mailbox):
+        """Return a dict mapping the journaled UIDs (int) of mailbox to their states."""
+        rows = self.conn.execute("SELECT uid, state FROM messages WHERE account = ? AND mailbox = ? "
+                                 "AND uidvalidity = ?", (self.account, mailbox, self.uidvalidity[mailbox]))
+        return dict((uid, str(state)) for uid, state in rows)
+
+    def record(self, mailbox, uid, state):
+        """Record the state of a message."""
+        self.record_many(mailbox, [uid], state)
+
+    def record_many(self, mailbox, uids, state):
+        """Record the same state for several messages."""
+        now = datetime.now().isoformat()
+        self.pending.append(("INSERT OR REPLACE INTO messages (account, mailbox, uidvalidity, uid, state, "
+                             "updated) VALUES (?, ?, ?, ?, ?, ?)",
+                             [(self.account, mailbox, self.uidvalidity[mailbox], int(uid), state, now)
+                              for uid in uids]))
+
+    def mark_expunged(self, mailbox):
+        """Record that all rewritten messages of mailbox have been expunged."""
+        self.pending.append(("UPDATE messages SET state = ?, updated = ? WHERE account = ? AND mailbox = ? "
+                             "AND uidvalidity = ? AND state = ?",
+                             [(EXPUNGED, datetime.now().isoformat(), self.account, mailbox,
+                               self.uidvalidity[mailbox], REWRITTEN)]))
+
+    def finish_mailbox(self, mailbox, uidnext):
+        """Remember uidnext as the high-water mark for the next run of --since-last-run."""
+        self.pending.append(("UPDATE mailboxes SET uidnext = ? WHERE account = ? AND mailbox = ? "
+                             "AND uidvalidity = ?",
+                             [(uidnext, self.account, mailbox, self.uidvalidity[mailbox])]))
+
+    def commit(self):
+        """Write all recorded changes in one transaction and make them durable.
+
+        The write lock on the journal file is only held while the changes are written.
+        """
+        with self.conn:
+            for statement, rows in self.pending:
+                self.conn.executemany(statement, rows)
+        self.pending = []
+
+    def close(self):
+        """Commit and close the journal."""
+        self.commit()
+        self.conn.close()
+
@@ -0,0 +1,490 @@
+# -*- coding: utf-8 -*-
+# Copyright HUDORA GmbH 2009
+
+"""Bounded-memory MIME parsing.
+
+StreamParser is fed a mail in chunks, like email.feedparser.FeedParser, but it never keeps the bodies of
+the parts in memory. The raw mail is spooled into a temporary file which is only held in memory while it is
+smaller than a threshold. The parsed parts are header-only email.message.Message objects that know where
+their bodies are located in that spool. Payloads are decoded chunk by chunk into a destination file.
+Mails that are already held in a string are parsed in place, the string itself serves as the spool.
+
+Outside of header blocks, only the lines starting with "--" are looked at. Parsing therefore costs little
+more than a string search over the bodies, and splice() rewrites a mail with a handful of block copies.
+
+>>> root = parse_string('Subject: hi\\nContent-Type: multipart/mixed; boundary="b"\\n\\n--b\\n\\ntext\\n'
+...                     '--b\\nContent-Disposition: attachment; filename="a.txt"\\n'
+...                     'Content-Transfer-Encoding: base64\\n\\naGVsbG8=\\n--b--\\n')
+>>> [part.get_content_type() for part in root.walk()]
+['multipart/mixed', 'text/plain', 'text/plain']
+>>> root['subject'], root.get_payload()[0].raw_body(), root.get_payload()[1].decoded_string()
+('hi', 'text', 'hello')
+"""
+
+import binascii
+import email.message
+import email.parser
+import quopri
+import re
+import tempfile
+
+# keep spooled data in memory up to this many bytes before moving it to a temporary file
+DEFAULT_SPOOL_THRESHOLD = 8 * 1024 * 1024
+# size of the blocks read from the spool when copying or decoding bodies
+COPY_BUFFER_SIZE = 256 * 1024
+# lines longer than this can't be MIME boundaries, so they are not buffered as a whole
+MAX_LINE_BUFFER = 64 * 1024
+
+# Content-Transfer-Encodings of uuencoded bodies, which are decoded as a whole
+UUENCODE = ('x-uuencode', 'uuencode', 'uue', 'x-uue')
+
+HEADERS, PREAMBLE, BODY, EPILOGUE = range(4)
+
+header_re = re.compile(r'^[\x21-\x39\x3b-\x7e]+:|^[ \t]')
+
+
+class StreamPart(email.message.Message):
+    """A header-only message part whose body stays in the spool of the StreamParser that created it.
+
+    header_start, body_start and body_end are offsets into the spool. Multipart and message/* parts have
+    their sub-parts attached as payload, like email.message.Message, so walk() works as usual.
+    """
+
+    def __init__(self):
+        email.message.Message.__init__(self)
+        self.spool = None
+        self.header_start = 0
+        self.body_start = 0
+        self.body_end = 0
+
+    def body_size(self):
+        """Size of the raw (encoded) body in bytes."""
+        return self.body_end - self.body_start
+
+    def iter_raw(self, start=None, end=None):
+        """Generate the raw bytes between start and end (default: the body) in blocks."""
+        if start is None:
+            start = self.body_start
+        if end is None:
+            end = self.body_end
+        while start < end:
+            self.spool.seek(start)
+            data = self.spool.read(min(COPY_BUFFER_SIZE, end - start))
+            if not data:
+                break
+            start += len(data)
+            yield data
+
+    def iter_buffers(self, start, end):
+        """Like iter_raw(), but for mails parsed from a string the data is yielded as a read-only buffer
+        sharing the memory of that string. Buffers can be written to files, but not used as strings.
+        """
+        if isinstance(self.spool, StringSpool):
+            if start < end:
+                yield buffer(self.spool.data, start, end - start)
+            return
+        for data in self.iter_raw(start, end):
+            yield data
+
+    def raw_headers(self):
+        """The raw header block of the part, including the empty line that terminates it."""
+        return ''.join(self.iter_raw(self.header_start, self.body_start))
+
+    def raw_body(self):
+        """The raw body of the part. Only use this for parts known to be small."""
+        return ''.join(self.iter_raw())
+
+    def decode_to(self, out):
+        """Write the decoded body to the file object out, chunk by chunk. Returns the number of bytes written.
+
+        The Content-Transfer-Encoding is handled like email.message.Message.get_payload(decode=True) does.
+        """
+        cte = str(self.get('content-transfer-encoding', '')).lower().strip()
+        if cte in UUENCODE:
+            # rare enough to not bother with streaming
+            part = email.message.Message()
+            part['Content-Transfer-Encoding'] = cte
+            part.set_payload(self.raw_body())
+            data = part.get_payload(decode=True) or ''
+            out.write(data)
+            return len(data)
+
+        decoder = transfer_decoder(cte)
+        written = 0
+        for chunk in self.iter_raw():
+            if decoder is not None:
+                chunk = decoder.decode(chunk)
+            out.write(chunk)
+            written += len(chunk)
+        if decoder is not None:
+            chunk = decoder.flush()
+            out.write(chunk)
+            written += len(chunk)
+        return written
+
+    def decoded(self, spool_threshold=DEFAULT_SPOOL_THRESHOLD):
+        """Return the decoded body as a rewound file object.
+
+        The file is moved to disk when it grows larger than spool_threshold.
+        """
+        out = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+        self.decode_to(out)
+        out.seek(0)
+        return out
+
+    def decoded_string(self):
+        """Return the decoded body as a string. Only use this for parts known to be small."""
+        out = tempfile.SpooledTemporaryFile(max_size=self.body_size() + 1)
+        self.decode_to(out)
+        out.seek(0)
+        return out.read()
+
+    def decoded_size(self):
+        """Size of the decoded body, computed without keeping it in memory."""
+        return self.decode_to(_NullFile())
+
+
+class StringSpool(object):
+    """Read-only file object over a string, the spool of a mail that is already in memory.
+
+    >>> spool = StringSpool('hello world')
+    >>> spool.seek(6)
+    >>> spool.read(3), spool.read(), spool.tell()
+    ('wor', 'ld', 11)
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += len(self.data)
+        self.pos = max(pos, 0)
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        if size < 0:
+            end = len(self.data)
+        else:
+            end = self.pos + size
+        data = self.data[self.pos:end]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+class _NullFile(object):
+    """File object discarding everything written to it."""
+
+    def write(self, data):
+        pass
+
+
+def transfer_decoder(cte):
+    """Return an incremental decoder for the Content-Transfer-Encoding cte, None if no decoding is needed.
+
+    uuencoded bodies (see UUENCODE) can't be decoded incrementally and are returned as they are, too.
+
+    >>> decoder = transfer_decoder(' Quoted-Printable')
+    >>> decoder.decode('caf=\\n') + decoder.decode('=C3=A9\\nx') + decoder.flush()
+    'caf\\xc3\\xa9\\nx'
+    >>> transfer_decoder('8bit') is None
+    True
+    """
+    cte = str(cte or '').lower().strip()
+    if cte == 'base64':
+        return Base64Decoder()
+    if cte == 'quoted-printable':
+        return LineDecoder(quopri.decodestring)
+    return None
+
+
+class Base64Decoder(object):
+    """Incremental base64 decoder ignoring whitespace and other garbage like binascii.a2b_base64.
+
+    >>> decoder = Base64Decoder()
+    >>> decoder.decode('aGVs\\r\\nbG') + decoder.decode('8gd29y') + decoder.decode('bGQ=\\r\\n')
+    'hello world'
+    >>> decoder.decode('aGk') + decoder.flush()
+    'hi'
+    """
+
+    def __init__(self):
+        self.pending = ''
+
+    def decode(self, data):
+        data = self.pending + re.sub(r'[^A-Za-z0-9+/=]+', '', data)
+        usable = len(data) - len(data) % 4
+        self.pending = data[usable:]
+        return self._decode(data[:usable])
+
+    def flush(self):
+        data = self.pending
+        self.pending = ''
+        if not data:
+            return ''
+        return self._decode(data + '=' * (-len(data) % 4))
+
+    def _decode(self, data):
+        try:
+            return binascii.a2b_base64(data)
+        except binascii.Error:
+            return ''
+
+
+class LineDecoder(object):
+    """Incremental decoder applying a line based decoding function to complete lines only."""
+
+    def __init__(self, function):
+        self.function = function
+        self.pending = ''
+
+    def decode(self, data):
+        data = self.pending + data
+        end = data.rfind('\n') + 1
+        self.pending = data[end:]
+        return self.function(data[:end])
+
+    def flush(self):
+        data = self.pending
+        self.pending = ''
+        return self.function(data)
+
+
+class StreamParser(object):
+    """Incremental MIME parser spooling the raw mail instead of keeping it in memory.
+
+    Call feed() with consecutive chunks of the mail and close() to get the root StreamPart. Memory use is
+    bounded by the spool threshold plus the size of the header blocks.
+    """
+
+    def __init__(self, spool_threshold=DEFAULT_SPOOL_THRESHOLD, spool=None):
+        """Create a parser spooling to a new temporary file, or using spool, a StringSpool that already holds
+        the complete mail which is then fed without being copied.
+        """
+        self.external_spool = spool is not None
+        if spool is None:
+            spool = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+        self.spool = spool
+        self._pos = 0
+        self._partial = ''
+        self._midline = False
+        self._last_eol = 0
+        self._state = HEADERS
+        self._headers = []
+        self._header_start = 0
+        self._header_parent = None
+        self._root = None
+        self._open = []
+        self._boundaries = []
+
+    def feed(self, data):
+        """Feed the next chunk of the raw mail."""
+        if not self.external_spool:
+            self.spool.write(data)
+        start = self._pos - len(self._partial)
+        self._pos += len(data)
+        if self._partial:
+            data = self._partial + data
+        pos = 0
+        while True:
+            if self._state != HEADERS and (self._midline or not data.startswith('--', pos)):
+                # only delimiter lines matter outside of header blocks, skip to the next candidate
+                skip = data.find('\n--', pos)
+                if skip < 0:
+                    skip = data.rfind('\n', pos)
+                    if skip >= 0:
+                        self._skipped_line(data, pos, skip)
+                        pos = skip + 1
+                    break
+                self._skipped_line(data, pos, skip)
+                pos = skip + 1
+            end = data.find('\n', pos) + 1
+            if not end:
+                break
+            self._line(data[pos:end], start + pos)
+            pos = end
+        self._partial = data[pos:]
+        if len(self._partial) > MAX_LINE_BUFFER and self._state != HEADERS:
+            self._midline = True
+            self._partial = ''
+
+    def close(self):
+        """Finish parsing and return the root StreamPart."""
+        if self._partial:
+            self._line(self._partial, self._pos - len(self._partial))
+            self._partial = ''
+        if self._state == HEADERS and (self._headers or self._root is None):
+            self._end_headers(self._pos)
+        for part in self._open:
+            part.body_end = self._pos
+        self._open = []
+        self.spool.seek(0)
+        return self._root
+
+    def _skipped_line(self, data, pos, eol):
+        """Account for the skipped lines between pos and the line break at eol."""
+        self._midline = False
+        if eol > pos and data[eol - 1] == '\r':
+            self._last_eol = 2
+        else:
+            self._last_eol = 1
+
+    def _line(self, line, offset):
+        midline = self._midline
+        self._midline = False
+        if not midline and line.startswith('--') and self._boundaries:
+            match = self._match_boundary(line)
+            if match is not None:
+                self._boundary(match[0], match[1], offset, offset + len(line))
+                self._last_eol = len(line) - len(line.rstrip('\r\n'))
+                return
+
+        if self._state == HEADERS:
+            if line.rstrip('\r\n') == '':
+                self._end_headers(offset + len(line))
+            elif header_re.match(line):
+                self._headers.append(line)
+            else:
+                # no empty line after the headers, the body starts right here
+                self._end_headers(offset)
+        self._last_eol = len(line) - len(line.rstrip('\r\n'))
+
+    def _match_boundary(self, line):
+        text = line.rstrip()
+        for depth in range(len(self._boundaries) - 1, -1, -1):
+            boundary = '--' + self._boundaries[depth][1]
+            if text == boundary:
+                return depth, False
+            if text == boundary + '--':
+                return depth, True
+        return None
+
+    def _boundary(self, depth, closing, offset, next_offset):
+        # the line break before a delimiter belongs to the delimiter
+        end = max(offset - self._last_eol, 0)
+        if self._state == HEADERS and self._headers:
+            self._end_headers(end)
+        container = self._boundaries[depth][0]
+        del self._boundaries[depth + 1:]
+        while self._open and self._open[-1] is not container:
+            part = self._open.pop()
+            part.body_end = max(end, part.body_start)
+        if closing:
+            self._boundaries.pop()
+            self._state = EPILOGUE
+        else:
+            self._state = HEADERS
+            self._headers = []
+            self._header_start = next_offset
+            self._header_parent = container
+
+    def _end_headers(self, body_start):
+        part = email.parser.HeaderParser(_class=StreamPart).parsestr(''.join(self._headers))
+        part.set_payload(None)
+        part.spool = self.spool
+        part.header_start = self._header_start
+        part.body_start = part.body_end = body_start
+        self._headers = []
+
+        parent = self._header_parent
+        if parent is None:
+            self._root = part
+        else:
+            if parent.get_content_type() == 'multipart/digest':
+                part.set_default_type('message/rfc822')
+            parent.attach(part)
+        self._open.append(part)
+
+        boundary = part.get_boundary()
+        if part.get_content_maintype() == 'multipart' and boundary:
+            self._boundaries.append((part, boundary))
+            self._state = PREAMBLE
+        elif part.get_content_maintype() == 'message' and part.get_content_subtype() != 'delivery-status':
+            # the body is an encapsulated message with headers of its own
+            self._state = HEADERS
+            self._header_start = body_start
+            self._header_parent = part
+        else:
+            self._state = BODY
+
+
+def parse_string(data):
+    """Parse a complete mail held in a string, which is used as the spool without copying it."""
+    parser = StreamParser(spool=StringSpool(data))
+    parser.feed(data)
+    return parser.close()
+
+
+def strip_headers(raw, names):
+    """Remove header fields, including their continuation lines, from a raw header block.
+
+    >>> strip_headers('Content-Type: text/plain;\\n name=x\\nX-Foo: bar\\n\\n', ['content-type'])
+    'X-Foo: bar\\n\\n'
+    """
+    names = [name.lower() for name in names]
+    ret = []
+    skip = False
+    for line in raw.splitlines(True):
+        if line[:1] in (' ', '\t'):
+            if not skip:
+                ret.append(line)
+            continue
+        skip = line.split(':', 1)[0].strip().lower() in names and ':' in line
+        if not skip:
+            ret.append(line)
+    return ''.join(ret)
+
+
+def splice(root, replace, out):
+    """Write the mail parsed into root to out, replacing whole parts.
+
+    replace is called for the parts in walk() order and returns either None to keep a part or the string to
+    write instead of its headers and body. The sub-parts of a replaced part are not visited. Everything else
+    is copied byte for byte from the spool. Returns the number of replaced parts.
+
+    >>> root = parse_string('Content-Type: multipart/mixed; boundary=b\\n\\npre\\n--b\\n\\none\\n--b\\n'
+    ...                     'X-Part: 2\\n\\ntwo\\n--b--\\nepilogue\\n')
+    >>> import StringIO
+    >>> out = StringIO.StringIO()
+    >>> splice(root, lambda part: part['x-part'] and 'X-Part: new\\n\\nzwei', out)
+    1
+    >>> print out.getvalue(),
+    Content-Type: multipart/mixed; boundary=b
+    <BLANKLINE>
+    pre
+    --b
+    <BLANKLINE>
+    one
+    --b
+    X-Part: new
+    <BLANKLINE>
+    zwei
+    --b--
+    epilogue
+    """
+    cursor = root.header_start
+    replaced = 0
+    stack = [root]
+    while stack:
+        part = stack.pop()
+        replacement = replace(part)
+        if replacement is None:
+            if part.is_multipart():
+                stack.extend(reversed(part.get_payload()))
+            continue
+        for data in root.iter_buffers(cursor, part.header_start):
+            out.write(data)
+        out.write(replacement)
+        cursor = part.body_end
+        replaced += 1
+    for data in root.iter_buffers(cursor, root.body_end):
+        out.write(data)
+    return replaced
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+# Copyright HUDORA GmbH 2009
+
+"""Attachment policies for RemoveAttachments.
+
+A policy file is a JSON object selecting the attachments to archive and remove. Mails of the folders in
+exclude_folders and the UIDs in exclude_uids are never touched. Every rule selects the attachments of some
+mails, an attachment is taken if any rule applying to its mail selects it. All keys are optional, a rule
+without any selects all attachments, and a policy without rules works like a single such rule:
+
+    {
+      "exclude_folders": ["Drafts", "[Gmail]/*"],
+      "exclude_uids": ["339", "18205"],
+      "rules": [
+        {"name": "old scans", "folders": ["INBOX", "Archive/*"], "from": ["scanner@", "fax@"],
+         "older_than_days": 180, "mime_types": ["application/pdf", "image/*"], "min_part_size": 100},
+        {"name": "read office documents", "flags": ["\\\\Seen", "!\\\\Flagged", "!$Keep"],
+         "filenames": ["*.doc", "*.xls", "*.ppt"], "min_message_size": 500}
+      ]
+    }
+
+Rule keys on the mail are folders (shell patterns of mailbox names), before and since (YYYY-MM-DD),
+older_than_days and newer_than_days, min_message_size and max_message_size (kB), from (substrings of the
+sender, any of them) and flags (system flags or keywords the mail must have, or must not have with a leading
+"!"). They are all turned into IMAP SEARCH keys (see Rule.search) and evaluated by the server, so mails no
+rule applies to are never looked at. Rule keys on the attachments are mime_types and filenames (shell
+patterns, case-insensitive) and min_part_size and max_part_size (kB, encoded size). They only need the
+BODYSTRUCTURE of a mail, so mails without wanted attachments are never downloaded.
+
+>>> policy = Policy({'exclude_folders': ['Trash'], 'rules': [
+...     {'folders': ['INBOX'], 'flags': ['\\\\Seen'], 'mime_types': ['image/*'], 'min_part_size': 10},
+...     {'from': 'scanner@example.com', 'filenames': ['*.pdf']}]})
+>>> [rule.search for rule in policy.rules_for('INBOX')]
+['SEEN', 'FROM "scanner@example.com"']
+>>> [rule.search for rule in policy.rules_for('Archive')]
+['FROM "scanner@example.com"']
+>>> policy.rules_for('Trash')
+[]
+>>> rules = policy.rules_for('INBOX')
+>>> Policy.wants(rules, 'image/png', 'a.png', 20 * 1024), Policy.wants(rules, 'image/png', 'a.png', 100)
+(True, False)
+>>> Policy.wants(rules, 'application/pdf', 'Scan.PDF', 100)
+True
+"""
+
+import json
+import re
+from datetime import date, datetime, timedelta
+
+# system flags and their SEARCH keys, for mails having them and for mails not having them
+SYSTEM_FLAGS = {
+    '\\answered': ('ANSWERED', 'UNANSWERED'),
+    '\\deleted': ('DELETED', 'UNDELETED'),
+    '\\draft': ('DRAFT', 'UNDRAFT'),
+    '\\flagged': ('FLAGGED', 'UNFLAGGED'),
+    '\\seen': ('SEEN', 'UNSEEN'),
+}
+
+RULE_KEYS = set(['name', 'folders', 'before', 'since', 'older_than_days', 'newer_than_days',
+                 'min_message_size', 'max_message_size', 'from', 'flags', 'mime_types', 'filenames',
+                 'min_part_size', 'max_part_size'])
+POLICY_KEYS = set(['exclude_folders', 'exclude_uids', 'rules'])
+
+
+class PolicyException(Exception):
+    """Raised for invalid policies."""
+    pass
+
+
+def glob_regex(patterns, ignore_case=False):
+    """Compile a list of shell patterns into a single regular expression, None for an empty list.
+
+    Only * (any string) and ? (any character) are special. Unlike with fnmatch, brackets match themselves,
+    as in Gmail's folder names.
+
+    >>> glob_regex(['*.pdf', 'scan?.tif'], ignore_case=True).match('Invoice.PDF') is not None
+    True
+    >>> glob_regex(['INBOX']).match('INBOX/Sub') is None
+    True
+    >>> regex = glob_regex(['[Gmail]/*'])
+    >>> regex.match('[Gmail]/Trash') is not None, regex.match('G/Trash') is None
+    (True, True)
+    >>> glob_regex([]) is None
+    True
+    """
+    if not patterns:
+        return None
+    regexes = []
+    for pattern in patterns:
+        regexes.append('.*'.join('.'.join(re.escape(part) for part in chunk.split('?'))
+                                 for chunk in pattern.split('*')))
+    return re.compile('|'.join(r'(?:%s)\Z' % regex for regex in regexes),
+                      re.DOTALL | (ignore_case and re.IGNORECASE or 0))
+
+
+def imap_string(value):
+    """Quote value as IMAP string for a SEARCH key. Only ASCII strings can be sent without a charset.
+
+    >>> print imap_string('say "hi"')
+    "say \\"hi\\""
+    """
+    try:
+        value = str(value)
+    except UnicodeError:
+        raise PolicyException("Only ASCII text is supported in SEARCH keys: %r" % value)
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def imap_date(day):
+    """Format a date for SEARCH, independent of the locale.
+
+    >>> imap_date(date(2009, 11, 4))
+    '4-Nov-2009'
+    """
+    months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+    return '%d-%s-%d' % (day.day, months[day.month - 1], day.year)
+
+
+def _as_list(value):
+    if isinstance(value, basestring):
+        return [value]
+    return list(value or [])
+
+
+def _parse_day(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        raise PolicyException("Invalid date %r, use YYYY-MM-DD" % (value, ))
+
+
+def _kilobytes(spec, key):
+    value = spec.get(key)
+    if value is None:
+        return None
+    if not isinstance(value, (int, long, float)) or value < 0:
+        raise PolicyException("%s must be a size in kB: %r" % (key, value))
+    return int(value * 1024)
+
+
+def search_keys(spec, today=None):
+    """Translate the mail criteria of a rule into IMAP SEARCH keys, '' if it has none.
+
+    Relative ages are counted from today. BEFORE and SINCE compare the internal date of the mails.
+    >>> search_keys({'older_than_days': 30, 'before': '2009-12-31', 'min_message_size': 100},
+    ...             today=date(2009, 12, 1))
+    'BEFORE 1-Nov-2009 LARGER 102400'
+    >>> search_keys({'from': ['a@example.com', 'b@example.com', 'c@'], 'flags': ['!\\\\Seen', '$Label1']})
+    'OR OR FROM "a@example.com" FROM "b@example.com" FROM "c@" UNSEEN KEYWORD $Label1'
+    >>> search_keys({})
+    ''
+    """
+    today = today or date.today()
+    for key in ('older_than_days', 'newer_than_days'):
+        if spec.get(key) is not None and not isinstance(spec[key], (int, long)):
+            raise PolicyException("%s must be a number of days: %r" % (key, spec[key]))
+    keys = []
+    before = [_parse_day(value) for value in _as_list(spec.get('before'))]
+    since = [_parse_day(value) for value in _as_list(spec.get('since'))]
+    if spec.get('older_than_days') is not None:
+        before.append(today - timedelta(days=spec['older_than_days']))
+    if spec.get('newer_than_days') is not None:
+        since.append(today - timedelta(days=spec['newer_than_days']))
+    if before:
+        keys.append('BEFORE ' + imap_date(min(before)))
+    if since:
+        keys.append('SINCE ' + imap_date(max(since)))
+    min_size = _kilobytes(spec, 'min_message_size')
+    if min_size:
+        keys.append('LARGER %d' % min_size)
+    max_size = _kilobytes(spec, 'max_message_size')
+    if max_size is not None:
+        keys.append('SMALLER %d' % max_size)
+
+    senders = _as_list(spec.get('from'))
+    if senders:
+        # OR takes two keys, nest it for more
+        keys.append(''.join('OR ' for sender in senders[1:]) +
+                    ' '.join('FROM ' + imap_string(sender) for sender in senders))
+
+    for flag in _as_list(spec.get('flags')):
+        negated = flag.startswith('!')
+        name = flag.lstrip('!')
+        if name.lower() in SYSTEM_FLAGS:
+            keys.append(SYSTEM_FLAGS[name.lower()][int(negated)])
+        elif re.match(r'^[^\s(){%*"\\\]]+$', name):
+            keys.append('%s %s' % (negated and 'UNKEYWORD' or 'KEYWORD', name))
+        else:
+            raise PolicyException("Invalid flag %r" % flag)
+    return ' '.join(keys)
+
+
+class Rule(object):
+    """A compiled policy rule, see the module documentation for its keys."""
+
+    def __init__(self, spec, today=None):
+        unknown = set(spec) - RULE_KEYS
+        if unknown:
+            raise PolicyException("Unknown rule keys: %s" % ', '.join(sorted(unknown)))
+        self.name = spec.get('name')
+        self.folders = glob_regex(_as_list(spec.get('folders')))
+        # SEARCH keys selecting the mails the rule applies to
+        self.search = search_keys(spec, today)
+        self.mime_types = glob_regex(_as_list(spec.get('mime_types')), ignore_case=True)
+        self.filenames = glob_regex(_as_list(spec.get('filenames')), ignore_case=True)
+        self.min_part_size = _kilobytes(spec, 'min_part_size')
+        self.max_part_size = _kilobytes(spec, 'max_part_size')
+
+    def applies_to(self, mailbox):
+        """Whether the rule applies to the mails of mailbox."""
+        return self.folders is None or self.folders.match(mailbox) is not None
+
+    def wants(self, mimetype, filename, size):
+        """Whether the rule selects an attachment. size is the encoded size, None if unknown."""
+        if self.mime_types is not None and self.mime_types.match(mimetype) is None:
+            return False
+        if self.filenames is not None and self.filenames.match(filename or '') is None:
+            return False
+        if self.min_part_size is not None and (size is None or size < self.min_part_size):
+            return False
+        if self.max_part_size is not None and size is not None and size > self.max_part_size:
+            return False
+        return True
+
+    def __repr__(self):
+        return '<Rule %s: %s>' % (self.name, self.search or 'ALL')
+
+
+class Policy(object):
+    """A compiled attachment policy, see the module documentation."""
+
+    def __init__(self, spec, today=None):
+        if not isinstance(spec, dict):
+            raise PolicyException("A policy must be a JSON object")
+        unknown = set(spec) - POLICY_KEYS
+        if unknown:
+            raise PolicyException("Unknown policy keys: %s" % ', '.join(sorted(unknown)))
+        self.exclude_folders = glob_regex(_as_list(spec.get('exclude_folders')))
+        self.exclude_uids = set(str(uid) for uid in spec.get('exclude_uids', []))
+        self.rules = [Rule(rule, today) for rule in spec.get('rules') or [{}]]
+
+    def rules_for(self, mailbox):
+        """Return the rules applying to the mails of mailbox, none for excluded folders."""
+        if self.exclude_folders is not None and self.exclude_folders.match(mailbox):
+            return []
+        return [rule for rule in self.rules if rule.applies_to(mailbox)]
+
+    @staticmethod
+    def wants(rules, mimetype, filename, size):
+        """Whether any of rules selects an attachment."""
+        for rule in rules:
+            if rule.wants(mimetype, filename, size):
+                return True
+        return False
+
+
+def load_policy(path):
+    """Read and compile the policy file at path."""
+    try:
+        spec = json.load(open(path))
+    except (IOError, ValueError), e:
+        raise PolicyException("Cannot read policy %s: %s" % (path, e))
+    return Policy(spec)
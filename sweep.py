@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright HUDORA GmbH 2009
+
+"""Run RemoveAttachments over many accounts, e.g. for all employees of a company.
+
+The accounts file lists one IMAP username per line, like gmailsignature/all_users.txt. Blank lines and lines
+starting with # are ignored. A username may be followed by RemoveAttachments options overriding the ones
+given on the command line for this account, quoted like in a shell:
+
+    # the defaults from the command line apply to everyone but the boss
+    v.nachname
+    f.last --password "s3cret phrase" --min-size 1000 --time-budget 7200
+
+    python sweep.py --accounts all_users.txt --domain hudora.de -s imap.gmail.com --ssl --gmail -p ... \\
+        --couchdb-server http://127.0.0.1:5984/ --remove --jobs 8 --max-sessions-per-server 20 \\
+        --time-budget 1800 --window 21600 --report sweep.json
+
+Accounts are processed by a pool of --jobs threads, and each account uses up to --workers IMAP sessions.
+--max-sessions-per-server caps the number of sessions open on any one IMAP server at the same time, an
+account waits until it can open all of its sessions. With --time-budget, an account stops starting new mails
+once it has been running that long. With --window, accounts that could not be started within that many
+seconds after the sweep began are skipped, and running ones stop at its end. Work left over is picked up by
+the next sweep, best with a --journal.
+
+A failing account is reported and does not affect the others. At the end, a table of all accounts is
+printed, and --report writes the results with the counters and metrics of every account as JSON. The exit
+status is 1 if any account failed.
+"""
+
+import copy
+import json
+import logging
+import shlex
+import StringIO
+import sys
+import threading
+import time
+import Queue
+from contextlib import contextmanager
+
+import instrument
+import throttle
+from instrument import format_size, format_duration
+from RemoveAttachments import RemoveAttachments, make_parser, settings_from_options, die
+
+# placeholder in the --metrics-json and --metrics-prom paths replaced with the account name
+ACCOUNT_PLACEHOLDER = '{account}'
+
+
+def parse_accounts(lines):
+    """Parse the lines of an accounts file into a list of (username, option arguments) tuples.
+
+    >>> parse_accounts(['# comment', '', 'v.nachname', '  f.last --min-size 100 --password "a b"'])
+    [('v.nachname', []), ('f.last', ['--min-size', '100', '--password', 'a b'])]
+    """
+    accounts = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        args = shlex.split(line)
+        accounts.append((args[0], args[1:]))
+    return accounts
+
+
+def account_username(username, domain):
+    """Complete a username from the accounts file with the mail domain, unless it has one already.
+
+    >>> account_username('v.nachname', 'hudora.de')
+    'v.nachname@hudora.de'
+    >>> account_username('f.last@example.com', 'hudora.de')
+    'f.last@example.com'
+    >>> account_username('f.last', None)
+    'f.last'
+    """
+    if domain and '@' not in username:
+        return '%s@%s' % (username, domain)
+    return username
+
+
+class SessionLimit(object):
+    """Counts the IMAP sessions open on a server and lets accounts wait until they may open theirs.
+
+    A limit of 0 means no limit.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def sessions(self, count):
+        """Wait in the with statement until count more sessions may be open, and count them as open."""
+        with self.condition:
+            while self.limit and self.used + count > self.limit:
+                self.condition.wait()
+            self.used += count
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.used -= count
+                self.condition.notify_all()
+
+
+class Sweep(object):
+    """Processes a list of accounts with RemoveAttachments on a pool of threads.
+
+    accounts is a list of (username, options) tuples, where options are the parsed RemoveAttachments
+    options of the account. jobs is the number of accounts processed at the same time, max_sessions the cap
+    on IMAP sessions per server (0 for none) and window the number of seconds after which no further
+    accounts are started (0 for no limit).
+    """
+
+    def __init__(self, accounts, jobs=1, max_sessions=0, window=0):
+        self.accounts = accounts
+        self.jobs = max(1, jobs)
+        self.max_sessions = max_sessions
+        self.window = window
+        self.started = None
+        # server -> SessionLimit
+        self.limits = {}
+        self.lock = threading.Lock()
+        self.results = []
+
+    def _limit(self, server):
+        with self.lock:
+            if server not in self.limits:
+                self.limits[server] = SessionLimit(self.max_sessions)
+            return self.limits[server]
+
+    def _end(self):
+        """Return the time.time() at which the sweep window closes, None if there is no window."""
+        if not self.window:
+            return None
+        return self.started + self.window
+
+    def run(self):
+        """Process all accounts and return the list of their results, see run_account()."""
+        self.started = time.time()
+        queue = Queue.Queue()
+        for account in self.accounts:
+            queue.put(account)
+        threads = []
+        for num in range(min(self.jobs, len(self.accounts))):
+            thread = threading.Thread(target=self._work_queue, args=(queue, ), name="job-%d" % num)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        order = dict((username, num) for num, (username, options) in enumerate(self.accounts))
+        self.results.sort(key=lambda result: order[result['account']])
+        return self.results
+
+    def _work_queue(self, queue):
+        """Job thread body: process accounts from queue until it is empty."""
+        while True:
+            try:
+                username, options = queue.get_nowait()
+            except Queue.Empty:
+                break
+            threading.current_thread().name = username
+            result = self.run_account(username, options)
+            with self.lock:
+                self.results.append(result)
+
+    def run_account(self, username, options):
+        """Process a single account and return its result.
+
+        The result is a dict with the keys account, status ('done', 'incomplete' if it ran out of time,
+        'failed' or 'skipped' if the sweep window closed before it could start), seconds, error, counters
+        (the statistics of RemoveAttachments) and metrics (see instrument.Metrics.summary()).
+        """
+        result = {'account': username, 'status': 'skipped', 'seconds': 0, 'error': None, 'counters': {},
+                  'metrics': None}
+        settings = settings_from_options(options)
+        limit = self._limit(settings['server'])
+        if self.max_sessions and settings['workers'] > self.max_sessions:
+            settings['workers'] = self.max_sessions
+
+        with limit.sessions(settings['workers']):
+            start = time.time()
+            end = self._end()
+            if end is not None and start >= end:
+                logging.warning("Sweep window closed, skipping account %s", username)
+                return result
+            if options.time_budget:
+                end = min(end or sys.maxint, start + options.time_budget)
+
+            logging.info("Processing account %s", username)
+            metrics = instrument.from_options('removeattachments', options, [('account', username)])
+            governor = throttle.from_options(options, settings['workers'])
+            program = None
+            try:
+                program = RemoveAttachments(metrics=metrics, governor=governor, deadline=end, **settings)
+                program.run()
+                result['status'] = program.stats['unfinished_mailboxes'] and 'incomplete' or 'done'
+                if settings['plan']:
+                    plan = StringIO.StringIO()
+                    program.report_plan(plan)
+                    result['plan'] = json.loads(plan.getvalue())
+            except Exception, e:
+                logging.warning("Error processing account %s", username)
+                logging.exception(e)
+                result['status'] = 'failed'
+                result['error'] = str(e)
+                if program is not None:
+                    try:
+                        program.imap.shutdown()
+                    except Exception:
+                        pass
+            finally:
+                result['seconds'] = time.time() - start
+                result['counters'] = dict(getattr(program, 'stats', {}))
+                try:
+                    instrument.write_outputs(metrics, options, result['counters'])
+                except (IOError, OSError), e:
+                    logging.warning("Could not write the metrics of account %s: %s", username, e)
+                result['metrics'] = metrics.summary()
+        logging.info("Account %s %s after %s", username, result['status'], format_duration(result['seconds']))
+        return result
+
+
+def print_report(results, out=None):
+    """Print a table of the results of all accounts."""
+    out = out or sys.stdout
+    columns = ('Account', 'Status', 'Time', 'Mails', 'Rewritten', 'Uploaded', 'Received', 'Failed')
+    out.write("%-40s %-10s %9s %7s %9s %10s %10s %7s\n" % columns)
+    statuses = {}
+    for result in results:
+        counters = result['counters']
+        received = result['metrics'] and result['metrics']['total']['bytes_received'] or 0
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+        out.write("%-40s %-10s %9s %7d %9d %10s %10s %7d\n" % (
+            result['account'], result['status'], format_duration(result['seconds']),
+            counters.get('candidates', 0), counters.get('appended_mails', 0),
+            format_size(counters.get('uploaded_bytes', 0)), format_size(received),
+            counters.get('failed_mailboxes', 0)))
+        if result['error']:
+            out.write("    %s\n" % result['error'])
+    out.write("\n%d accounts: %s\n" % (len(results), ', '.join('%d %s' % (count, status)
+                                                              for status, count in sorted(statuses.items()))))
+
+
+def load_accounts(parser, defaults, path, domain):
+    """Read the accounts file at path and return a list of (username, options) tuples.
+
+    The options of an account are the defaults with the overrides from its line applied. Aborts if the
+    overrides of an account are invalid.
+    """
+    accounts = []
+    for username, args in parse_accounts(open(path)):
+        username = account_username(username, domain)
+        values = copy.copy(defaults)
+        values.username = username
+        try:
+            options, rest = parser.parse_args(args, values)
+        except SystemExit:
+            die("Invalid options for account %s" % username)
+        if rest:
+            die("Unexpected arguments for account %s: %s" % (username, ' '.join(rest)))
+        for name in ('metrics_json', 'metrics_prom'):
+            path = getattr(options, name)
+            if path and path != '-':
+                setattr(options, name, path.replace(ACCOUNT_PLACEHOLDER, username))
+        # check the options now rather than in the middle of the night
+        settings_from_options(options)
+        accounts.append((username, options))
+    return accounts
+
+
+def main():
+    """Parse command-line arguments and run the sweep."""
+    parser = make_parser()
+    parser.usage = "%prog --accounts FILE [RemoveAttachments options]"
+    parser.add_option("--accounts", help="File listing the accounts to process, one username per line, "
+                      "optionally followed by options for this account")
+    parser.add_option("--domain", help="Mail domain added to usernames without one")
+    parser.add_option("--jobs", type="int", default=1,
+                      help="Number of accounts processed at the same time [%default]")
+    parser.add_option("--max-sessions-per-server", type="int", default=0,
+                      help="Maximum number of IMAP sessions open on a server at the same time, over all "
+                      "accounts (0 for no limit) [%default]")
+    parser.add_option("--time-budget", type="int", default=0,
+                      help="Stop starting new mails in an account after this many seconds (0 for no limit) "
+                      "[%default]")
+    parser.add_option("--window", type="int", default=0,
+                      help="Stop the sweep after this many seconds, skipping accounts that were not started "
+                      "(0 for no limit) [%default]")
+    parser.add_option("--report", help="Write the results of all accounts as JSON to this file ('-' for "
+                      "stdout)")
+    defaults, args = parser.parse_args()
+    if not defaults.accounts:
+        parser.error("--accounts is required")
+
+    logging.basicConfig(format="%(asctime)s %(threadName)s %(levelname)s %(message)s", level=logging.INFO)
+    if defaults.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    accounts = load_accounts(parser, defaults, defaults.accounts, defaults.domain)
+    if len(accounts) > 1:
+        for name in ('metrics_json', 'metrics_prom'):
+            path = getattr(defaults, name)
+            if path and ACCOUNT_PLACEHOLDER not in path:
+                parser.error("--%s needs %s in its path to tell the accounts apart" % (name.replace('_', '-'),
+                                                                                      ACCOUNT_PLACEHOLDER))
+
+    sweep = Sweep(accounts, defaults.jobs, defaults.max_sessions_per_server, defaults.window)
+    results = sweep.run()
+    print_report(results)
+    if defaults.report:
+        report = {'started': sweep.started, 'seconds': time.time() - sweep.started, 'accounts': results}
+        text = json.dumps(report, indent=2, sort_keys=True) + '\n'
+        if defaults.report == '-':
+            sys.stdout.write(text)
+        else:
+            instrument.write_atomically(defaults.report, text)
+    if [result for result in results if result['status'] == 'failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+# Copyright HUDORA GmbH 2009
+
+"""Rate limiting and adaptive throttling of IMAP transfers, shared by the IMAP tools.
+
+Gmail and Dovecot throttle or drop sessions of clients that download too fast. A Governor keeps all sessions
+of a run within a budget of bytes and commands per second, enforced with token buckets, and watches the
+sessions for signs of throttling:
+
+ - [THROTTLED] response codes, as sent by Gmail
+ - unexpected BYE responses, which announce a dropped session
+ - FETCH responses that take much longer than usual
+
+On such a signal, the rates are halved, the number of concurrently active sessions is reduced by one and all
+sessions pause for a backoff time, which doubles while the signals keep coming. After every RAMP_INTERVAL
+seconds without a signal, rates and sessions are raised again, up to the configured limits. Without
+configured limits, the governor only starts limiting after the first signal, at half the rate observed until
+then.
+
+    governor = Governor(bytes_per_second=2 * 1024 * 1024, max_sessions=4)
+    govern_imap(imap, governor)
+    with governor.session():
+        ...
+"""
+
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds without throttling signals after which rates and concurrency are raised again
+RAMP_INTERVAL = 30
+# factor the rates are raised by after RAMP_INTERVAL
+RAMP_FACTOR = 1.25
+# first and longest pause after a throttling signal, in seconds
+MIN_BACKOFF = 1
+MAX_BACKOFF = 120
+# signals within this many seconds after the last one are taken as part of the same throttling episode
+SIGNAL_COOLDOWN = 5
+# a response is slow if it takes SLOW_FACTOR times the average response time and at least SLOW_SECONDS
+SLOW_FACTOR = 10
+SLOW_SECONDS = 5
+# commands whose response times are watched, others like APPEND, large SEARCHes or EXPUNGE are slow by nature
+TIMED_COMMANDS = ('FETCH', )
+# lowest rates the governor throttles down to, in bytes and commands per second
+MIN_BYTES_RATE = 16 * 1024
+MIN_COMMANDS_RATE = 0.5
+# length of the window over which the transfer rate is observed, in seconds
+RATE_WINDOW = 10
+
+THROTTLED_RE = re.compile(r'\[THROTTLED\]', re.IGNORECASE)
+BYE_RE = re.compile(r'\* BYE\b', re.IGNORECASE)
+
+
+def command_name(data):
+    """Return the upper-cased name of the IMAP command sent with data, looking through UID.
+
+    >>> command_name('ABCD12 uid FETCH 1:5 (BODY.PEEK[])\\r\\n'), command_name('ABCD13 EXPUNGE\\r\\n')
+    ('FETCH', 'EXPUNGE')
+    """
+    words = data.split(None, 3)
+    if len(words) > 2 and words[1].upper() == 'UID':
+        return words[2].upper()
+    if len(words) > 1:
+        return words[1].upper()
+    return None
+
+
+class TokenBucket(object):
+    """Token bucket refilled with rate tokens per second, holding up to a second worth of tokens.
+
+    consume() takes tokens even if there are not enough and returns how long the caller has to wait until
+    the debt is paid off. A rate of 0 means no limit.
+
+    >>> bucket = TokenBucket(100, now=0)
+    >>> bucket.consume(60, now=0), bucket.consume(60, now=0), bucket.consume(40, now=0.5)
+    (0, 0.2, 0.1)
+    >>> TokenBucket(0, now=0).consume(10 ** 9, now=0)
+    0
+    """
+
+    def __init__(self, rate, now=None):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.time() if now is None else now
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.tokens = min(self.tokens, rate)
+
+    def consume(self, amount, now=None):
+        """Take amount tokens and return the number of seconds to wait before going on."""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if not self.rate:
+                return 0
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate) - amount
+            self.updated = now
+            if self.tokens >= 0:
+                return 0
+            return round(-self.tokens / float(self.rate), 6)
+
+
+class Governor(object):
+    """Bytes and commands per second budget and concurrency limit of all IMAP sessions of a run.
+
+    bytes_per_second and commands_per_second are the upper limits (0 for none), max_sessions is the
+    highest number of sessions active at the same time, see session(). The governor may be shared by
+    threads.
+    """
+
+    def __init__(self, bytes_per_second=0, commands_per_second=0, max_sessions=1):
+        self.max_bytes_rate = bytes_per_second
+        self.max_commands_rate = commands_per_second
+        self.max_sessions = max_sessions
+        self.bytes = TokenBucket(bytes_per_second)
+        self.commands = TokenBucket(commands_per_second)
+        self.sessions = max_sessions
+        self.active = 0
+        self.condition = threading.Condition()
+        self.lock = threading.Lock()
+        now = time.time()
+        self.paused_until = 0
+        self.backoff = MIN_BACKOFF
+        self.last_signal = None
+        self.last_ramp = now
+        self.response_time = None
+        self.window_start = now
+        self.window_bytes = 0
+        self.observed_rate = 0
+        self.stats = {'throttle_signals': 0, 'throttle_seconds': 0.0}
+
+    def set_max_sessions(self, max_sessions):
+        """Change the concurrency limit, e.g. to the number of sessions actually opened."""
+        with self.condition:
+            self.max_sessions = max_sessions
+            if self.last_signal is None:
+                self.sessions = max_sessions
+            else:
+                self.sessions = min(self.sessions, max_sessions)
+            self.condition.notify_all()
+
+    @contextmanager
+    def session(self):
+        """Wait in the with statement until one more session may be active, and count it as active."""
+        with self.condition:
+            while self.active >= self.sessions:
+                self.condition.wait(1)
+                self._ramp_up()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+    def _wait(self, seconds):
+        """Sleep for seconds, plus any pause after a throttling signal."""
+        pause = max(self.paused_until - time.time(), 0)
+        seconds = max(seconds, pause)
+        if seconds > 0:
+            with self.lock:
+                self.stats['throttle_seconds'] += seconds
+            time.sleep(seconds)
+
+    def command(self):
+        """Take a command from the budget, waiting if needed. Called before every IMAP command."""
+        self._ramp_up()
+        self._wait(self.commands.consume(1))
+
+    def transferred(self, nbytes):
+        """Take nbytes from the budget, waiting if needed. Called after data was sent or received."""
+        now = time.time()
+        with self.lock:
+            self.window_bytes += nbytes
+            if now - self.window_start >= RATE_WINDOW:
+                self.observed_rate = self.window_bytes / (now - self.window_start)
+                self.window_start = now
+                self.window_bytes = 0
+        self._wait(self.bytes.consume(nbytes, now))
+
+    def response(self, seconds):
+        """Take note of the time a FETCH took until its first response line, detecting slow responses."""
+        with self.lock:
+            average = self.response_time
+            slow = average is not None and seconds > max(SLOW_FACTOR * average, SLOW_SECONDS)
+            if not slow:
+                self.response_time = seconds if average is None else 0.9 * average + 0.1 * seconds
+        if slow:
+            self.throttled('response took %.1fs' % seconds)
+
+    def throttled(self, reason):
+        """Back off after a throttling signal: halve the rates, reduce the concurrency and pause."""
+        now = time.time()
+        with self.lock:
+            self.stats['throttle_signals'] += 1
+            if self.last_signal is not None and now - self.last_signal < SIGNAL_COOLDOWN:
+                return
+            if self.last_signal is not None and now - self.last_signal < self.backoff + RAMP_INTERVAL:
+                self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+            else:
+                self.backoff = MIN_BACKOFF
+            self.last_signal = now
+            self.last_ramp = now
+            self.paused_until = now + self.backoff
+            bytes_rate = self.bytes.rate or self.observed_rate
+            if not bytes_rate:
+                bytes_rate = self.window_bytes / max(now - self.window_start, 1)
+            commands_rate = self.commands.rate
+        bytes_rate = max(bytes_rate / 2, MIN_BYTES_RATE)
+        logging.warning("IMAP server is throttling (%s), backing off for %ds and limiting transfers to "
+                        "%d kB/s", reason, self.backoff, bytes_rate / 1024)
+        self.bytes.set_rate(bytes_rate)
+        if commands_rate:
+            self.commands.set_rate(max(commands_rate / 2, MIN_COMMANDS_RATE))
+        with self.condition:
+            self.sessions = max(self.sessions - 1, 1)
+
+    def _ramp_up(self):
+        """Raise rates and concurrency after RAMP_INTERVAL seconds without throttling signals."""
+        now = time.time()
+        with self.lock:
+            if now - self.last_ramp < RAMP_INTERVAL:
+                return
+            self.last_ramp = now
+        if self.bytes.rate and self.bytes.rate != self.max_bytes_rate:
+            rate = self.bytes.rate * RAMP_FACTOR
+            if self.max_bytes_rate:
+                rate = min(rate, self.max_bytes_rate)
+            self.bytes.set_rate(rate)
+        if self.commands.rate and self.commands.rate != self.max_commands_rate:
+            self.commands.set_rate(min(self.commands.rate * RAMP_FACTOR, self.max_commands_rate))
+        with self.condition:
+            if self.sessions < self.max_sessions:
+                self.sessions += 1
+                self.condition.notify_all()
+
+
+def govern_imap(imap, governor):
+    """Subject an imaplib session to governor.
+
+    Like instrument.instrument_imap(), this wraps the methods imaplib uses for every command and all socket
+    I/O on the instance. Response lines are checked for [THROTTLED] and unexpected BYE responses, and the
+    time from sending one of the TIMED_COMMANDS until its first response line is passed to
+    Governor.response().
+    """
+    new_tag, send, read, readline = imap._new_tag, imap.send, imap.read, imap.readline
+    # whether a command is about to be sent, and since when a timed one waits for its first response line
+    waiting = {'command': False, 'since': None}
+
+    def governed_new_tag():
+        governor.command()
+        waiting['command'] = True
+        return new_tag()
+
+    def governed_send(data):
+        send(data)
+        timed = waiting['command'] and command_name(data) in TIMED_COMMANDS
+        waiting['command'] = False
+        governor.transferred(len(data))
+        # the waiting time must not include the time we hold back ourselves
+        if timed:
+            waiting['since'] = time.time()
+
+    def governed_read(size):
+        data = read(size)
+        governor.transferred(len(data))
+        return data
+
+    def governed_readline():
+        line = readline()
+        if waiting['since'] is not None:
+            governor.response(time.time() - waiting['since'])
+            waiting['since'] = None
+        if THROTTLED_RE.search(line):
+            governor.throttled(line.strip())
+        elif BYE_RE.match(line) and imap.state != 'LOGOUT':
+            governor.throttled(line.strip())
+        governor.transferred(len(line))
+        return line
+
+    imap._new_tag = governed_new_tag
+    imap.send = governed_send
+    imap.read = governed_read
+    imap.readline = governed_readline
+    return imap
+
+
+def add_options(parser):
+    """Add the governor options to an optparse parser, see from_options()."""
+    parser.add_option("--max-rate", type="int", default=0,
+                      help="Limit IMAP transfers to this many kB/s (0 for no limit, transfers are still "
+                      "slowed down when the server throttles) [%default]")
+    parser.add_option("--max-commands", type="float", default=0,
+                      help="Limit IMAP commands to this many per second (0 for no limit) [%default]")
+
+
+def from_options(options, max_sessions=1):
+    """Return the Governor for the options added by add_options()."""
+    return Governor(options.max_rate * 1024, options.max_commands, max_sessions)